@@ -17,17 +17,20 @@ from __future__ import print_function
 from collections import deque, OrderedDict
 from hashlib import sha1
 import array
+import bisect
 import common
-import functools
 import heapq
 import itertools
 import multiprocessing
+import multiprocessing.pool
 import os
+import random
 import re
 import subprocess
 import threading
 import time
 import tempfile
+import zlib
 
 from rangelib import RangeSet
 
@@ -35,43 +38,137 @@ from rangelib import RangeSet
 __all__ = ["EmptyImage", "DataImage", "BlockImageDiff"]
 
 
-def compute_patch(src, tgt, imgdiff=False):
-  srcfd, srcfile = tempfile.mkstemp(prefix="src-")
-  tgtfd, tgtfile = tempfile.mkstemp(prefix="tgt-")
-  patchfd, patchfile = tempfile.mkstemp(prefix="patch-")
-  os.close(patchfd)
+class ScratchFile(object):
+  """A reusable scratch file for passing data to or from a diff tool.
 
-  try:
-    with os.fdopen(srcfd, "wb") as f_src:
-      for p in src:
-        f_src.write(p)
+  bsdiff and imgdiff only take pathnames. Where memfd_create(2) is available
+  the file is an anonymous in-memory file that the child process opens as
+  /proc/self/fd/N. Otherwise it falls back to a file on tmpfs (/dev/shm), or
+  in the default temp directory if there is no tmpfs. The file is truncated
+  and rewritten for each use rather than created anew."""
+
+  SHM_DIR = "/dev/shm"
+
+  def __init__(self, name):
+    self.unlink_path = None
+    fd = self._MemfdCreate(name)
+    if fd is not None:
+      self.path = "/proc/self/fd/%d" % (fd,)
+    else:
+      shm_dir = self.SHM_DIR if os.access(self.SHM_DIR, os.W_OK) else None
+      fd, self.path = tempfile.mkstemp(prefix=name + "-", dir=shm_dir)
+      self.unlink_path = self.path
+    self.f = os.fdopen(fd, "r+b")
 
-    with os.fdopen(tgtfd, "wb") as f_tgt:
-      for p in tgt:
-        f_tgt.write(p)
+  @staticmethod
+  def _MemfdCreate(name):
+    """Return a memfd file descriptor, or None if memfds can't be used."""
+    if not os.path.isdir("/proc/self/fd"):
+      return None
+    memfd_create = getattr(os, "memfd_create", None)
+    if memfd_create is not None:
+      try:
+        return memfd_create(name, 0)
+      except OSError:
+        return None
     try:
-      os.unlink(patchfile)
-    except OSError:
-      pass
+      import ctypes
+      memfd_create = ctypes.CDLL(None, use_errno=True).memfd_create
+    except (AttributeError, ImportError, OSError):
+      return None
+    # The fd must stay inheritable (no MFD_CLOEXEC) for the diff tool to open
+    # it through /proc/self/fd.
+    fd = memfd_create(name.encode(), 0)
+    return fd if fd >= 0 else None
+
+  def Write(self, pieces):
+    self.Reset()
+    for p in pieces:
+      self.f.write(p)
+    self.f.flush()
+
+  def Read(self):
+    self.f.seek(0)
+    return self.f.read()
+
+  def Reset(self):
+    self.f.seek(0)
+    self.f.truncate()
+    self.f.flush()
+
+  def Close(self):
+    if self.f is not None:
+      self.f.close()
+      self.f = None
+    if self.unlink_path is not None:
+      try:
+        os.unlink(self.unlink_path)
+      except OSError:
+        pass
+      self.unlink_path = None
+
+  def __del__(self):
+    self.Close()
+
+
+# Each thread that calls compute_patch() keeps its own set of scratch files.
+_scratch_files = threading.local()
+
+
+def is_zip_name(name):
+  """Return whether 'name' is that of a zip archive, which imgdiff can diff
+  entry by entry."""
+  return name.split(".")[-1].lower() in ("apk", "jar", "zip")
+
+
+def diff_command(imgdiff=False):
+  """Return the diff program and its options, without the filenames."""
+  if imgdiff:
+    return ["imgdiff", "-z"]
+  return ["bsdiff"]
+
+
+def compute_patch(src, tgt, imgdiff=False, key=None):
+  """Return the patch from 'src' to 'tgt' (lists of strings or buffers).
+
+  Given its patch cache 'key', the patch is stored in OPTIONS.patch_cache,
+  and computed by OPTIONS.diff_pool if it is set (see diff_pool.py)."""
+  diff_pool = common.OPTIONS.diff_pool
+  if key is not None and diff_pool is not None:
+    return diff_pool.Diff(key, [str(p) for p in src], [str(p) for p in tgt],
+                          imgdiff)
+
+  scratch = getattr(_scratch_files, "files", None)
+  if scratch is None:
+    scratch = _scratch_files.files = (
+        ScratchFile("src"), ScratchFile("tgt"), ScratchFile("patch"))
+  src_file, tgt_file, patch_file = scratch
+
+  src_file.Write(src)
+  tgt_file.Write(tgt)
+  patch_file.Reset()
+  try:
+    cmd = diff_command(imgdiff) + [
+        src_file.path, tgt_file.path, patch_file.path]
     if imgdiff:
-      p = subprocess.call(["imgdiff", "-z", srcfile, tgtfile, patchfile],
-                          stdout=open("/dev/null", "a"),
-                          stderr=subprocess.STDOUT)
+      with open(os.devnull, "a") as devnull:
+        p = subprocess.call(cmd, stdout=devnull, stderr=subprocess.STDOUT)
     else:
-      p = subprocess.call(["bsdiff", srcfile, tgtfile, patchfile])
+      p = subprocess.call(cmd)
 
     if p:
       raise ValueError("diff failed: " + str(p))
 
-    with open(patchfile, "rb") as f:
-      return f.read()
+    patch = patch_file.Read()
   finally:
-    try:
-      os.unlink(srcfile)
-      os.unlink(tgtfile)
-      os.unlink(patchfile)
-    except OSError:
-      pass
+    # Don't keep the data alive until the next call on this thread.
+    src_file.Reset()
+    tgt_file.Reset()
+    patch_file.Reset()
+
+  if key is not None:
+    common.OPTIONS.patch_cache.Put(key, patch)
+  return patch
 
 
 class Image(object):
@@ -207,21 +304,167 @@ class Transfer(object):
             " to " + str(self.tgt_ranges) + ">")
 
 
-@functools.total_ordering
-class HeapItem(object):
-  def __init__(self, item):
-    self.item = item
-    # Negate the score since python's heap is a min-heap and we want
-    # the maximum score.
-    self.score = -item.score
-  def clear(self):
-    self.item = None
-  def __bool__(self):
-    return self.item is None
-  def __eq__(self, other):
-    return self.score == other.score
-  def __le__(self, other):
-    return self.score <= other.score
+class IndexedHeap(object):
+  """A max-heap of transfers ordered by their score, where the score of any
+  transfer can be changed, or the transfer removed, in place.
+
+  Each transfer records its position in the heap in its heap_index field,
+  and in heap_order when it was last (re)scored. Transfers of equal scores
+  come out in that order, so the sequence doesn't depend on the shape of
+  the heap."""
+
+  def __init__(self, items):
+    self.heap = list(items)
+    self.counter = itertools.count()
+    for i, item in enumerate(self.heap):
+      item.heap_index = i
+      item.heap_order = next(self.counter)
+    for i in reversed(range(len(self.heap) // 2)):
+      self._SiftDown(i)
+
+  @staticmethod
+  def _Before(a, b):
+    return (a.score > b.score or
+            (a.score == b.score and a.heap_order < b.heap_order))
+
+  def _Place(self, item, i):
+    self.heap[i] = item
+    item.heap_index = i
+
+  def _SiftUp(self, i):
+    heap = self.heap
+    item = heap[i]
+    while i > 0:
+      parent = (i - 1) >> 1
+      if not self._Before(item, heap[parent]):
+        break
+      self._Place(heap[parent], i)
+      i = parent
+    self._Place(item, i)
+
+  def _SiftDown(self, i):
+    heap = self.heap
+    n = len(heap)
+    item = heap[i]
+    while True:
+      child = 2 * i + 1
+      if child >= n:
+        break
+      if child + 1 < n and self._Before(heap[child + 1], heap[child]):
+        child += 1
+      if not self._Before(heap[child], item):
+        break
+      self._Place(heap[child], i)
+      i = child
+    self._Place(item, i)
+
+  def Update(self, item):
+    """Move 'item' to its place after its score has changed."""
+    item.heap_order = next(self.counter)
+    self._SiftUp(item.heap_index)
+    self._SiftDown(item.heap_index)
+
+  def Remove(self, item):
+    i = item.heap_index
+    last = self.heap.pop()
+    item.heap_index = None
+    if last is not item:
+      self._Place(last, i)
+      self._SiftUp(i)
+      self._SiftDown(last.heap_index)
+
+  def Pop(self):
+    """Remove and return the transfer with the highest score."""
+    item = self.heap[0]
+    self.Remove(item)
+    return item
+
+
+class SimilarityIndex(object):
+  """An index of files by content, to find the source file most similar to
+  a target file whose name doesn't match any (e.g. one that moved to another
+  directory and had its version suffix bumped).
+
+  Each file is summarized by a bottom-k min-hash sketch: the k smallest
+  hashes of the short strings (shingles) starting at content-defined anchor
+  points in its data. As the anchors depend on the data only, files sharing
+  most of their contents have overlapping sketches even if the data moved
+  around within the files. The sketches are scaled down so that the index
+  holds at most max_entries hashes."""
+
+  SKETCH_SIZE = 128
+  MIN_SKETCH_SIZE = 16
+  SHINGLE_SIZE = 32
+
+  # Shingles start at the 2-byte sequences made of one of 16 values followed
+  # by one of 16 others, i.e. about once every 256 bytes of random data.
+  ANCHOR_RE = re.compile("[%s][%s]" % (
+      "".join("\\x%02x" % (i,) for i in range(0, 256, 16)),
+      "".join("\\x%02x" % (i,) for i in range(7, 256, 16))))
+
+  def __init__(self, image, file_map, max_entries=1 << 20,
+               min_similarity=0.25):
+    """Index the files in 'file_map' (name -> RangeSet) of 'image'. Only
+    the largest ones are indexed if there's no room for all of them."""
+    self.min_similarity = min_similarity
+
+    names = sorted(file_map, key=lambda fn: (-file_map[fn].size(), fn))
+    names = names[:max_entries // self.MIN_SKETCH_SIZE]
+    self.sketch_size = self.SKETCH_SIZE
+    if names:
+      self.sketch_size = max(self.MIN_SKETCH_SIZE, min(
+          self.SKETCH_SIZE, max_entries // len(names)))
+
+    self.names = []
+    self.sketches = []
+    self.postings = {}
+    for fn in names:
+      sketch = self.Sketch(image, file_map[fn])
+      if not sketch:
+        continue
+      for h in sketch:
+        self.postings.setdefault(h, []).append(len(self.names))
+      self.names.append(fn)
+      self.sketches.append(sketch)
+
+  def Sketch(self, image, ranges):
+    """Return the bottom-k sketch of the 'ranges' blocks of 'image'."""
+    k = self.sketch_size
+    hashes = set()
+    for data in image.ReadRangeSet(ranges):
+      data = str(data)
+      for m in self.ANCHOR_RE.finditer(data):
+        i = m.start()
+        hashes.add(zlib.crc32(data[i:i + self.SHINGLE_SIZE]) & 0xffffffff)
+      if len(hashes) > 4 * k:
+        hashes = set(heapq.nsmallest(k, hashes))
+    return frozenset(heapq.nsmallest(k, hashes))
+
+  def Similarity(self, a, b):
+    """Estimate the Jaccard similarity of the files with sketches a and b."""
+    union = heapq.nsmallest(self.sketch_size, a | b)
+    if not union:
+      return 0.0
+    return sum(1 for h in union if h in a and h in b) / float(len(union))
+
+  def FindMostSimilar(self, image, ranges):
+    """Return the name of the indexed file most similar to the 'ranges'
+    blocks of 'image', or None if none is similar enough."""
+    sketch = self.Sketch(image, ranges)
+    counts = {}
+    for h in sketch:
+      for i in self.postings.get(h, ()):
+        counts[i] = counts.get(i, 0) + 1
+    if not counts:
+      return None
+
+    # Only estimate the similarity of the few files sharing the most hashes.
+    candidates = sorted(counts, key=lambda i: (-counts[i], i))[:8]
+    best = max(candidates,
+               key=lambda i: (self.Similarity(sketch, self.sketches[i]), -i))
+    if self.Similarity(sketch, self.sketches[best]) < self.min_similarity:
+      return None
+    return self.names[best]
 
 
 # BlockImageDiff works on two image objects.  An image object is
@@ -275,7 +518,11 @@ class BlockImageDiff(object):
     self._max_stashed_size = 0
     self.touched_src_ranges = RangeSet()
     self.touched_src_sha1 = None
+    self.src_block_index = None
     self.disable_imgdiff = disable_imgdiff
+    # Large files get split into pieces of at most this fraction of the cache
+    # size (see AddSplitTransfers() in FindTransfers()).
+    self.split_threshold = 0.125
 
     assert version in (1, 2, 3, 4)
 
@@ -297,7 +544,7 @@ class BlockImageDiff(object):
   def max_stashed_size(self):
     return self._max_stashed_size
 
-  def Compute(self, prefix):
+  def Compute(self, prefix, write_new_data=True):
     # When looking for a source file to use as the diff input for a
     # target file, we try:
     #   1) an exact path match if available, otherwise
@@ -322,17 +569,26 @@ class BlockImageDiff(object):
       self.ReverseBackwardEdges()
       self.ImproveVertexSequence()
 
-    # Ensure the runtime stash size is under the limit.
+    # Ensure the runtime stash size is under the limit, reordering the
+    # transfers first if that saves converting some of them to "new".
     if self.version >= 2 and common.OPTIONS.cache_size is not None:
+      if common.OPTIONS.stash_reorder_rounds > 0:
+        self.ImproveStashOrder()
       self.ReviseStashSize()
 
     # Double-check our work.
     self.AssertSequenceGood()
 
-    self.ComputePatches(prefix)
+    self.ComputePatches(prefix, write_new_data)
     self.WriteTransfers(prefix)
 
   def HashBlocks(self, source, ranges): # pylint: disable=no-self-use
+    # Images that cache their hashes (e.g. SparseImage) compute them
+    # themselves, so that the same blocks aren't read and hashed repeatedly.
+    range_sha1 = getattr(source, "RangeSha1", None)
+    if range_sha1 is not None:
+      return range_sha1(ranges)
+
     data = source.ReadRangeSet(ranges)
     ctx = sha1()
 
@@ -353,12 +609,22 @@ class BlockImageDiff(object):
       total = 0
       while target_blocks:
         blocks_to_write = target_blocks.first(blocks_limit)
-        out.append("%s %s\n" % (style, blocks_to_write.to_string_raw()))
+        out.write("%s %s\n" % (style, blocks_to_write.to_string_raw()))
         total += blocks_to_write.size()
         target_blocks = target_blocks.subtract(blocks_to_write)
       return total
 
-    out = []
+    # The header of the transfer list (the total number of blocks written, the
+    # number of stash slots and the maximum stash size) and the initial erase
+    # command depend on the whole update. Rather than holding all the commands
+    # in memory until they are known, we work them out in a first pass that
+    # only does the stash bookkeeping, and then stream the commands straight
+    # to the file in a second pass.
+    #
+    # The first pass assigns the stash slot of each stash (stash_ids), and for
+    # version 3+ the hash it's stored under (stash_hashes), which stashes need
+    # a "stash" command (stash_writes) and after which use they can be freed
+    # (stash_frees).
 
     total = 0
 
@@ -369,6 +635,12 @@ class BlockImageDiff(object):
     free_stash_ids = []
     next_stash_id = 0
 
+    stash_ids = {}
+    stash_hashes = {}
+    stash_writes = set()
+    stash_frees = set()
+    touched_src_ranges = [self.touched_src_ranges]
+
     for xf in self.transfers:
 
       if self.version < 2:
@@ -383,170 +655,62 @@ class BlockImageDiff(object):
           sid = next_stash_id
           next_stash_id += 1
         stashes[s] = sid
+        stash_ids[s] = sid
         if self.version == 2:
           stashed_blocks += sr.size()
-          out.append("stash %d %s\n" % (sid, sr.to_string_raw()))
+          stash_writes.add(s)
         else:
           sh = self.HashBlocks(self.src, sr)
+          stash_hashes[s] = sh
           if sh in stashes:
             stashes[sh] += 1
           else:
             stashes[sh] = 1
             stashed_blocks += sr.size()
-            self.touched_src_ranges = self.touched_src_ranges.union(sr)
-            out.append("stash %s %s\n" % (sh, sr.to_string_raw()))
+            touched_src_ranges.append(sr)
+            stash_writes.add(s)
 
       if stashed_blocks > max_stashed_blocks:
         max_stashed_blocks = stashed_blocks
 
-      free_string = []
       free_size = 0
-
-      if self.version == 1:
-        src_str = xf.src_ranges.to_string_raw() if xf.src_ranges else ""
-      elif self.version >= 2:
-
-        #   <# blocks> <src ranges>
-        #     OR
-        #   <# blocks> <src ranges> <src locs> <stash refs...>
-        #     OR
-        #   <# blocks> - <stash refs...>
-
-        size = xf.src_ranges.size()
-        src_str = [str(size)]
-
-        unstashed_src_ranges = xf.src_ranges
-        mapped_stashes = []
-        for s, sr in xf.use_stash:
-          sid = stashes.pop(s)
-          unstashed_src_ranges = unstashed_src_ranges.subtract(sr)
-          sh = self.HashBlocks(self.src, sr)
-          sr = xf.src_ranges.map_within(sr)
-          mapped_stashes.append(sr)
-          if self.version == 2:
-            src_str.append("%d:%s" % (sid, sr.to_string_raw()))
-            # A stash will be used only once. We need to free the stash
-            # immediately after the use, instead of waiting for the automatic
-            # clean-up at the end. Because otherwise it may take up extra space
-            # and lead to OTA failures.
-            # Bug: 23119955
-            free_string.append("free %d\n" % (sid,))
-            free_size += sr.size()
-          else:
-            assert sh in stashes
-            src_str.append("%s:%s" % (sh, sr.to_string_raw()))
-            stashes[sh] -= 1
-            if stashes[sh] == 0:
-              free_size += sr.size()
-              free_string.append("free %s\n" % (sh))
-              stashes.pop(sh)
-          heapq.heappush(free_stash_ids, sid)
-
-        if unstashed_src_ranges:
-          src_str.insert(1, unstashed_src_ranges.to_string_raw())
-          if xf.use_stash:
-            mapped_unstashed = xf.src_ranges.map_within(unstashed_src_ranges)
-            src_str.insert(2, mapped_unstashed.to_string_raw())
-            mapped_stashes.append(mapped_unstashed)
-            self.AssertPartition(RangeSet(data=(0, size)), mapped_stashes)
+      for s, sr in xf.use_stash:
+        sid = stashes.pop(s)
+        if self.version == 2:
+          free_size += sr.size()
+          stash_frees.add(s)
         else:
-          src_str.insert(1, "-")
-          self.AssertPartition(RangeSet(data=(0, size)), mapped_stashes)
-
-        src_str = " ".join(src_str)
-
-      # all versions:
-      #   zero <rangeset>
-      #   new <rangeset>
-      #   erase <rangeset>
-      #
-      # version 1:
-      #   bsdiff patchstart patchlen <src rangeset> <tgt rangeset>
-      #   imgdiff patchstart patchlen <src rangeset> <tgt rangeset>
-      #   move <src rangeset> <tgt rangeset>
-      #
-      # version 2:
-      #   bsdiff patchstart patchlen <tgt rangeset> <src_str>
-      #   imgdiff patchstart patchlen <tgt rangeset> <src_str>
-      #   move <tgt rangeset> <src_str>
-      #
-      # version 3:
-      #   bsdiff patchstart patchlen srchash tgthash <tgt rangeset> <src_str>
-      #   imgdiff patchstart patchlen srchash tgthash <tgt rangeset> <src_str>
-      #   move hash <tgt rangeset> <src_str>
+          sh = stash_hashes[s]
+          assert sh in stashes
+          stashes[sh] -= 1
+          if stashes[sh] == 0:
+            free_size += sr.size()
+            stash_frees.add(s)
+            stashes.pop(sh)
+        heapq.heappush(free_stash_ids, sid)
 
       tgt_size = xf.tgt_ranges.size()
 
       if xf.style == "new":
-        assert xf.tgt_ranges
-        assert tgt_size == WriteSplitTransfers(out, xf.style, xf.tgt_ranges)
         total += tgt_size
-      elif xf.style == "move":
-        assert xf.tgt_ranges
-        assert xf.src_ranges.size() == tgt_size
-        if xf.src_ranges != xf.tgt_ranges:
-          if self.version == 1:
-            out.append("%s %s %s\n" % (
-                xf.style,
-                xf.src_ranges.to_string_raw(), xf.tgt_ranges.to_string_raw()))
-          elif self.version == 2:
-            out.append("%s %s %s\n" % (
-                xf.style,
-                xf.tgt_ranges.to_string_raw(), src_str))
-          elif self.version >= 3:
+      elif xf.style in ("move", "bsdiff", "imgdiff"):
+        # A move onto itself is a no-op and doesn't get written out.
+        if xf.style != "move" or xf.src_ranges != xf.tgt_ranges:
+          if self.version >= 3:
             # take into account automatic stashing of overlapping blocks
             if xf.src_ranges.overlaps(xf.tgt_ranges):
               temp_stash_usage = stashed_blocks + xf.src_ranges.size()
               if temp_stash_usage > max_stashed_blocks:
                 max_stashed_blocks = temp_stash_usage
 
-            self.touched_src_ranges = self.touched_src_ranges.union(
-                xf.src_ranges)
-
-            out.append("%s %s %s %s\n" % (
-                xf.style,
-                self.HashBlocks(self.tgt, xf.tgt_ranges),
-                xf.tgt_ranges.to_string_raw(), src_str))
+            touched_src_ranges.append(xf.src_ranges)
           total += tgt_size
-      elif xf.style in ("bsdiff", "imgdiff"):
-        assert xf.tgt_ranges
-        assert xf.src_ranges
-        if self.version == 1:
-          out.append("%s %d %d %s %s\n" % (
-              xf.style, xf.patch_start, xf.patch_len,
-              xf.src_ranges.to_string_raw(), xf.tgt_ranges.to_string_raw()))
-        elif self.version == 2:
-          out.append("%s %d %d %s %s\n" % (
-              xf.style, xf.patch_start, xf.patch_len,
-              xf.tgt_ranges.to_string_raw(), src_str))
-        elif self.version >= 3:
-          # take into account automatic stashing of overlapping blocks
-          if xf.src_ranges.overlaps(xf.tgt_ranges):
-            temp_stash_usage = stashed_blocks + xf.src_ranges.size()
-            if temp_stash_usage > max_stashed_blocks:
-              max_stashed_blocks = temp_stash_usage
-
-          self.touched_src_ranges = self.touched_src_ranges.union(
-              xf.src_ranges)
-
-          out.append("%s %d %d %s %s %s %s\n" % (
-              xf.style,
-              xf.patch_start, xf.patch_len,
-              self.HashBlocks(self.src, xf.src_ranges),
-              self.HashBlocks(self.tgt, xf.tgt_ranges),
-              xf.tgt_ranges.to_string_raw(), src_str))
-        total += tgt_size
       elif xf.style == "zero":
-        assert xf.tgt_ranges
-        to_zero = xf.tgt_ranges.subtract(xf.src_ranges)
-        assert WriteSplitTransfers(out, xf.style, to_zero) == to_zero.size()
-        total += to_zero.size()
+        total += xf.tgt_ranges.subtract(xf.src_ranges).size()
       else:
         raise ValueError("unknown transfer style '%s'\n" % xf.style)
 
-      if free_string:
-        out.append("".join(free_string))
-        stashed_blocks -= free_size
+      stashed_blocks -= free_size
 
       if self.version >= 2 and common.OPTIONS.cache_size is not None:
         # Sanity check: abort if we're going to need more stash space than
@@ -564,13 +728,11 @@ class BlockImageDiff(object):
                    stash_threshold)
 
     if self.version >= 3:
+      self.touched_src_ranges = RangeSet.union_all(touched_src_ranges)
       self.touched_src_sha1 = self.HashBlocks(
           self.src, self.touched_src_ranges)
 
-    # Zero out extended blocks as a workaround for bug 20881595.
     if self.tgt.extended:
-      assert (WriteSplitTransfers(out, "zero", self.tgt.extended) ==
-              self.tgt.extended.size())
       total += self.tgt.extended.size()
 
     # We erase all the blocks on the partition that a) don't contain useful
@@ -584,24 +746,164 @@ class BlockImageDiff(object):
     new_dontcare = all_tgt_minus_extended.subtract(self.tgt.care_map)
 
     erase_first = new_dontcare.subtract(self.touched_src_ranges)
-    if erase_first:
-      out.insert(0, "erase %s\n" % (erase_first.to_string_raw(),))
-
     erase_last = new_dontcare.subtract(erase_first)
-    if erase_last:
-      out.append("erase %s\n" % (erase_last.to_string_raw(),))
 
-    out.insert(0, "%d\n" % (self.version,))   # format version number
-    out.insert(1, "%d\n" % (total,))
-    if self.version >= 2:
-      # version 2 only: after the total block count, we give the number
-      # of stash slots needed, and the maximum size needed (in blocks)
-      out.insert(2, str(next_stash_id) + "\n")
-      out.insert(3, str(max_stashed_blocks) + "\n")
+    # Second pass: write out the commands.
+    with open(prefix + ".transfer.list", "wb") as out:
+      out.write("%d\n" % (self.version,))   # format version number
+      out.write("%d\n" % (total,))
+      if self.version >= 2:
+        # version 2 only: after the total block count, we give the number
+        # of stash slots needed, and the maximum size needed (in blocks)
+        out.write(str(next_stash_id) + "\n")
+        out.write(str(max_stashed_blocks) + "\n")
+
+      if erase_first:
+        out.write("erase %s\n" % (erase_first.to_string_raw(),))
+
+      written = 0
+
+      for xf in self.transfers:
+
+        for s, sr in xf.stash_before:
+          if s not in stash_writes:
+            continue
+          if self.version == 2:
+            out.write("stash %d %s\n" % (stash_ids[s], sr.to_string_raw()))
+          else:
+            out.write("stash %s %s\n" % (stash_hashes[s], sr.to_string_raw()))
+
+        free_string = []
 
-    with open(prefix + ".transfer.list", "wb") as f:
-      for i in out:
-        f.write(i)
+        if self.version == 1:
+          src_str = xf.src_ranges.to_string_raw() if xf.src_ranges else ""
+        elif self.version >= 2:
+
+          #   <# blocks> <src ranges>
+          #     OR
+          #   <# blocks> <src ranges> <src locs> <stash refs...>
+          #     OR
+          #   <# blocks> - <stash refs...>
+
+          size = xf.src_ranges.size()
+          src_str = [str(size)]
+
+          unstashed_src_ranges = xf.src_ranges
+          mapped_stashes = []
+          for s, sr in xf.use_stash:
+            unstashed_src_ranges = unstashed_src_ranges.subtract(sr)
+            sr = xf.src_ranges.map_within(sr)
+            mapped_stashes.append(sr)
+            if self.version == 2:
+              sid = stash_ids[s]
+              src_str.append("%d:%s" % (sid, sr.to_string_raw()))
+              # A stash will be used only once. We need to free the stash
+              # immediately after the use, instead of waiting for the
+              # automatic clean-up at the end. Because otherwise it may take
+              # up extra space and lead to OTA failures.
+              # Bug: 23119955
+              free_string.append("free %d\n" % (sid,))
+            else:
+              sh = stash_hashes[s]
+              src_str.append("%s:%s" % (sh, sr.to_string_raw()))
+              if s in stash_frees:
+                free_string.append("free %s\n" % (sh))
+
+          if unstashed_src_ranges:
+            src_str.insert(1, unstashed_src_ranges.to_string_raw())
+            if xf.use_stash:
+              mapped_unstashed = xf.src_ranges.map_within(unstashed_src_ranges)
+              src_str.insert(2, mapped_unstashed.to_string_raw())
+              mapped_stashes.append(mapped_unstashed)
+              self.AssertPartition(RangeSet(data=(0, size)), mapped_stashes)
+          else:
+            src_str.insert(1, "-")
+            self.AssertPartition(RangeSet(data=(0, size)), mapped_stashes)
+
+          src_str = " ".join(src_str)
+
+        # all versions:
+        #   zero <rangeset>
+        #   new <rangeset>
+        #   erase <rangeset>
+        #
+        # version 1:
+        #   bsdiff patchstart patchlen <src rangeset> <tgt rangeset>
+        #   imgdiff patchstart patchlen <src rangeset> <tgt rangeset>
+        #   move <src rangeset> <tgt rangeset>
+        #
+        # version 2:
+        #   bsdiff patchstart patchlen <tgt rangeset> <src_str>
+        #   imgdiff patchstart patchlen <tgt rangeset> <src_str>
+        #   move <tgt rangeset> <src_str>
+        #
+        # version 3:
+        #   bsdiff patchstart patchlen srchash tgthash <tgt rangeset> <src_str>
+        #   imgdiff patchstart patchlen srchash tgthash <tgt rangeset> <src_str>
+        #   move hash <tgt rangeset> <src_str>
+
+        tgt_size = xf.tgt_ranges.size()
+
+        if xf.style == "new":
+          assert xf.tgt_ranges
+          assert tgt_size == WriteSplitTransfers(out, xf.style, xf.tgt_ranges)
+          written += tgt_size
+        elif xf.style == "move":
+          assert xf.tgt_ranges
+          assert xf.src_ranges.size() == tgt_size
+          if xf.src_ranges != xf.tgt_ranges:
+            if self.version == 1:
+              out.write("%s %s %s\n" % (
+                  xf.style,
+                  xf.src_ranges.to_string_raw(), xf.tgt_ranges.to_string_raw()))
+            elif self.version == 2:
+              out.write("%s %s %s\n" % (
+                  xf.style,
+                  xf.tgt_ranges.to_string_raw(), src_str))
+            elif self.version >= 3:
+              out.write("%s %s %s %s\n" % (
+                  xf.style,
+                  self.HashBlocks(self.tgt, xf.tgt_ranges),
+                  xf.tgt_ranges.to_string_raw(), src_str))
+            written += tgt_size
+        elif xf.style in ("bsdiff", "imgdiff"):
+          assert xf.tgt_ranges
+          assert xf.src_ranges
+          if self.version == 1:
+            out.write("%s %d %d %s %s\n" % (
+                xf.style, xf.patch_start, xf.patch_len,
+                xf.src_ranges.to_string_raw(), xf.tgt_ranges.to_string_raw()))
+          elif self.version == 2:
+            out.write("%s %d %d %s %s\n" % (
+                xf.style, xf.patch_start, xf.patch_len,
+                xf.tgt_ranges.to_string_raw(), src_str))
+          elif self.version >= 3:
+            out.write("%s %d %d %s %s %s %s\n" % (
+                xf.style,
+                xf.patch_start, xf.patch_len,
+                self.HashBlocks(self.src, xf.src_ranges),
+                self.HashBlocks(self.tgt, xf.tgt_ranges),
+                xf.tgt_ranges.to_string_raw(), src_str))
+          written += tgt_size
+        elif xf.style == "zero":
+          assert xf.tgt_ranges
+          to_zero = xf.tgt_ranges.subtract(xf.src_ranges)
+          assert WriteSplitTransfers(out, xf.style, to_zero) == to_zero.size()
+          written += to_zero.size()
+
+        if free_string:
+          out.write("".join(free_string))
+
+      # Zero out extended blocks as a workaround for bug 20881595.
+      if self.tgt.extended:
+        assert (WriteSplitTransfers(out, "zero", self.tgt.extended) ==
+                self.tgt.extended.size())
+        written += self.tgt.extended.size()
+
+      if erase_last:
+        out.write("erase %s\n" % (erase_last.to_string_raw(),))
+
+    assert written == total, "wrote %d blocks, expected %d" % (written, total)
 
     if self.version >= 2:
       self._max_stashed_size = max_stashed_blocks * self.tgt.blocksize
@@ -616,84 +918,246 @@ class BlockImageDiff(object):
         print("max stashed blocks: %d  (%d bytes), limit: <unknown>\n" % (
               max_stashed_blocks, self._max_stashed_size))
 
-  def ReviseStashSize(self):
-    print("Revising stash size...")
-    stashes = {}
+  def MaxAllowedStashBlocks(self):
+    """Return the maximum blocks available for stash based on /cache size and
+    the threshold."""
+    cache_size = common.OPTIONS.cache_size
+    stash_threshold = common.OPTIONS.stash_threshold
+    return cache_size * stash_threshold / self.tgt.blocksize
 
-    # Create the map between a stash and its def/use points. For example, for a
-    # given stash of (idx, sr), stashes[idx] = (sr, def_cmd, use_cmd).
-    for xf in self.transfers:
-      # Command xf defines (stores) all the stashes in stash_before.
-      for idx, sr in xf.stash_before:
-        stashes[idx] = (sr, xf)
+  def SimulateStash(self, transfers, max_allowed):
+    """Simulate running 'transfers' in order with at most 'max_allowed' blocks
+    of stash, without changing anything.
 
-      # Record all the stashes command xf uses.
-      for idx, _ in xf.use_stash:
-        stashes[idx] += (xf,)
+    Returns (replaced_cmds, max_stashed_blocks). replaced_cmds lists the
+    (cmd, blocks, kind) of the commands ReviseStashSize() needs to replace
+    with "new" to stay within the limit, where kind is "explicit" or
+    "implicit"; max_stashed_blocks is the peak stash size of the remaining
+    commands."""
 
-    # Compute the maximum blocks available for stash based on /cache size and
-    # the threshold.
-    cache_size = common.OPTIONS.cache_size
-    stash_threshold = common.OPTIONS.stash_threshold
-    max_allowed = cache_size * stash_threshold / self.tgt.blocksize
+    # Map each stash to the command that uses it.
+    users = {}
+    for xf in transfers:
+      for idx, _ in xf.use_stash:
+        users[idx] = xf
 
+    replaced_cmds = []
+    replaced = set()
     stashed_blocks = 0
-    new_blocks = 0
+    max_stashed_blocks = 0
 
-    # Now go through all the commands. Compute the required stash size on the
+    # Go through all the commands, computing the required stash size on the
     # fly. If a command requires excess stash than available, it deletes the
     # stash by replacing the command that uses the stash with a "new" command
-    # instead.
-    for xf in self.transfers:
-      replaced_cmds = []
+    # instead. A replaced command no longer uses any stashes (which then
+    # aren't stashed either, unless that already happened) nor stashes its
+    # source blocks implicitly.
+    for xf in transfers:
+      replaced_here = []
 
       # xf.stash_before generates explicit stash commands.
       for idx, sr in xf.stash_before:
+        use_cmd = users[idx]
+        if use_cmd in replaced:
+          continue
         if stashed_blocks + sr.size() > max_allowed:
           # We cannot stash this one for a later command. Find out the command
           # that will use this stash and replace the command with "new".
-          use_cmd = stashes[idx][2]
-          replaced_cmds.append(use_cmd)
-          print("%10d  %9s  %s" % (sr.size(), "explicit", use_cmd))
+          replaced_here.append((use_cmd, sr.size(), "explicit"))
         else:
           stashed_blocks += sr.size()
+          max_stashed_blocks = max(max_stashed_blocks, stashed_blocks)
+
+      if xf not in replaced:
+        # xf.use_stash generates free commands.
+        for _, sr in xf.use_stash:
+          stashed_blocks -= sr.size()
+
+        # "move" and "diff" may introduce implicit stashes in BBOTA v3. Prior
+        # to ComputePatches(), they both have the style of "diff".
+        if xf.style == "diff" and self.version >= 3:
+          assert xf.tgt_ranges and xf.src_ranges
+          if xf.src_ranges.overlaps(xf.tgt_ranges):
+            temp_stash_usage = stashed_blocks + xf.src_ranges.size()
+            if temp_stash_usage > max_allowed:
+              replaced_here.append((xf, xf.src_ranges.size(), "implicit"))
+            else:
+              max_stashed_blocks = max(max_stashed_blocks, temp_stash_usage)
+
+      replaced_cmds.extend(replaced_here)
+      replaced.update(cmd for cmd, _, _ in replaced_here)
+
+    return replaced_cmds, max_stashed_blocks
+
+  def ImproveStashOrder(self):
+    """Reorder the transfers so that fewer of them need to be packed as "new"
+    by ReviseStashSize() to fit the stash into /cache.
+
+    Any topological order of the (acyclic by now) digraph is a valid sequence.
+    We try orders built greedily from the stash sizes, first deterministically
+    and then with random perturbations, until one fits or we've tried
+    OPTIONS.stash_reorder_rounds of them or we stop finding better ones, and
+    keep the best one: the one converting the fewest blocks to "new", then
+    with the smallest peak stash size. The random generator is seeded, so
+    the result is reproducible; only OPTIONS.stash_reorder_time (seconds, if
+    set) can cut the search short depending on the machine's speed."""
+
+    print("Reordering transfers to reduce stash size...")
+    max_allowed = self.MaxAllowedStashBlocks()
+
+    def Cost(transfers):
+      replaced_cmds, max_stashed_blocks = self.SimulateStash(
+          transfers, max_allowed)
+      new_blocks = sum(cmd.tgt_ranges.size() for cmd in
+                       set(cmd for cmd, _, _ in replaced_cmds))
+      return new_blocks, max_stashed_blocks
+
+    # Give up early once this many random orders in a row brought nothing.
+    max_stale_rounds = 256
+
+    initial_cost = best_cost = Cost(self.transfers)
+    best = None
+    max_rounds = common.OPTIONS.stash_reorder_rounds
+    time_limit = common.OPTIONS.stash_reorder_time
+    deadline = None if time_limit is None else time.time() + time_limit
+    rnd = random.Random(0)
+    rounds = 0
+    stale_rounds = 0
+    while (best_cost[0] > 0 and rounds < max_rounds and
+           stale_rounds < max_stale_rounds):
+      if deadline is not None and time.time() >= deadline:
+        print(("  Warning: stopped reordering after %d round(s): "
+               "stash_reorder_time (%gs) reached; the output now depends "
+               "on the speed of this machine.") % (rounds, time_limit))
+        break
+      transfers = self.StashAwareSequence(max_allowed,
+                                          rnd if rounds > 0 else None)
+      rounds += 1
+      cost = Cost(transfers)
+      if cost < best_cost:
+        best_cost = cost
+        best = transfers
+        stale_rounds = 0
+      else:
+        stale_rounds += 1
+
+    if best is not None:
+      self.transfers = best
+      for i, xf in enumerate(best):
+        xf.order = i
+
+    saved_blocks = initial_cost[0] - best_cost[0]
+    print(("  %d blocks (%d bytes) saved from being packed as new blocks "
+           "in %d round(s); peak stash %d -> %d blocks.") % (
+               saved_blocks, saved_blocks * self.tgt.blocksize, rounds,
+               initial_cost[1], best_cost[1]))
+
+  def StashAwareSequence(self, max_allowed, rnd=None):
+    """Return a topological order of the transfers that tries to keep the
+    stash within 'max_allowed' blocks.
+
+    Whenever there's a choice, we take the transfer that leaves the least
+    amount of stashed data after it's executed (like ImproveVertexSequence()),
+    among those that can run without exceeding the limit. If 'rnd' is given,
+    these amounts are randomly perturbed to explore other orders."""
+
+    # Only look at this many candidates for one that fits before giving up
+    # and taking the best one, to bound the cost of each step.
+    max_candidates = 64
+
+    stash_size = {}
+    need = {}
+    incoming = {}
+    for xf in self.transfers:
+      stash = sum(sr.size() for _, sr in xf.stash_before)
+      free = sum(sr.size() for _, sr in xf.use_stash)
+      implicit = 0
+      if (xf.style == "diff" and self.version >= 3 and
+          xf.src_ranges.overlaps(xf.tgt_ranges)):
+        implicit = xf.src_ranges.size()
+      stash_size[xf] = stash - free
+      need[xf] = max(stash, stash - free + implicit)
+      incoming[xf] = len(xf.goes_after)
+
+    def Key(u):
+      if rnd is None:
+        return (stash_size[u], u.order, u)
+      return (stash_size[u] * rnd.uniform(0.5, 1.5), rnd.random(), u)
+
+    S = [Key(u) for u in self.transfers if not incoming[u]]
+    heapq.heapify(S)
+
+    L = []
+    stashed_blocks = 0
+    while S:
+      room = max_allowed - stashed_blocks
+      skipped = []
+      while S and len(skipped) < max_candidates:
+        item = heapq.heappop(S)
+        if need[item[2]] <= room:
+          break
+        skipped.append(item)
+      else:
+        item = skipped.pop(0)
+      for i in skipped:
+        heapq.heappush(S, i)
 
-      # xf.use_stash generates free commands.
-      for _, sr in xf.use_stash:
-        stashed_blocks -= sr.size()
-
-      # "move" and "diff" may introduce implicit stashes in BBOTA v3. Prior to
-      # ComputePatches(), they both have the style of "diff".
-      if xf.style == "diff" and self.version >= 3:
-        assert xf.tgt_ranges and xf.src_ranges
-        if xf.src_ranges.overlaps(xf.tgt_ranges):
-          if stashed_blocks + xf.src_ranges.size() > max_allowed:
-            replaced_cmds.append(xf)
-            print("%10d  %9s  %s" % (xf.src_ranges.size(), "implicit", xf))
-
-      # Replace the commands in replaced_cmds with "new"s.
-      for cmd in replaced_cmds:
-        # It no longer uses any commands in "use_stash". Remove the def points
-        # for all those stashes.
-        for idx, sr in cmd.use_stash:
-          def_cmd = stashes[idx][1]
-          assert (idx, sr) in def_cmd.stash_before
-          def_cmd.stash_before.remove((idx, sr))
-
-        # Add up blocks that violates space limit and print total number to
-        # screen later.
-        new_blocks += cmd.tgt_ranges.size()
-        cmd.ConvertToNew()
+      xf = item[2]
+      L.append(xf)
+      stashed_blocks += stash_size[xf]
+      for u in xf.goes_before:
+        incoming[u] -= 1
+        if not incoming[u]:
+          heapq.heappush(S, Key(u))
+
+    # if this fails then our graph had a cycle.
+    assert len(L) == len(self.transfers)
+    return L
+
+  def ReviseStashSize(self):
+    print("Revising stash size...")
+    stashes = {}
+
+    # Create the map between a stash and its def point. For example, for a
+    # given stash of (idx, sr), stashes[idx] = (sr, def_cmd).
+    for xf in self.transfers:
+      # Command xf defines (stores) all the stashes in stash_before.
+      for idx, sr in xf.stash_before:
+        stashes[idx] = (sr, xf)
+
+    replaced_cmds, _ = self.SimulateStash(self.transfers,
+                                          self.MaxAllowedStashBlocks())
+
+    # Replace the commands in replaced_cmds with "new"s.
+    new_blocks = 0
+    for cmd, size, kind in replaced_cmds:
+      print("%10d  %9s  %s" % (size, kind, cmd))
+
+      # It no longer uses any commands in "use_stash". Remove the def points
+      # for all those stashes.
+      for idx, sr in cmd.use_stash:
+        def_cmd = stashes[idx][1]
+        assert (idx, sr) in def_cmd.stash_before
+        def_cmd.stash_before.remove((idx, sr))
+
+      # Add up blocks that violates space limit and print total number to
+      # screen later.
+      new_blocks += cmd.tgt_ranges.size()
+      cmd.ConvertToNew()
 
     num_of_bytes = new_blocks * self.tgt.blocksize
     print("  Total %d blocks (%d bytes) are packed as new blocks due to "
           "insufficient cache size." % (new_blocks, num_of_bytes))
 
-  def ComputePatches(self, prefix):
+  def ComputePatches(self, prefix, write_new_data=True):
+    # Unless 'write_new_data' is True, the new data is left for the caller
+    # to read from the target image (e.g. straight into the package) in the
+    # order of the "new" commands in the transfer list.
     print("Reticulating splines...")
-    diff_q = []
+    diff_queue = []
     patch_num = 0
-    with open(prefix + ".new.dat", "wb") as new_f:
+    new_f = open(prefix + ".new.dat", "wb") if write_new_data else None
+    try:
       for xf in self.transfers:
         if xf.style == "zero":
           tgt_size = xf.tgt_ranges.size() * self.tgt.blocksize
@@ -702,17 +1166,15 @@ class BlockImageDiff(object):
               str(xf.tgt_ranges)))
 
         elif xf.style == "new":
-          for piece in self.tgt.ReadRangeSet(xf.tgt_ranges):
-            new_f.write(piece)
+          if new_f is not None:
+            for piece in self.tgt.ReadRangeSet(xf.tgt_ranges):
+              new_f.write(piece)
           tgt_size = xf.tgt_ranges.size() * self.tgt.blocksize
           print("%10d %10d (%6.2f%%) %7s %s %s" % (
               tgt_size, tgt_size, 100.0, xf.style,
               xf.tgt_name, str(xf.tgt_ranges)))
 
         elif xf.style == "diff":
-          src = self.src.ReadRangeSet(xf.src_ranges)
-          tgt = self.tgt.ReadRangeSet(xf.tgt_ranges)
-
           # We can't compare src and tgt directly because they may have
           # the same content but be broken up into blocks differently, eg:
           #
@@ -720,18 +1182,14 @@ class BlockImageDiff(object):
           #
           # We want those to compare equal, ideally without having to
           # actually concatenate the strings (these may be tens of
-          # megabytes).
-
-          src_sha1 = sha1()
-          for p in src:
-            src_sha1.update(p)
-          tgt_sha1 = sha1()
-          tgt_size = 0
-          for p in tgt:
-            tgt_sha1.update(p)
-            tgt_size += len(p)
-
-          if src_sha1.digest() == tgt_sha1.digest():
+          # megabytes).  Comparing the hashes also means we don't hold on
+          # to the data; it gets read again only if a patch is needed.
+
+          src_sha1 = self.HashBlocks(self.src, xf.src_ranges)
+          tgt_sha1 = self.HashBlocks(self.tgt, xf.tgt_ranges)
+          tgt_size = xf.tgt_ranges.size() * self.tgt.blocksize
+
+          if src_sha1 == tgt_sha1:
             # These are identical; we don't need to generate a patch,
             # just issue copy commands on the device.
             xf.style = "move"
@@ -757,49 +1215,72 @@ class BlockImageDiff(object):
             # zip file (plus possibly extra zeros in the last block),
             # which is what imgdiff needs to operate.  (imgdiff is
             # fine with extra zeros at the end of the file.)
-            imgdiff = (not self.disable_imgdiff and xf.intact and
-                       xf.tgt_name.split(".")[-1].lower()
-                       in ("apk", "jar", "zip"))
+            imgdiff = self.CanUseImgdiff(xf.tgt_name, xf.src_name,
+                                         xf.tgt_ranges, xf.src_ranges)
             xf.style = "imgdiff" if imgdiff else "bsdiff"
-            diff_q.append((tgt_size, src, tgt, xf, patch_num))
+            diff_queue.append((tgt_size, patch_num, xf, src_sha1, tgt_sha1))
             patch_num += 1
 
         else:
           assert False, "unknown style " + xf.style
+    finally:
+      if new_f is not None:
+        new_f.close()
 
-    if diff_q:
+    if diff_queue:
       if self.threads > 1:
         print("Computing patches (using %d threads)..." % (self.threads,))
       else:
         print("Computing patches...")
-      diff_q.sort()
+
+      # Hand out the largest transfers first to reduce the long-pole effect.
+      # The pool workers pull the next transfer from the shared queue as soon
+      # as they become idle, so the small ones backfill behind the large ones.
+      diff_queue.sort(key=lambda item: (-item[0], item[1]))
 
       patches = [None] * patch_num
 
-      # TODO: Rewrite with multiprocessing.ThreadPool?
-      lock = threading.Lock()
-      def diff_worker():
-        while True:
-          with lock:
-            if not diff_q:
-              return
-            tgt_size, src, tgt, xf, patchnum = diff_q.pop()
-          patch = compute_patch(src, tgt, imgdiff=(xf.style == "imgdiff"))
+      # The image objects may read through a single file object, so the
+      # reads must be serialized. (Memory-mapped images only hand out
+      # buffers here; the data gets paged in when the worker writes it out.)
+      # Only the transfers being diffed are held in memory: at most one per
+      # worker, regardless of the image size.
+      read_lock = threading.Lock()
+
+      # Patches computed by earlier runs (e.g. incrementals from another
+      # source build to the same target) are picked up from the patch cache.
+      patch_cache = common.OPTIONS.patch_cache
+
+      def diff_worker(item):
+        _, _, xf, src_sha1, tgt_sha1 = item
+        imgdiff = (xf.style == "imgdiff")
+        key = None
+        if patch_cache is not None:
+          key = patch_cache.Key(src_sha1, tgt_sha1, diff_command(imgdiff))
+          patch = patch_cache.Get(key)
+          if patch is not None:
+            return item, patch
+        with read_lock:
+          src = self.src.ReadRangeSet(xf.src_ranges)
+          tgt = self.tgt.ReadRangeSet(xf.tgt_ranges)
+        return item, compute_patch(src, tgt, imgdiff=imgdiff, key=key)
+
+      # The diffing itself happens in the bsdiff/imgdiff child processes; a
+      # thread per child is all it takes to keep them busy.
+      pool = multiprocessing.pool.ThreadPool(self.threads)
+      try:
+        for (tgt_size, patch_index, xf, _, _), patch in pool.imap_unordered(
+            diff_worker, diff_queue):
           size = len(patch)
-          with lock:
-            patches[patchnum] = (patch, xf)
-            print("%10d %10d (%6.2f%%) %7s %s %s %s" % (
-                size, tgt_size, size * 100.0 / tgt_size, xf.style,
-                xf.tgt_name if xf.tgt_name == xf.src_name else (
-                    xf.tgt_name + " (from " + xf.src_name + ")"),
-                str(xf.tgt_ranges), str(xf.src_ranges)))
-
-      threads = [threading.Thread(target=diff_worker)
-                 for _ in range(self.threads)]
-      for th in threads:
-        th.start()
-      while threads:
-        threads.pop().join()
+          patches[patch_index] = (patch, xf)
+          print("%10d %10d (%6.2f%%) %7s %s %s %s" % (
+              size, tgt_size, size * 100.0 / tgt_size, xf.style,
+              xf.tgt_name if xf.tgt_name == xf.src_name else (
+                  xf.tgt_name + " (from " + xf.src_name + ")"),
+              str(xf.tgt_ranges), str(xf.src_ranges)))
+      finally:
+        pool.terminate()
+        pool.join()
     else:
       patches = []
 
@@ -994,20 +1475,14 @@ class BlockImageDiff(object):
     s1 = deque()  # the left side of the sequence, built from left to right
     s2 = deque()  # the right side of the sequence, built from right to left
 
-    heap = []
-    for xf in self.transfers:
-      xf.heap_item = HeapItem(xf)
-      heap.append(xf.heap_item)
-    heapq.heapify(heap)
+    heap = IndexedHeap(self.transfers)
 
     sinks = set(u for u in G if not u.outgoing)
     sources = set(u for u in G if not u.incoming)
 
     def adjust_score(iu, delta):
       iu.score += delta
-      iu.heap_item.clear()
-      iu.heap_item = HeapItem(iu)
-      heapq.heappush(heap, iu.heap_item)
+      heap.Update(iu)
 
     while G:
       # Put all sinks at the end of the sequence.
@@ -1017,6 +1492,7 @@ class BlockImageDiff(object):
           if u not in G: continue
           s2.appendleft(u)
           del G[u]
+          heap.Remove(u)
           for iu in u.incoming:
             adjust_score(iu, -iu.outgoing.pop(u))
             if not iu.outgoing: new_sinks.add(iu)
@@ -1029,6 +1505,7 @@ class BlockImageDiff(object):
           if u not in G: continue
           s1.append(u)
           del G[u]
+          heap.Remove(u)
           for iu in u.outgoing:
             adjust_score(iu, +iu.incoming.pop(u))
             if not iu.incoming: new_sources.add(iu)
@@ -1040,12 +1517,7 @@ class BlockImageDiff(object):
       # maximizes the net difference in source blocks saved we get by
       # pretending it's a source rather than a sink.
 
-      while True:
-        u = heapq.heappop(heap)
-        if u and u.item in G:
-          u = u.item
-          break
-
+      u = heap.Pop()
       s1.append(u)
       del G[u]
       for iu in u.outgoing:
@@ -1065,41 +1537,52 @@ class BlockImageDiff(object):
       new_transfers.append(x)
       del x.incoming
       del x.outgoing
+      del x.heap_index
+      del x.heap_order
 
     self.transfers = new_transfers
 
   def GenerateDigraph(self):
     print("Generating digraph...")
 
-    # Each item of source_ranges will be:
-    #   - None, if that block is not used as a source,
-    #   - a transfer, if one transfer uses it as a source, or
-    #   - a set of transfers.
-    source_ranges = []
+    # Split the source blocks into segments that are read by the same set
+    # of transfers. seg_transfers[k] holds the transfers reading the blocks
+    # in [seg_starts[k], seg_starts[k+1]) (possibly none), so finding the
+    # transfers that read a range of blocks takes a bisect plus one step per
+    # segment, regardless of how many blocks the range spans.
+    events = []
     for b in self.transfers:
       for s, e in b.src_ranges:
-        if e > len(source_ranges):
-          source_ranges.extend([None] * (e-len(source_ranges)))
-        for i in range(s, e):
-          if source_ranges[i] is None:
-            source_ranges[i] = b
-          else:
-            if not isinstance(source_ranges[i], set):
-              source_ranges[i] = set([source_ranges[i]])
-            source_ranges[i].add(b)
+        events.append((s, 1, b.id, b))
+        events.append((e, -1, b.id, b))
+    events.sort(key=lambda ev: ev[:3])
+
+    seg_starts = []
+    seg_transfers = []
+    active = set()
+    i = 0
+    while i < len(events):
+      pos = events[i][0]
+      while i < len(events) and events[i][0] == pos:
+        _, delta, _, b = events[i]
+        if delta > 0:
+          active.add(b)
+        else:
+          active.remove(b)
+        i += 1
+      seg_starts.append(pos)
+      seg_transfers.append(tuple(active))
 
     for a in self.transfers:
       intersections = set()
       for s, e in a.tgt_ranges:
-        for i in range(s, e):
-          if i >= len(source_ranges): break
-          b = source_ranges[i]
-          if b is not None:
-            if isinstance(b, set):
-              intersections.update(b)
-            else:
-              intersections.add(b)
+        first = max(bisect.bisect_right(seg_starts, s) - 1, 0)
+        last = bisect.bisect_left(seg_starts, e)
+        for k in range(first, last):
+          intersections.update(seg_transfers[k])
 
+      # Visit them in a fixed order so that the output is repeatable.
+      intersections = sorted(intersections, key=lambda x: x.id)
       for b in intersections:
         if a is b: continue
 
@@ -1132,14 +1615,12 @@ class BlockImageDiff(object):
       since the split pieces don't align well. According to our experiments,
       1/8 of the cache size as the per-piece limit appears to be optimal.
       Compared to the fixed 1024-block limit, it reduces the overall package
-      size by 30% for volantis, and 20% for angler and bullhead."""
+      size by 30% for volantis, and 20% for angler and bullhead. With
+      OPTIONS.adaptive_split, the limit is picked per partition instead (see
+      ChooseSplitThreshold())."""
 
       # Possibly split large files into smaller chunks.
-      pieces = 0
-      cache_size = common.OPTIONS.cache_size
-      split_threshold = 0.125
-      max_blocks_per_transfer = int(cache_size * split_threshold /
-                                    self.tgt.blocksize)
+      max_blocks_per_transfer = self.MaxBlocksPerTransfer(self.split_threshold)
 
       # Change nothing for small files.
       if (tgt_ranges.size() <= max_blocks_per_transfer and
@@ -1147,27 +1628,11 @@ class BlockImageDiff(object):
         Transfer(tgt_name, src_name, tgt_ranges, src_ranges, style, by_id)
         return
 
-      while (tgt_ranges.size() > max_blocks_per_transfer and
-             src_ranges.size() > max_blocks_per_transfer):
+      for pieces, (tgt_piece, src_piece) in enumerate(self.SplitRanges(
+          tgt_ranges, src_ranges, max_blocks_per_transfer)):
         tgt_split_name = "%s-%d" % (tgt_name, pieces)
         src_split_name = "%s-%d" % (src_name, pieces)
-        tgt_first = tgt_ranges.first(max_blocks_per_transfer)
-        src_first = src_ranges.first(max_blocks_per_transfer)
-
-        Transfer(tgt_split_name, src_split_name, tgt_first, src_first, style,
-                 by_id)
-
-        tgt_ranges = tgt_ranges.subtract(tgt_first)
-        src_ranges = src_ranges.subtract(src_first)
-        pieces += 1
-
-      # Handle remaining blocks.
-      if tgt_ranges.size() or src_ranges.size():
-        # Must be both non-empty.
-        assert tgt_ranges.size() and src_ranges.size()
-        tgt_split_name = "%s-%d" % (tgt_name, pieces)
-        src_split_name = "%s-%d" % (src_name, pieces)
-        Transfer(tgt_split_name, src_split_name, tgt_ranges, src_ranges, style,
+        Transfer(tgt_split_name, src_split_name, tgt_piece, src_piece, style,
                  by_id)
 
     def AddTransfer(tgt_name, src_name, tgt_ranges, src_ranges, style, by_id,
@@ -1180,57 +1645,46 @@ class BlockImageDiff(object):
         Transfer(tgt_name, src_name, tgt_ranges, src_ranges, style, by_id)
         return
 
-      # Handle .odex files specially to analyze the block-wise difference. If
-      # most of the blocks are identical with only few changes (e.g. header),
-      # we will patch the changed blocks only. This avoids stashing unchanged
-      # blocks while patching. We limit the analysis to files without size
-      # changes only. This is to avoid sacrificing the OTA generation cost too
-      # much.
-      if (tgt_name.split(".")[-1].lower() == 'odex' and
-          tgt_ranges.size() == src_ranges.size()):
-
-        # 0.5 threshold can be further tuned. The tradeoff is: if only very
-        # few blocks remain identical, we lose the opportunity to use imgdiff
-        # that may have better compression ratio than bsdiff.
-        crop_threshold = 0.5
-
-        tgt_skipped = RangeSet()
-        src_skipped = RangeSet()
-        tgt_size = tgt_ranges.size()
-        tgt_changed = 0
-        for src_block, tgt_block in zip(src_ranges.next_item(),
-                                        tgt_ranges.next_item()):
-          src_rs = RangeSet(str(src_block))
-          tgt_rs = RangeSet(str(tgt_block))
-          if self.src.ReadRangeSet(src_rs) == self.tgt.ReadRangeSet(tgt_rs):
-            tgt_skipped = tgt_skipped.union(tgt_rs)
-            src_skipped = src_skipped.union(src_rs)
-          else:
-            tgt_changed += tgt_rs.size()
-
-          # Terminate early if no clear sign of benefits.
-          if tgt_changed > tgt_size * crop_threshold:
-            break
-
-        if tgt_changed < tgt_size * crop_threshold:
-          assert tgt_changed + tgt_skipped.size() == tgt_size
-          print('%10d %10d (%6.2f%%) %s' % (tgt_skipped.size(), tgt_size,
-                tgt_skipped.size() * 100.0 / tgt_size, tgt_name))
+      # Analyze the block-wise difference: blocks of the target file that are
+      # identical to some source block, in the source file (at the same
+      # offset or not) or anywhere else in the source image, are moved rather
+      # than diffed. If most of the blocks are identical with only few
+      # changes (e.g. header), we will patch the changed blocks only. This
+      # avoids stashing unchanged blocks while patching.
+      #
+      # 0.5 threshold can be further tuned. The tradeoff is: if only very few
+      # blocks remain identical, we lose the opportunity to use imgdiff that
+      # may have better compression ratio than bsdiff.
+      crop_threshold = 0.5
+
+      groups, tgt_skipped, src_skipped = self.FindIdenticalBlocks(
+          tgt_ranges, src_ranges)
+      tgt_size = tgt_ranges.size()
+      unchanged = groups == [(tgt_ranges, src_ranges)]
+      if not unchanged and tgt_skipped.size() > tgt_size * crop_threshold:
+        print('%10d %10d (%6.2f%%) %s' % (tgt_skipped.size(), tgt_size,
+              tgt_skipped.size() * 100.0 / tgt_size, tgt_name))
+        for i, (tgt_group, src_group) in enumerate(groups):
+          suffix = "-skipped" if len(groups) == 1 else "-skipped-%d" % (i,)
           AddSplitTransfers(
-              "%s-skipped" % (tgt_name,),
-              "%s-skipped" % (src_name,),
-              tgt_skipped, src_skipped, style, by_id)
+              tgt_name + suffix, src_name + suffix,
+              tgt_group, src_group, style, by_id)
+
+        # Intentionally change the file extension to avoid being imgdiff'd as
+        # the files are no longer in their original format.
+        tgt_name = "%s-cropped" % (tgt_name,)
+        src_name = "%s-cropped" % (src_name,)
+        tgt_ranges = tgt_ranges.subtract(tgt_skipped)
+        src_ranges = src_ranges.subtract(src_skipped)
 
-          # Intentionally change the file extension to avoid being imgdiff'd as
-          # the files are no longer in their original format.
-          tgt_name = "%s-cropped" % (tgt_name,)
-          src_name = "%s-cropped" % (src_name,)
-          tgt_ranges = tgt_ranges.subtract(tgt_skipped)
-          src_ranges = src_ranges.subtract(src_skipped)
+        # Possibly having no changed blocks.
+        if not tgt_ranges:
+          return
 
-          # Possibly having no changed blocks.
-          if not tgt_ranges:
-            return
+        # Or nothing left in the source file to diff the changes against.
+        if not src_ranges:
+          Transfer(tgt_name, None, tgt_ranges, src_ranges, "new", by_id)
+          return
 
       # Add the transfer(s).
       AddSplitTransfers(
@@ -1238,7 +1692,24 @@ class BlockImageDiff(object):
 
     print("Finding transfers...")
 
+    if common.OPTIONS.adaptive_split and self.version >= 3:
+      self.ChooseSplitThreshold()
+
+    # Source files that none of the target files match by name are indexed
+    # by content, to find a source for the remaining targets, if there are
+    # any.
+    unmatched = [fn for fn in self.tgt.file_map
+                 if not fn.startswith("__") and self.FindSource(fn) is None]
+    similarity_index = None
+    if unmatched:
+      claimed = set(self.FindSource(fn) for fn in self.tgt.file_map)
+      unclaimed = dict((fn, ranges) for fn, ranges in self.src.file_map.items()
+                       if not fn.startswith("__") and fn not in claimed)
+      if unclaimed:
+        similarity_index = SimilarityIndex(self.src, unclaimed)
+
     empty = RangeSet()
+    similar = 0
     for tgt_fn, tgt_ranges in self.tgt.file_map.items():
       if tgt_fn == "__ZERO":
         # the special "__ZERO" domain is all the blocks not contained
@@ -1255,33 +1726,299 @@ class BlockImageDiff(object):
         AddTransfer(tgt_fn, None, tgt_ranges, empty, "new", self.transfers)
         continue
 
-      elif tgt_fn in self.src.file_map:
-        # Look for an exact pathname match in the source.
-        AddTransfer(tgt_fn, tgt_fn, tgt_ranges, self.src.file_map[tgt_fn],
-                    "diff", self.transfers, self.version >= 3)
-        continue
-
-      b = os.path.basename(tgt_fn)
-      if b in self.src_basenames:
-        # Look for an exact basename match in the source.
-        src_fn = self.src_basenames[b]
-        AddTransfer(tgt_fn, src_fn, tgt_ranges, self.src.file_map[src_fn],
-                    "diff", self.transfers, self.version >= 3)
-        continue
-
-      b = re.sub("[0-9]+", "#", b)
-      if b in self.src_numpatterns:
-        # Look for a 'number pattern' match (a basename match after
-        # all runs of digits are replaced by "#").  (This is useful
-        # for .so files that contain version numbers in the filename
-        # that get bumped.)
-        src_fn = self.src_numpatterns[b]
+      src_fn = self.FindSource(tgt_fn)
+      if (src_fn is None and similarity_index is not None and
+          not tgt_fn.startswith("__")):
+        # Look for a source file with similar contents.
+        src_fn = similarity_index.FindMostSimilar(self.tgt, tgt_ranges)
+        if src_fn is not None:
+          similar += 1
+      if src_fn is not None:
         AddTransfer(tgt_fn, src_fn, tgt_ranges, self.src.file_map[src_fn],
                     "diff", self.transfers, self.version >= 3)
         continue
 
       AddTransfer(tgt_fn, None, tgt_ranges, empty, "new", self.transfers)
 
+    if similarity_index is not None:
+      print("  %d of %d unmatched target files diffed against a similar "
+            "source file." % (similar, len(unmatched)))
+
+  def MaxBlocksPerTransfer(self, split_threshold):
+    return int(common.OPTIONS.cache_size * split_threshold /
+               self.tgt.blocksize)
+
+  @staticmethod
+  def SplitRanges(tgt_ranges, src_ranges, max_blocks_per_transfer):
+    """Return the (tgt, src) pieces AddSplitTransfers() splits a large file
+    into, each of them at most 'max_blocks_per_transfer' blocks (except for
+    the last piece of the longer side)."""
+    pieces = []
+    while (tgt_ranges.size() > max_blocks_per_transfer and
+           src_ranges.size() > max_blocks_per_transfer):
+      tgt_first = tgt_ranges.first(max_blocks_per_transfer)
+      src_first = src_ranges.first(max_blocks_per_transfer)
+      pieces.append((tgt_first, src_first))
+      tgt_ranges = tgt_ranges.subtract(tgt_first)
+      src_ranges = src_ranges.subtract(src_first)
+
+    # Handle remaining blocks.
+    if tgt_ranges.size() or src_ranges.size():
+      # Must be both non-empty.
+      assert tgt_ranges.size() and src_ranges.size()
+      pieces.append((tgt_ranges, src_ranges))
+    return pieces
+
+  # The split thresholds (as fractions of the cache size) tried by
+  # ChooseSplitThreshold(), and the number of files it tries them on.
+  SPLIT_THRESHOLDS = (0.0625, 0.125, 0.25, 0.5)
+  SPLIT_SAMPLE_FILES = 4
+
+  def ChooseSplitThreshold(self):
+    """Pick the split threshold giving the smallest patches for this
+    partition.
+
+    Each candidate in SPLIT_THRESHOLDS whose pieces fit in the stash is
+    tried on the largest files that it would split, by diffing their pieces.
+    The results are memoized in the patch cache (OPTIONS.patch_cache, if
+    any) per file contents, i.e. per (file, source build), along with the
+    patches themselves, which ComputePatches() then picks up for the chosen
+    threshold."""
+
+    print("Choosing split threshold...")
+
+    max_stash = self.MaxAllowedStashBlocks()
+    candidates = [t for t in self.SPLIT_THRESHOLDS
+                  if self.MaxBlocksPerTransfer(t) <= max_stash]
+    if not candidates:
+      print("  No candidate fits in the stash; keeping %g." % (
+          self.split_threshold,))
+      return
+
+    # Only files larger than the smallest pieces get split differently.
+    smallest = self.MaxBlocksPerTransfer(min(candidates))
+    samples = []
+    for tgt_fn, tgt_ranges in self.tgt.file_map.items():
+      if tgt_fn.startswith("__"):
+        continue
+      src_fn = self.FindSource(tgt_fn)
+      if src_fn is None:
+        continue
+      src_ranges = self.src.file_map[src_fn]
+      if tgt_ranges.size() > smallest and src_ranges.size() > smallest:
+        samples.append((tgt_fn, tgt_ranges, src_fn, src_ranges))
+    samples.sort(key=lambda x: (-x[1].size(), x[0]))
+    samples = samples[:self.SPLIT_SAMPLE_FILES]
+    if not samples:
+      print("  No files large enough to split; keeping %g." % (
+          self.split_threshold,))
+      return
+
+    read_lock = threading.Lock()
+    patch_cache = common.OPTIONS.patch_cache
+
+    def Measure(task):
+      """Return the total patch size and diff time of the pieces of a sample
+      file for one of the thresholds."""
+      split_threshold, (tgt_fn, tgt_ranges, src_fn, src_ranges) = task
+      max_blocks = self.MaxBlocksPerTransfer(split_threshold)
+      if patch_cache is not None:
+        # Hashing reads the images too, so it also needs the lock.
+        with read_lock:
+          src_sha1 = self.HashBlocks(self.src, src_ranges)
+          tgt_sha1 = self.HashBlocks(self.tgt, tgt_ranges)
+        key = patch_cache.Key(src_sha1, tgt_sha1, ["split", str(max_blocks)])
+        result = patch_cache.Get(key)
+        if result is not None:
+          size, seconds = result.split()
+          return task, int(size), float(seconds)
+
+      if (tgt_ranges.size() <= max_blocks and
+          src_ranges.size() <= max_blocks):
+        # Not split; may use imgdiff (see ComputePatches()).
+        pieces = [(tgt_ranges, src_ranges)]
+        imgdiff = self.CanUseImgdiff(tgt_fn, src_fn, tgt_ranges, src_ranges)
+      else:
+        pieces = self.SplitRanges(tgt_ranges, src_ranges, max_blocks)
+        imgdiff = False
+
+      size = 0
+      seconds = 0.0
+      for tgt_piece, src_piece in pieces:
+        with read_lock:
+          src_sha1 = self.HashBlocks(self.src, src_piece)
+          tgt_sha1 = self.HashBlocks(self.tgt, tgt_piece)
+        if src_sha1 == tgt_sha1:
+          continue
+        with read_lock:
+          src = self.src.ReadRangeSet(src_piece)
+          tgt = self.tgt.ReadRangeSet(tgt_piece)
+        start = time.time()
+        patch = compute_patch(src, tgt, imgdiff=imgdiff)
+        seconds += time.time() - start
+        size += len(patch)
+        if patch_cache is not None:
+          patch_cache.Put(patch_cache.Key(src_sha1, tgt_sha1,
+                                          diff_command(imgdiff)), patch)
+
+      if patch_cache is not None:
+        patch_cache.Put(key, "%d %f" % (size, seconds))
+      return task, size, seconds
+
+    tasks = [(t, sample) for t in candidates for sample in samples]
+    results = dict((t, [0, 0.0]) for t in candidates)
+    pool = multiprocessing.pool.ThreadPool(self.threads)
+    try:
+      for (t, _), size, seconds in pool.imap_unordered(Measure, tasks):
+        results[t][0] += size
+        results[t][1] += seconds
+    finally:
+      pool.terminate()
+      pool.join()
+
+    best = min(candidates, key=lambda t: (results[t][0], results[t][1], t))
+    print("  %d largest files; stash limit %d blocks" % (len(samples),
+                                                         max_stash))
+    print("  %10s %12s %12s %10s" % ("threshold", "piece blocks",
+                                     "patch bytes", "diff time"))
+    for t in candidates:
+      print("%s %10g %12d %12d %9.1fs" % (
+          "*" if t == best else " ", t, self.MaxBlocksPerTransfer(t),
+          results[t][0], results[t][1]))
+    self.split_threshold = best
+
+  def CanUseImgdiff(self, tgt_name, src_name, tgt_ranges, src_ranges):
+    """Return whether the target file may be diffed with imgdiff, which
+    needs both files to be zips. The source file may be of another type
+    than the target when it was picked by contents (see SimilarityIndex)."""
+    return (not self.disable_imgdiff and
+            getattr(tgt_ranges, "monotonic", False) and
+            getattr(src_ranges, "monotonic", False) and
+            is_zip_name(tgt_name) and is_zip_name(src_name))
+
+  def FindSource(self, tgt_fn):
+    """Return the source file to diff the target file 'tgt_fn' against,
+    going by their names, or None if there's no match."""
+
+    if tgt_fn in self.src.file_map:
+      # Look for an exact pathname match in the source.
+      return tgt_fn
+
+    b = os.path.basename(tgt_fn)
+    if b in self.src_basenames:
+      # Look for an exact basename match in the source.
+      return self.src_basenames[b]
+
+    b = re.sub("[0-9]+", "#", b)
+    if b in self.src_numpatterns:
+      # Look for a 'number pattern' match (a basename match after
+      # all runs of digits are replaced by "#").  (This is useful
+      # for .so files that contain version numbers in the filename
+      # that get bumped.)
+      return self.src_numpatterns[b]
+
+    return None
+
+  def BlockHashes(self, image, ranges):
+    """Return the SHA-1 digests of the blocks in 'ranges' of 'image', in
+    order."""
+    # Images with a per-block hash index (e.g. SparseImage) only read the
+    # data once.
+    block_sha1 = getattr(image, "BlockSha1", None)
+    if block_sha1 is not None:
+      return [block_sha1(i) for s, e in ranges for i in range(s, e)]
+    data = "".join(str(d) for d in image.ReadRangeSet(ranges))
+    blocksize = image.blocksize
+    return [sha1(data[i:i+blocksize]).digest()
+            for i in range(0, len(data), blocksize)]
+
+  def SourceBlockIndex(self):
+    """Return a dict mapping the SHA-1 digest of every nonzero block in the
+    source files to the first such block. Built on first use.
+
+    The "__COPY" blocks and the clobbered blocks (e.g. the ext4 superblock)
+    are left out: their contents on the device differ from the source
+    image, so they can't be moved from."""
+    if self.src_block_index is None:
+      zero_sha1 = sha1("\0" * self.src.blocksize).digest()
+      clobbered = getattr(self.src, "clobbered_blocks", None) or RangeSet()
+      index = {}
+      for fn in sorted(self.src.file_map):
+        if fn in ("__ZERO", "__COPY"):
+          continue
+        ranges = self.src.file_map[fn].subtract(clobbered)
+        blocks = (i for s, e in ranges for i in range(s, e))
+        for i, h in itertools.izip(blocks, self.BlockHashes(self.src, ranges)):
+          if h != zero_sha1:
+            index.setdefault(h, i)
+      self.src_block_index = index
+    return self.src_block_index
+
+  def FindIdenticalBlocks(self, tgt_ranges, src_ranges):
+    """Find the blocks of 'tgt_ranges' identical to a source block.
+
+    We look for each block at the same offset in 'src_ranges' first, then
+    (unless it's a zero block) anywhere in 'src_ranges', then anywhere in
+    the source files. Returns
+    (groups, tgt_skipped, src_skipped): 'groups' lists the (tgt, src)
+    RangeSet pairs of identical blocks, each mapping the target blocks to
+    the source blocks in increasing order so that it can be a single move;
+    'tgt_skipped' is the union of the target blocks found, and
+    'src_skipped' the ones of 'src_ranges' they're taken from."""
+
+    zero_sha1 = sha1("\0" * self.tgt.blocksize).digest()
+    tgt_hashes = self.BlockHashes(self.tgt, tgt_ranges)
+    src_hashes = self.BlockHashes(self.src, src_ranges)
+    src_blocks = [i for s, e in src_ranges for i in range(s, e)]
+    # Clobbered source blocks don't hold the image contents on the device.
+    clobbered = getattr(self.src, "clobbered_blocks", None) or RangeSet()
+    clobbered = set(i for s, e in clobbered for i in range(s, e))
+    own_index = {}
+    for i, h in itertools.izip(src_blocks, src_hashes):
+      if i not in clobbered:
+        own_index.setdefault(h, i)
+
+    pairs = []
+    tgt_blocks = (i for s, e in tgt_ranges for i in range(s, e))
+    for n, (t, h) in enumerate(itertools.izip(tgt_blocks, tgt_hashes)):
+      if (n < len(src_hashes) and src_hashes[n] == h and
+          src_blocks[n] not in clobbered):
+        pairs.append((t, src_blocks[n]))
+        continue
+      # Zero blocks are cheap to diff, and would match all over the place.
+      if h == zero_sha1:
+        continue
+      s = own_index.get(h)
+      if s is None:
+        s = self.SourceBlockIndex().get(h)
+      if s is not None:
+        pairs.append((t, s))
+
+    def ToRangeSet(blocks):
+      data = []
+      for i in blocks:
+        if data and data[-1] == i:
+          data[-1] = i + 1
+        else:
+          data.extend((i, i + 1))
+      return RangeSet(data=data)
+
+    # Split the pairs (in increasing target order) wherever the source blocks
+    # stop increasing.
+    groups = []
+    start = 0
+    for n in range(1, len(pairs) + 1):
+      if n == len(pairs) or pairs[n][1] <= pairs[n - 1][1]:
+        group = pairs[start:n]
+        groups.append((ToRangeSet(t for t, _ in group),
+                       ToRangeSet(s for _, s in group)))
+        start = n
+
+    tgt_skipped = RangeSet.union_all(t for t, _ in groups)
+    src_skipped = RangeSet.union_all(
+        src for _, src in groups).intersect(src_ranges)
+    return groups, tgt_skipped, src_skipped
+
   def AbbreviateSourceNames(self):
     for k in self.src.file_map.keys():
       b = os.path.basename(k)
@@ -1295,8 +2032,8 @@ class BlockImageDiff(object):
     'total' RangeSet (ie, they are nonintersecting and their union
     equals 'total')."""
 
-    so_far = RangeSet()
-    for i in seq:
-      assert not so_far.overlaps(i)
-      so_far = so_far.union(i)
+    seq = list(seq)
+    so_far = RangeSet.union_all(seq)
+    # The RangeSets are nonintersecting iff no block got counted twice.
+    assert sum(i.size() for i in seq) == so_far.size()
     assert so_far == total
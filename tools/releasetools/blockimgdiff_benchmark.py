@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2016 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# Times BlockImageDiff.FindVertexSequence() on synthetic dependency graphs,
+# and reports the number of source blocks lost to the edges it leaves
+# pointing backwards. Pass --compare with another blockimgdiff.py (e.g. one
+# checked out from an older revision) to run it side by side.
+#
+
+from __future__ import print_function
+
+import argparse
+import imp
+import os
+import random
+import sys
+import time
+
+import common
+import blockimgdiff
+from rangelib import RangeSet
+
+
+def SyntheticDigraph(num_vertices, degree, seed=0):
+  """Return the edges (a, b, weight) of a random digraph on 'num_vertices'
+  vertices, where each vertex has about 'degree' outgoing edges."""
+  rnd = random.Random(seed)
+  edges = {}
+  for a in range(num_vertices):
+    for _ in range(degree):
+      b = rnd.randrange(num_vertices)
+      if a != b:
+        edges[(a, b)] = rnd.randint(1, 64)
+  return sorted((a, b, w) for (a, b), w in edges.items())
+
+
+def RunBenchmark(module, num_vertices, edges, rounds):
+  best = None
+  for _ in range(rounds):
+    by_id = []
+    for i in range(num_vertices):
+      module.Transfer("t%d" % (i,), "s%d" % (i,), RangeSet(), RangeSet(),
+                      "diff", by_id)
+    for a, b, w in edges:
+      by_id[a].goes_before[by_id[b]] = w
+      by_id[b].goes_after[by_id[a]] = w
+
+    b = module.BlockImageDiff(module.DataImage("\0" * 4096))
+    b.transfers = by_id
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+      start = time.time()
+      b.FindVertexSequence()
+      elapsed = time.time() - start
+    finally:
+      sys.stdout = stdout
+    if best is None or elapsed < best:
+      best = elapsed
+
+  lost = sum(w for a, b, w in edges if by_id[a].order > by_id[b].order)
+  return best, lost
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--vertices', type=int, default=20000,
+      help='Number of transfers in the generated digraph')
+  parser.add_argument('--degree', type=int, default=20,
+      help='Average number of outgoing edges of each transfer')
+  parser.add_argument('--compare',
+      help='Another blockimgdiff.py to time against this one')
+  parser.add_argument('--rounds', type=int, default=3,
+      help='Time each benchmark this many times, keeping the fastest')
+  args = parser.parse_args()
+
+  edges = SyntheticDigraph(args.vertices, args.degree)
+  print("%d vertices, %d edges" % (args.vertices, len(edges)))
+
+  modules = [("current", blockimgdiff)]
+  if args.compare:
+    modules.append(("other", imp.load_source("blockimgdiff_other",
+                                             args.compare)))
+  for name, module in modules:
+    elapsed, lost = RunBenchmark(module, args.vertices, edges, args.rounds)
+    print("%-8s %8.3fs  %d blocks lost to backward edges" % (
+        name, elapsed, lost))
+
+if __name__ == '__main__':
+  main()
@@ -12,24 +12,34 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import bisect
 import copy
 import errno
+import fnmatch
 import getopt
 import getpass
 import imp
+import mmap
+import multiprocessing
 import os
 import platform
+import Queue
 import re
 import shlex
 import shutil
+import stat
+import struct
 import subprocess
 import sys
 import tempfile
 import threading
 import time
+import traceback
 import zipfile
+import zlib
 
 import blockimgdiff
+import rangelib
 
 from hashlib import sha1 as sha1
 
@@ -65,6 +75,28 @@ class Options(object):
     # Stash size cannot exceed cache_size * threshold.
     self.cache_size = None
     self.stash_threshold = 0.8
+    # The number of transfer orders to try to fit the stash into /cache
+    # before packing some of them as new blocks instead (none by default),
+    # and an optional cap in seconds on that search (which makes the output
+    # depend on the machine's speed when it's hit).
+    self.stash_reorder_rounds = 0
+    self.stash_reorder_time = None
+    # Pick the size of the pieces large files get split into per partition,
+    # rather than using a fixed fraction of the cache size.
+    self.adaptive_split = False
+    # The limits for computing the patches of files (see
+    # ComputeDifferences()): seconds per diff, and bytes of the files being
+    # diffed at a time (no limit if None).
+    self.diff_timeout = 300
+    self.diff_max_bytes = None
+    # A patch_cache.PatchCache to reuse patches across runs, if any.
+    self.patch_cache = None
+    # A proxy to the diff_pool.DiffPool that computes the block diffs shared
+    # by several processes, if any.
+    self.diff_pool = None
+    # A directory to keep the unzipped inputs and the computed block
+    # differences in, keyed by their inputs, so that a rerun skips them.
+    self.work_dir = None
 
 
 OPTIONS = Options()
@@ -131,11 +163,17 @@ def CloseInheritedPipes():
 
 def LoadInfoDict(input_file, input_dir=None):
   """Read and parse the META/misc_info.txt key/value pairs from the
-  input target files and return a dict."""
+  input target files and return a dict.
+
+  'input_file' is a zipfile.ZipFile, a directory or a TargetFiles. The
+  properties that refer to files are redirected into 'input_dir' (a
+  directory or a TargetFiles, which unzips only those files), if given."""
 
   def read_helper(fn):
     if isinstance(input_file, zipfile.ZipFile):
       return input_file.read(fn)
+    elif isinstance(input_file, TargetFiles):
+      return input_file.Read(fn)
     else:
       path = os.path.join(input_file, *fn.split("/"))
       try:
@@ -186,49 +224,45 @@ def LoadInfoDict(input_file, input_dir=None):
   # are doing repacking. Redirect those properties to the actual files in the
   # unzipped directory.
   if input_dir is not None:
+    if not isinstance(input_dir, TargetFiles):
+      input_dir = TargetFiles(input_dir)
+
     # We carry a copy of file_contexts.bin under META/. If not available,
     # search BOOT/RAMDISK/. Note that sometimes we may need a different file
     # to build images than the one running on device, such as when enabling
     # system_root_image. In that case, we must have the one for image
     # generation copied to META/.
     fc_basename = os.path.basename(d.get("selinux_fc", "file_contexts"))
-    fc_config = os.path.join(input_dir, "META", fc_basename)
+    fc_config = "META/" + fc_basename
     if d.get("system_root_image") == "true":
-      assert os.path.exists(fc_config)
-    if not os.path.exists(fc_config):
-      fc_config = os.path.join(input_dir, "BOOT", "RAMDISK", fc_basename)
-      if not os.path.exists(fc_config):
+      assert input_dir.Exists(fc_config)
+    if not input_dir.Exists(fc_config):
+      fc_config = "BOOT/RAMDISK/" + fc_basename
+      if not input_dir.Exists(fc_config):
         fc_config = None
 
     if fc_config:
-      d["selinux_fc"] = fc_config
+      d["selinux_fc"] = input_dir.GetPath(fc_config)
 
     # Similarly we need to redirect "ramdisk_dir" and "ramdisk_fs_config".
     if d.get("system_root_image") == "true":
-      d["ramdisk_dir"] = os.path.join(input_dir, "ROOT")
+      d["ramdisk_dir"] = os.path.join(input_dir.Extract("ROOT/*"), "ROOT")
       d["ramdisk_fs_config"] = os.path.join(
-          input_dir, "META", "root_filesystem_config.txt")
+          input_dir.Extract("META/root_filesystem_config.txt"), "META",
+          "root_filesystem_config.txt")
 
     # Redirect {system,vendor}_base_fs_file.
-    if "system_base_fs_file" in d:
-      basename = os.path.basename(d["system_base_fs_file"])
-      system_base_fs_file = os.path.join(input_dir, "META", basename)
-      if os.path.exists(system_base_fs_file):
-        d["system_base_fs_file"] = system_base_fs_file
-      else:
-        print "Warning: failed to find system base fs file: %s" % (
-            system_base_fs_file,)
-        del d["system_base_fs_file"]
-
-    if "vendor_base_fs_file" in d:
-      basename = os.path.basename(d["vendor_base_fs_file"])
-      vendor_base_fs_file = os.path.join(input_dir, "META", basename)
-      if os.path.exists(vendor_base_fs_file):
-        d["vendor_base_fs_file"] = vendor_base_fs_file
+    for partition in ("system", "vendor"):
+      key = partition + "_base_fs_file"
+      if key not in d:
+        continue
+      base_fs_file = "META/" + os.path.basename(d[key])
+      if input_dir.Exists(base_fs_file):
+        d[key] = input_dir.GetPath(base_fs_file)
       else:
-        print "Warning: failed to find vendor base fs file: %s" % (
-            vendor_base_fs_file,)
-        del d["vendor_base_fs_file"]
+        print "Warning: failed to find %s base fs file: %s" % (
+            partition, os.path.join(input_dir.path, *base_fs_file.split("/")))
+        del d[key]
 
   try:
     data = read_helper("META/imagesizes.txt")
@@ -535,17 +569,19 @@ def GetBootableImage(name, prebuilt_name, unpack_dir, tree_subdir,
 
   Look for it in 'unpack_dir'/BOOTABLE_IMAGES under the name 'prebuilt_name',
   otherwise look for it under 'unpack_dir'/IMAGES, otherwise construct it from
-  the source files in 'unpack_dir'/'tree_subdir'."""
+  the source files in 'unpack_dir'/'tree_subdir'. 'unpack_dir' may also be a
+  TargetFiles, in which case only the source files get unzipped, if needed."""
 
-  prebuilt_path = os.path.join(unpack_dir, "BOOTABLE_IMAGES", prebuilt_name)
-  if os.path.exists(prebuilt_path):
-    print "using prebuilt %s from BOOTABLE_IMAGES..." % (prebuilt_name,)
-    return File.FromLocalFile(name, prebuilt_path)
+  if isinstance(unpack_dir, TargetFiles):
+    target_files = unpack_dir
+  else:
+    target_files = TargetFiles(unpack_dir)
 
-  prebuilt_path = os.path.join(unpack_dir, "IMAGES", prebuilt_name)
-  if os.path.exists(prebuilt_path):
-    print "using prebuilt %s from IMAGES..." % (prebuilt_name,)
-    return File.FromLocalFile(name, prebuilt_path)
+  for subdir in ("BOOTABLE_IMAGES", "IMAGES"):
+    prebuilt_name_in_dir = subdir + "/" + prebuilt_name
+    if target_files.Exists(prebuilt_name_in_dir):
+      print "using prebuilt %s from %s..." % (prebuilt_name, subdir)
+      return File(name, target_files.Read(prebuilt_name_in_dir))
 
   print "building image from target_files %s..." % (tree_subdir,)
 
@@ -560,6 +596,7 @@ def GetBootableImage(name, prebuilt_name, unpack_dir, tree_subdir,
                  info_dict.get("recovery_as_boot") == "true")
 
   fs_config = "META/" + tree_subdir.lower() + "_filesystem_config.txt"
+  unpack_dir = target_files.Extract([tree_subdir + "/*", fs_config])
   data = _BuildBootableImage(os.path.join(unpack_dir, tree_subdir),
                              os.path.join(unpack_dir, fs_config),
                              info_dict, has_ramdisk)
@@ -568,38 +605,346 @@ def GetBootableImage(name, prebuilt_name, unpack_dir, tree_subdir,
   return None
 
 
+def FileSha1(filename):
+  """Return the SHA-1 of the contents of 'filename'."""
+  ctx = sha1()
+  with open(filename, "rb") as f:
+    for data in iter(lambda: f.read(1 << 20), ""):
+      ctx.update(data)
+  return ctx.hexdigest()
+
+
+def UnzipToDir(filename, dirname, patterns=None):
+  """Unzip the members of the archive 'filename' that match any of the
+  shell-style 'patterns' (a string or a list, all members if None) into
+  'dirname', using OPTIONS.worker_threads threads. A pattern that matches
+  no member gets a warning.
+
+  Members already present in 'dirname' with the same size and CRC are
+  skipped. Each member is written to a temp file next to 'dirname' and
+  renamed into place, so an interrupted run never leaves a partial member
+  behind.
+
+  Returns (bytes extracted, bytes skipped).
+  """
+  if isinstance(patterns, basestring):
+    patterns = [patterns]
+
+  try:
+    with zipfile.ZipFile(filename, "r") as input_zip:
+      infos = input_zip.infolist()
+  except (IOError, zipfile.BadZipfile) as e:
+    raise ExternalError("failed to unzip input target-files \"%s\": %s" %
+                        (filename, e))
+  if patterns is not None:
+    matched = set()
+    selected = []
+    for i in infos:
+      hits = [p for p in patterns if fnmatch.fnmatchcase(i.filename, p)]
+      if hits:
+        matched.update(hits)
+        selected.append(i)
+    infos = selected
+    for p in patterns:
+      if p not in matched:
+        print "Warning: no member of %s matches %s" % (filename, p)
+
+  if not os.path.isdir(dirname):
+    os.makedirs(dirname)
+
+  # Do the largest members first, to try and reduce the long-pole effect.
+  infos.sort(key=lambda i: i.file_size, reverse=True)
+
+  # The files unzip(1) creates for members without permissions get the
+  # default ones.
+  umask = os.umask(0)
+  os.umask(umask)
+  temp_dir = os.path.dirname(os.path.abspath(dirname))
+
+  lock = threading.Lock()
+  info_iter = iter(infos)   # accessed under lock
+  totals = [0, 0]           # extracted, skipped; accessed under lock
+  errors = []
+
+  def worker():
+    # zipfile.ZipFile objects can't be read from by several threads.
+    try:
+      with zipfile.ZipFile(filename, "r") as input_zip:
+        while True:
+          with lock:
+            info = next(info_iter, None)
+            if info is None or errors:
+              return
+          extracted = _UnzipMember(input_zip, info, dirname, temp_dir,
+                                   umask)
+          with lock:
+            totals[0 if extracted else 1] += info.file_size
+    except Exception as e:
+      with lock:
+        errors.append(e)
+
+  threads = [threading.Thread(target=worker)
+             for _ in range(OPTIONS.worker_threads or
+                            multiprocessing.cpu_count())]
+  for th in threads:
+    th.start()
+  while threads:
+    threads.pop().join()
+
+  if errors:
+    raise ExternalError("failed to unzip input target-files \"%s\": %s" %
+                        (filename, errors[0]))
+  return totals[0], totals[1]
+
+
+def _UnzipMember(input_zip, info, dirname, temp_dir, umask):
+  # Extract 'info' from 'input_zip' into 'dirname' the way unzip(1) does,
+  # including symlinks, permissions and timestamps, going through a temp
+  # file in 'temp_dir'. Returns False if it was already there.
+  name = os.path.normpath(info.filename)
+  if name.startswith(("/", "../")) or name == "..":
+    raise ValueError("unsafe member name %s" % (info.filename,))
+  path = os.path.join(dirname, name)
+  mode = info.external_attr >> 16
+
+  if info.filename.endswith("/"):
+    if not os.path.isdir(path):
+      try:
+        os.makedirs(path)
+      except OSError as e:
+        if e.errno != errno.EEXIST:
+          raise
+    return False
+
+  if stat.S_ISLNK(mode):
+    target = input_zip.read(info)
+    if os.path.islink(path) and os.readlink(path) == target:
+      return False
+  elif _ZipMemberPresent(info, path):
+    return False
+
+  parent = os.path.dirname(path)
+  if not os.path.isdir(parent):
+    try:
+      os.makedirs(parent)
+    except OSError as e:
+      if e.errno != errno.EEXIST:
+        raise
+
+  fd, temp_path = tempfile.mkstemp(prefix=".unzip-", dir=temp_dir)
+  try:
+    if stat.S_ISLNK(mode):
+      os.close(fd)
+      os.remove(temp_path)
+      os.symlink(target, temp_path)
+    else:
+      with os.fdopen(fd, "wb") as f, input_zip.open(info) as member:
+        shutil.copyfileobj(member, f, 1 << 20)
+      os.chmod(temp_path, mode & 0o7777 or 0o666 & ~umask)
+      mtime = time.mktime(info.date_time + (0, 0, -1))
+      os.utime(temp_path, (mtime, mtime))
+    os.rename(temp_path, path)
+  except:
+    if os.path.lexists(temp_path):
+      os.remove(temp_path)
+    raise
+  return True
+
+
+def _ZipMemberPresent(info, path):
+  # Whether the regular file 'path' has the size and CRC of the member 'info'.
+  try:
+    st = os.lstat(path)
+  except OSError:
+    return False
+  if not stat.S_ISREG(st.st_mode) or st.st_size != info.file_size:
+    return False
+  crc = 0
+  with open(path, "rb") as f:
+    for data in iter(lambda: f.read(1 << 20), ""):
+      crc = zlib.crc32(data, crc)
+  return crc & 0xffffffff == info.CRC
+
+
 def UnzipTemp(filename, pattern=None):
   """Unzip the given archive into a temporary directory and return the name.
 
   If filename is of the form "foo.zip+bar.zip", unzip foo.zip into a
-  temp dir, then unzip bar.zip into that_dir/BOOTABLE_IMAGES.
+  temp dir, then unzip bar.zip into that_dir/BOOTABLE_IMAGES. Only the
+  members of foo.zip matching 'pattern' (a shell-style pattern, or a list
+  of them) are unzipped if it's given; bar.zip is unzipped whole.
+
+  With OPTIONS.work_dir, the archive is unzipped there instead, keyed by
+  its contents, and kept for later runs, which only unzip the members that
+  are missing or don't match.
 
   Returns (tempdir, zipobj) where zipobj is a zipfile.ZipFile (of the
   main file), open for reading.
   """
 
+  m = re.match(r"^(.*[.]zip)\+(.*[.]zip)$", filename, re.IGNORECASE)
+  filenames = [m.group(1), m.group(2)] if m else [filename]
+
+  tmp = _UnzipDir(filenames)
+  extracted, skipped = UnzipToDir(filenames[0], tmp, pattern)
+  if m:
+    sizes = UnzipToDir(filenames[1], os.path.join(tmp, "BOOTABLE_IMAGES"))
+    extracted += sizes[0]
+    skipped += sizes[1]
+  print "unzipped %s: %d bytes extracted, %d bytes skipped" % (
+      filename, extracted, skipped)
+
+  return tmp, zipfile.ZipFile(filenames[0], "r")
+
+
+def _UnzipDir(filenames):
+  # Return the directory to unzip the archives 'filenames' into: one in
+  # OPTIONS.work_dir keyed by their contents if it's set, a temp dir
+  # otherwise.
+  if OPTIONS.work_dir is not None:
+    ctx = sha1()
+    for fn in filenames:
+      ctx.update(FileSha1(fn))
+    return os.path.join(OPTIONS.work_dir, "targetfiles-" + ctx.hexdigest())
   tmp = tempfile.mkdtemp(prefix="targetfiles-")
   OPTIONS.tempfiles.append(tmp)
+  return tmp
 
-  def unzip_to_dir(filename, dirname):
-    cmd = ["unzip", "-o", "-q", filename, "-d", dirname]
-    if pattern is not None:
-      cmd.append(pattern)
-    p = Run(cmd, stdout=subprocess.PIPE)
-    p.communicate()
-    if p.returncode != 0:
-      raise ExternalError("failed to unzip input target-files \"%s\"" %
-                          (filename,))
 
-  m = re.match(r"^(.*[.]zip)\+(.*[.]zip)$", filename, re.IGNORECASE)
-  if m:
-    unzip_to_dir(m.group(1), tmp)
-    unzip_to_dir(m.group(2), os.path.join(tmp, "BOOTABLE_IMAGES"))
-    filename = m.group(1)
-  else:
-    unzip_to_dir(filename, tmp)
+class TargetFiles(object):
+  """Read access to the members of a target-files, given either as a zip or
+  as the directory it was unzipped in, by their names in the zip (e.g.
+  "META/misc_info.txt"). Missing members raise KeyError.
+
+  Nothing gets unzipped up front: members stored in the zip are mapped
+  straight from it (see Map() and Locate()) and deflated ones are
+  decompressed while being read. Only the members that some tool needs as
+  real files (e.g. the RAMDISK tree for mkbootfs) get unzipped, through
+  Extract() or GetPath().
+  """
+
+  def __init__(self, path):
+    self.path = path
+    self.unzip_dir = None
+    self._zip_map = None
+    self._lock = threading.Lock()
+    if os.path.isdir(path):
+      self.input_zip = None
+      self.infos = None
+    else:
+      self.input_zip = zipfile.ZipFile(path, "r")
+      self.infos = dict((i.filename, i) for i in self.input_zip.infolist())
+
+  def Close(self):
+    if self.input_zip is not None:
+      self.input_zip.close()
+
+  def _DirPath(self, name):
+    return os.path.join(self.path, *name.split("/"))
+
+  def NameList(self):
+    """Return the sorted names of all the files and symlinks."""
+    if self.input_zip is not None:
+      return sorted(n for n in self.infos if not n.endswith("/"))
+    out = []
+    for dirpath, dirnames, filenames in os.walk(self.path):
+      prefix = os.path.relpath(dirpath, self.path).replace(os.sep, "/")
+      prefix = "" if prefix == "." else prefix + "/"
+      out.extend(prefix + fn for fn in filenames)
+      out.extend(prefix + d for d in dirnames
+                 if os.path.islink(os.path.join(dirpath, d)))
+    return sorted(out)
+
+  def Exists(self, name):
+    if self.input_zip is not None:
+      return name in self.infos
+    return os.path.exists(self._DirPath(name))
+
+  def IsSymlink(self, name):
+    if self.input_zip is not None:
+      return stat.S_ISLNK(self.infos[name].external_attr >> 16)
+    return os.path.islink(self._DirPath(name))
+
+  def Read(self, name):
+    """Return the contents of 'name' as a string."""
+    if self.input_zip is not None:
+      return self.input_zip.read(self.infos[name])
+    with self.Open(name) as f:
+      return f.read()
+
+  def Open(self, name):
+    """Return a file object to stream the contents of 'name'."""
+    if self.input_zip is not None:
+      # Members are opened with their own file objects, so they can be read
+      # from several threads.
+      return self.input_zip.open(self.infos[name])
+    try:
+      return open(self._DirPath(name), "rb")
+    except IOError as e:
+      if e.errno == errno.ENOENT:
+        raise KeyError(name)
+      raise
 
-  return tmp, zipfile.ZipFile(filename, "r")
+  def Locate(self, name):
+    """Return (filename, offset) where the contents of 'name' can be read
+    from, unzipping it first only if it's compressed in the zip."""
+    if self.input_zip is None:
+      path = self._DirPath(name)
+      if not os.path.exists(path):
+        raise KeyError(name)
+      return path, 0
+    info = self.infos[name]
+    if info.compress_type != zipfile.ZIP_STORED:
+      return self.GetPath(name), 0
+    # The local header's name and extra fields may differ in length from the
+    # ones in the central directory.
+    with self._lock:
+      self.input_zip.fp.seek(info.header_offset)
+      header = self.input_zip.fp.read(zipfile.sizeFileHeader)
+    fields = struct.unpack(zipfile.structFileHeader, header)
+    if fields[0] != zipfile.stringFileHeader:
+      raise zipfile.BadZipfile("bad local header for %s" % (name,))
+    # The file name and extra field lengths.
+    return self.path, (info.header_offset + zipfile.sizeFileHeader +
+                       fields[10] + fields[11])
+
+  def Map(self, name):
+    """Return the contents of 'name' without copying them: a buffer into
+    the memory-mapped zip (or file), unless it's compressed in the zip."""
+    if self.input_zip is not None:
+      info = self.infos[name]
+      if info.compress_type != zipfile.ZIP_STORED or not info.file_size:
+        return self.Read(name)
+      with self._lock:
+        if self._zip_map is None:
+          with open(self.path, "rb") as f:
+            self._zip_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+      _, offset = self.Locate(name)
+      return buffer(self._zip_map, offset, info.file_size)
+    path, _ = self.Locate(name)
+    if not os.path.getsize(path):
+      return ""
+    with open(path, "rb") as f:
+      return buffer(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+  def Extract(self, patterns=None):
+    """Unzip the members matching 'patterns' (see UnzipToDir()), and return
+    the directory they are unzipped in. Members unzipped by earlier calls
+    are kept. A directory target-files is returned as is."""
+    if self.input_zip is None:
+      return self.path
+    if self.unzip_dir is None:
+      self.unzip_dir = _UnzipDir([self.path])
+    UnzipToDir(self.path, self.unzip_dir, patterns)
+    return self.unzip_dir
+
+  def GetPath(self, name):
+    """Return the path of 'name' as a real file, unzipping it if needed."""
+    if not self.Exists(name):
+      raise KeyError(name)
+    # Match the name literally.
+    pattern = re.sub(r"([*?[])", r"[\1]", name)
+    return os.path.join(self.Extract(pattern), *name.split("/"))
 
 
 def GetKeyPasswords(keylist):
@@ -730,7 +1075,9 @@ def SignFile(input_name, output_name, key, password, min_api_level=None,
               key + OPTIONS.private_key_suffix,
               input_name, output_name])
 
-  p = Run(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+  # Several files may be signed at once (see sign_target_files_apks.py);
+  # close_fds keeps the others' password pipes out of this signer.
+  p = Run(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, close_fds=True)
   if password is not None:
     password += "\n"
   p.communicate(password)
@@ -1020,42 +1367,113 @@ class PasswordManager(object):
 
 def ZipWrite(zip_file, filename, arcname=None, perms=0o644,
              compress_type=None):
-  import datetime
-
-  # http://b/18015246
-  # Python 2.7's zipfile implementation wrongly thinks that zip64 is required
-  # for files larger than 2GiB. We can work around this by adjusting their
-  # limit. Note that `zipfile.writestr()` will not work for strings larger than
-  # 2GiB. The Python interpreter sometimes rejects strings that large (though
-  # it isn't clear to me exactly what circumstances cause this).
-  # `zipfile.write()` must be used directly to work around this.
-  #
-  # This mess can be avoided if we port to python3.
-  saved_zip64_limit = zipfile.ZIP64_LIMIT
-  zipfile.ZIP64_LIMIT = (1 << 32) - 1
-
-  if compress_type is None:
-    compress_type = zip_file.compression
+  """Write the file 'filename' into 'zip_file' as 'arcname' (defaults to
+  'filename'), streaming it through ZipWriteStream()."""
   if arcname is None:
     arcname = filename
-
-  saved_stat = os.stat(filename)
-
-  try:
-    # `zipfile.write()` doesn't allow us to pass ZipInfo, so just modify the
-    # file to be zipped and reset it when we're done.
-    os.chmod(filename, perms)
-
-    # Use a fixed timestamp so the output is repeatable.
-    epoch = datetime.datetime.fromtimestamp(0)
-    timestamp = (datetime.datetime(2009, 1, 1) - epoch).total_seconds()
-    os.utime(filename, (timestamp, timestamp))
-
-    zip_file.write(filename, arcname=arcname, compress_type=compress_type)
-  finally:
-    os.chmod(filename, saved_stat.st_mode)
-    os.utime(filename, (saved_stat.st_atime, saved_stat.st_mtime))
-    zipfile.ZIP64_LIMIT = saved_zip64_limit
+  with open(filename, "rb") as f:
+    ZipWriteStream(zip_file, arcname, iter(lambda: f.read(1 << 20), ""),
+                   size=os.fstat(f.fileno()).st_size, perms=perms,
+                   compress_type=compress_type)
+
+
+# http://b/18015246
+# Python 2.7's zipfile implementation wrongly thinks that zip64 is required
+# for files larger than 2GiB, and refers to zipfile.ZIP64_LIMIT for that when
+# writing the headers. ZipWriteStream() writes the local headers itself with
+# the actual zip64 limit, and ZipWriteStr() and ZipClose() (which writes the
+# central directory) adjust zipfile.ZIP64_LIMIT to match.
+ZIP64_LIMIT = (1 << 32) - 1
+
+
+def ZipWriteStream(zip_file, arcname, pieces, size=None, perms=0o644,
+                   compress_type=None):
+  """Write the data in the iterable of strings (or buffers) 'pieces' into
+  'zip_file' as 'arcname', computing the CRC and compressing on the fly, so
+  that large members (e.g. system.new.dat) never need to be held in memory
+  or written to a temp file first.
+
+  'size' is the expected size of the data, if known; the member gets zip64
+  headers if it may reach the zip64 limit, or if 'size' isn't given."""
+  if compress_type is None:
+    compress_type = zip_file.compression
+  if zip_file.mode not in ("w", "a"):
+    raise RuntimeError('write() requires mode "w" or "a"')
+
+  # Same as zipfile.ZipFile.write(). Use a fixed timestamp so the output is
+  # repeatable.
+  arcname = os.path.normpath(os.path.splitdrive(arcname)[1])
+  arcname = arcname.lstrip(os.sep + (os.altsep or ""))
+  zinfo = zipfile.ZipInfo(arcname, (2009, 1, 1, 0, 0, 0))
+  zinfo.external_attr = (perms | 0o100000) << 16
+  zinfo.compress_type = compress_type
+  zinfo.flag_bits = 0
+  zinfo.CRC = zinfo.file_size = zinfo.compress_size = 0
+  zinfo.header_offset = zip_file.fp.tell()
+  zip64 = size is None or size * 1.05 > ZIP64_LIMIT
+  if zip64:
+    zinfo.extract_version = max(zinfo.extract_version, 45)
+
+  zip_file.fp.write(_ZipLocalHeader(zinfo, zip64))
+  if compress_type == zipfile.ZIP_DEFLATED:
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED,
+                                  -15)
+  else:
+    compressor = None
+  crc = 0
+  file_size = 0
+  compress_size = 0
+  for piece in pieces:
+    file_size += len(piece)
+    crc = zlib.crc32(piece, crc)
+    if compressor is not None:
+      piece = compressor.compress(piece)
+    compress_size += len(piece)
+    zip_file.fp.write(piece)
+  if compressor is not None:
+    piece = compressor.flush()
+    compress_size += len(piece)
+    zip_file.fp.write(piece)
+
+  zinfo.CRC = crc & 0xffffffff
+  zinfo.file_size = file_size
+  zinfo.compress_size = compress_size
+  if not zip64 and max(file_size, compress_size) > ZIP64_LIMIT:
+    raise zipfile.LargeZipFile("%s is larger than its expected %d bytes" %
+                               (arcname, size))
+
+  # Go back to fill in the CRC and the sizes.
+  position = zip_file.fp.tell()
+  zip_file.fp.seek(zinfo.header_offset)
+  zip_file.fp.write(_ZipLocalHeader(zinfo, zip64))
+  zip_file.fp.seek(position)
+
+  zip_file.filelist.append(zinfo)
+  zip_file.NameToInfo[zinfo.filename] = zinfo
+  # Have close() write the central directory, as zipfile.write() does.
+  zip_file._didModify = True # pylint: disable=protected-access
+
+
+def _ZipLocalHeader(zinfo, zip64):
+  # Return the local file header of 'zinfo', with a zip64 extra field
+  # holding the sizes if 'zip64' is True.
+  filename = zinfo.filename
+  if isinstance(filename, unicode):
+    filename = filename.encode("utf-8")
+    zinfo.flag_bits |= 0x800
+  file_size, compress_size = zinfo.file_size, zinfo.compress_size
+  extra = ""
+  if zip64:
+    extra = struct.pack("<HHQQ", 1, 16, file_size, compress_size)
+    file_size = compress_size = 0xffffffff
+  dt = zinfo.date_time
+  dosdate = (dt[0] - 1980) << 9 | dt[1] << 5 | dt[2]
+  dostime = dt[3] << 11 | dt[4] << 5 | (dt[5] // 2)
+  header = struct.pack(zipfile.structFileHeader, zipfile.stringFileHeader,
+                       zinfo.extract_version, zinfo.reserved, zinfo.flag_bits,
+                       zinfo.compress_type, dostime, dosdate, zinfo.CRC,
+                       compress_size, file_size, len(filename), len(extra))
+  return header + filename + extra
 
 
 def ZipWriteStr(zip_file, zinfo_or_arcname, data, perms=None,
@@ -1072,7 +1490,7 @@ def ZipWriteStr(zip_file, zinfo_or_arcname, data, perms=None,
   """
 
   saved_zip64_limit = zipfile.ZIP64_LIMIT
-  zipfile.ZIP64_LIMIT = (1 << 32) - 1
+  zipfile.ZIP64_LIMIT = ZIP64_LIMIT
 
   if not isinstance(zinfo_or_arcname, zipfile.ZipInfo):
     zinfo = zipfile.ZipInfo(filename=zinfo_or_arcname)
@@ -1105,7 +1523,7 @@ def ZipClose(zip_file):
   # zipfile also refers to ZIP64_LIMIT during close() when it writes out the
   # central directory.
   saved_zip64_limit = zipfile.ZIP64_LIMIT
-  zipfile.ZIP64_LIMIT = (1 << 32) - 1
+  zipfile.ZIP64_LIMIT = ZIP64_LIMIT
 
   zip_file.close()
 
@@ -1197,6 +1615,14 @@ class DeviceSpecificParams(object):
   def VerifyOTA_Assertions(self):
     return self._DoCall("VerifyOTA_Assertions")
 
+  def UnzipPatterns(self):
+    """Called before the OTA is generated, to return the shell-style patterns
+    of the members of the target-files that the device-specific code reads
+    from the unzipped directories (OPTIONS.input_tmp, OPTIONS.source_tmp),
+    beyond the ones the OTA itself needs. If the module doesn't say (the
+    default, None), all the members get unzipped."""
+    return self._DoCall("UnzipPatterns")
+
 class File(object):
   def __init__(self, name, data):
     self.name = name
@@ -1220,6 +1646,70 @@ class File(object):
   def AddToZip(self, z, compression=None):
     ZipWriteStr(z, self.name, self.data, compress_type=compression)
 
+
+class LazyFile(File):
+  """A File whose contents are left where they are (a member of a
+  target-files ZipFile, or a file on disk) until a patch or a verbatim copy
+  needs them, and are never kept in memory.
+
+  The SHA-1 is either given up front (e.g. from a manifest saved by an
+  earlier run) or computed on first use, streaming the contents."""
+
+  # pylint: disable=super-init-not-called
+  def __init__(self, name, size, opener, sha1_hex=None):
+    self.name = name
+    self.size = size
+    self._opener = opener
+    self._sha1 = sha1_hex
+
+  @classmethod
+  def FromZip(cls, name, input_zip, info, sha1_hex=None):
+    """Return a LazyFile for the member 'info' of 'input_zip', which has to
+    be opened by its file name so that members can be read from several
+    threads."""
+    return cls(name, info.file_size, lambda: input_zip.open(info), sha1_hex)
+
+  @classmethod
+  def FromLocalFile(cls, name, diskname, sha1_hex=None):
+    return cls(name, os.path.getsize(diskname), lambda: open(diskname, "rb"),
+               sha1_hex)
+
+  def _Pieces(self):
+    f = self._opener()
+    try:
+      for piece in iter(lambda: f.read(1 << 20), ""):
+        yield piece
+    finally:
+      f.close()
+
+  @property
+  def sha1(self):
+    if self._sha1 is None:
+      ctx = sha1()
+      for piece in self._Pieces():
+        ctx.update(piece)
+      self._sha1 = ctx.hexdigest()
+    return self._sha1
+
+  @property
+  def data(self):
+    return "".join(self._Pieces())
+
+  def HasSha1(self):
+    """Return whether the SHA-1 is known without reading the contents."""
+    return self._sha1 is not None
+
+  def WriteToTemp(self):
+    t = tempfile.NamedTemporaryFile()
+    for piece in self._Pieces():
+      t.write(piece)
+    t.flush()
+    return t
+
+  def AddToZip(self, z, compression=None):
+    ZipWriteStream(z, self.name, self._Pieces(), size=self.size,
+                   compress_type=compression)
+
 DIFF_PROGRAM_BY_EXT = {
     ".gz" : "imgdiff",
     ".zip" : ["imgdiff", "-z"],
@@ -1234,63 +1724,88 @@ class Difference(object):
     self.sf = sf
     self.patch = None
     self.diff_program = diff_program
+    self._key = None
+    self._temps = None
 
-  def ComputePatch(self):
-    """Compute the patch (as a string of data) needed to turn sf into
-    tf.  Returns the same tuple as GetPatch()."""
-
-    tf = self.tf
-    sf = self.sf
-
+  def _Command(self):
     if self.diff_program:
       diff_program = self.diff_program
     else:
-      ext = os.path.splitext(tf.name)[1]
+      ext = os.path.splitext(self.tf.name)[1]
       diff_program = DIFF_PROGRAM_BY_EXT.get(ext, "bsdiff")
 
-    ttemp = tf.WriteToTemp()
-    stemp = sf.WriteToTemp()
-
-    ext = os.path.splitext(tf.name)[1]
-
+    if isinstance(diff_program, list):
+      return copy.copy(diff_program)
+    return [diff_program]
+
+  def _CacheKey(self, cmd):
+    # Options that name files (e.g. the imgdiff bonus file) are keyed on the
+    # file contents rather than on their (temporary) paths.
+    key_cmd = cmd[:1]
+    for arg in cmd[1:]:
+      if os.path.isfile(arg):
+        with open(arg, "rb") as f:
+          arg = "sha1:" + sha1(f.read()).hexdigest()
+      key_cmd.append(arg)
+    return OPTIONS.patch_cache.Key(self.sf.sha1, self.tf.sha1, key_cmd)
+
+  def Start(self):
+    """Start computing the patch in a child process and return the process,
+    which Finish() must be called for once it exits. Return None instead if
+    the patch is found in OPTIONS.patch_cache; nothing is started then."""
+    cmd = self._Command()
+    self.patch = None
+    self._key = None
+    if OPTIONS.patch_cache is not None:
+      self._key = self._CacheKey(cmd)
+      diff = OPTIONS.patch_cache.Get(self._key)
+      if diff is not None:
+        self.patch = diff
+        return None
+
+    ttemp = self.tf.WriteToTemp()
+    stemp = self.sf.WriteToTemp()
+    ptemp = tempfile.NamedTemporaryFile()
+    # stderr goes to a file rather than a pipe, so that nothing needs to
+    # read it while the process runs.
+    etemp = tempfile.TemporaryFile()
+    self._temps = (ttemp, stemp, ptemp, etemp)
+    with open(os.devnull, "w") as devnull:
+      return Run(cmd + [stemp.name, ttemp.name, ptemp.name],
+                 stdout=devnull, stderr=etemp)
+
+  def Finish(self, returncode):
+    """Collect the patch from the process returned by Start(), which exited
+    with 'returncode', or None if it was killed for taking too long."""
+    ttemp, stemp, ptemp, etemp = self._temps
+    self._temps = None
     try:
-      ptemp = tempfile.NamedTemporaryFile()
-      if isinstance(diff_program, list):
-        cmd = copy.copy(diff_program)
-      else:
-        cmd = [diff_program]
-      cmd.append(stemp.name)
-      cmd.append(ttemp.name)
-      cmd.append(ptemp.name)
-      p = Run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-      err = []
-      def run():
-        _, e = p.communicate()
-        if e:
-          err.append(e)
-      th = threading.Thread(target=run)
-      th.start()
-      th.join(timeout=300)   # 5 mins
-      if th.is_alive():
+      etemp.seek(0)
+      err = etemp.read()
+      if returncode is None:
         print "WARNING: diff command timed out"
-        p.terminate()
-        th.join(5)
-        if th.is_alive():
-          p.kill()
-          th.join()
-
-      if err or p.returncode != 0:
+      elif err or returncode != 0:
         print "WARNING: failure running %s:\n%s\n" % (
-            diff_program, "".join(err))
-        self.patch = None
-        return None, None, None
-      diff = ptemp.read()
+            self._Command()[0], err)
+      else:
+        self.patch = ptemp.read()
     finally:
-      ptemp.close()
-      stemp.close()
-      ttemp.close()
+      for t in (ptemp, etemp, stemp, ttemp):
+        t.close()
 
-    self.patch = diff
+    if self.patch is not None and self._key is not None:
+      OPTIONS.patch_cache.Put(self._key, self.patch)
+
+  def ComputePatch(self, timeout=None):
+    """Compute the patch (as a string of data) needed to turn sf into
+    tf, giving up after 'timeout' seconds (OPTIONS.diff_timeout by
+    default).  Returns the same tuple as GetPatch(), or (None, None, None)
+    if computing the patch failed."""
+    p = self.Start()
+    if p is not None:
+      self.Finish(_WaitProcess(p, timeout or OPTIONS.diff_timeout))
+    if self.patch is None:
+      return None, None, None
     return self.tf, self.sf, self.patch
 
 
@@ -1301,55 +1816,253 @@ class Difference(object):
     return self.tf, self.sf, self.patch
 
 
-def ComputeDifferences(diffs):
-  """Call ComputePatch on all the Difference objects in 'diffs'."""
+def _WaitProcess(p, timeout, start=None):
+  # Wait for the process 'p' started at time 'start' (now by default) to
+  # exit, and return its exit code; kill it and return None if it's still
+  # running after 'timeout' seconds.
+  deadline = (start or time.time()) + timeout
+  delay = 0.001
+  while p.poll() is None:
+    if time.time() >= deadline:
+      _KillProcess(p)
+      return None
+    time.sleep(delay)
+    delay = min(delay * 2, 0.05)
+  return p.returncode
+
+
+def _KillProcess(p):
+  # Terminate the process 'p', and kill it if it doesn't exit in 5 seconds.
+  if p.poll() is not None:
+    return
+  p.terminate()
+  deadline = time.time() + 5
+  while p.poll() is None and time.time() < deadline:
+    time.sleep(0.05)
+  if p.poll() is None:
+    p.kill()
+    p.wait()
+
+
+def ComputeBlockDifferences(block_diffs):
+  """Call Compute() on all the BlockDifference objects in 'block_diffs'.
+
+  The partitions are independent of each other until their scripts get
+  written, so each one is computed in a child process of its own.
+  OPTIONS.worker_threads is split between them in proportion to the size of
+  their target images. The output files end up in the paths set up by the
+  BlockDifference objects, so writing them out is unaffected, and the
+  OPTIONS.patch_cache hits and misses of the children are added to the
+  parent's.
+
+  The partitions are computed one after the other instead in a daemonic
+  process (e.g. a multiprocessing.Pool worker), which isn't allowed to have
+  children."""
+  if (len(block_diffs) <= 1 or not hasattr(os, "fork") or
+      multiprocessing.current_process().daemon):
+    for d in block_diffs:
+      d.Compute()
+    return
+
+  total_threads = OPTIONS.worker_threads or 1
+  weights = [max(d.tgt.total_blocks, 1) for d in block_diffs]
+  budget = [max(total_threads * w // sum(weights), 1) for w in weights]
+
+  children = []
+  try:
+    for d, threads in zip(block_diffs, budget):
+      print "computing %s block difference (%d threads)..." % (d.partition,
+                                                                threads)
+      recv_conn, send_conn = multiprocessing.Pipe(False)
+      p = multiprocessing.Process(target=d._ComputeInChild,
+                                  args=(threads, send_conn))
+      p.start()
+      send_conn.close()
+      children.append((d, p, recv_conn))
+
+    for d, p, conn in children:
+      try:
+        result = conn.recv()
+      except EOFError:
+        result = None
+      p.join()
+      if result is None:
+        raise ExternalError("failed to compute %s block difference (exit %s)"
+                            % (d.partition, p.exitcode))
+      ok, value = result
+      if not ok:
+        raise value
+      (d._required_cache, d.touched_src_ranges, d.touched_src_sha1,
+       stats) = value
+      if stats is not None:
+        OPTIONS.patch_cache.hits += stats[0]
+        OPTIONS.patch_cache.misses += stats[1]
+  finally:
+    for _, p, _ in children:
+      if p.is_alive():
+        p.terminate()
+        p.join()
+
+
+# The upper bounds in seconds of the buckets of the diff time histogram
+# printed by ComputeDifferences().
+DIFF_TIME_BUCKETS = (1, 10, 60, 300)
+
+
+def ComputeDifferences(diffs, retries=1):
+  """Compute the patches of all the Difference objects in 'diffs'.
+
+  Each patch is computed in a child process of its own (see
+  Difference.Start()), up to OPTIONS.worker_threads of them at a time, and
+  as long as the source and target files being diffed add up to at most
+  OPTIONS.diff_max_bytes, if it's set. The largest diffs go first, to try
+  and reduce the long-pole effect; when the next one doesn't fit in the
+  bytes left, the largest smaller one that does is started in its place.
+  A diff that fails or runs for more than OPTIONS.diff_timeout seconds is
+  retried up to 'retries' times.
+
+  Each started diff gets a thread of its own, which writes out the files
+  to diff (see Difference.Start()), waits for the child process and
+  collects the patch, so that this thread only schedules them.
+
+  Prints the time each diff took, a histogram of them, and the diff on the
+  critical path: the one that finished last, which bounds the wall time."""
   print len(diffs), "diffs to compute"
 
-  # Do the largest files first, to try and reduce the long-pole effect.
-  by_size = [(i.tf.size, i) for i in diffs]
-  by_size.sort(reverse=True)
-  by_size = [i[1] for i in by_size]
+  workers = OPTIONS.worker_threads or 1
+  max_bytes = OPTIONS.diff_max_bytes
+  timeout = OPTIONS.diff_timeout
 
-  lock = threading.Lock()
-  diff_iter = iter(by_size)   # accessed under lock
+  def Cost(d):
+    return d.tf.size + d.sf.size
 
-  def worker():
+  def Name(d):
+    if d.sf.name == d.tf.name:
+      return d.tf.name
+    return "%s (%s)" % (d.tf.name, d.sf.name)
+
+  # The diffs yet to start as (cost, -index, diff), in increasing order; the
+  # index keeps the order of 'diffs' among the ones of the same cost.
+  index = dict((id(d), i) for i, d in enumerate(diffs))
+
+  def PendingItem(d):
+    return Cost(d), -index[id(d)], d
+
+  pending = sorted(PendingItem(d) for d in diffs)
+
+  def TakePending(room):
+    # Remove and return the largest pending diff of at most 'room' bytes
+    # (of any size if 'room' is None), or None if there's none.
+    if room is None:
+      n = len(pending)
+    else:
+      n = bisect.bisect_right(pending, (room, float("inf")))
+    if not n:
+      return None
+    return pending.pop(n - 1)[2]
+
+  attempts = dict((id(d), 0) for d in diffs)
+  finished = Queue.Queue()
+  processes = {}   # id(diff) -> child process, of the diffs started
+  processes_lock = threading.Lock()
+  stopping = []
+
+  def RunDiff(d, start):
     try:
-      lock.acquire()
-      for d in diff_iter:
-        lock.release()
-        start = time.time()
-        d.ComputePatch()
-        dur = time.time() - start
-        lock.acquire()
-
-        tf, sf, patch = d.GetPatch()
-        if sf.name == tf.name:
-          name = tf.name
-        else:
-          name = "%s (%s)" % (tf.name, sf.name)
-        if patch is None:
-          print "patching failed!                                  %s" % (name,)
-        else:
-          print "%8.2f sec %8d / %8d bytes (%6.2f%%) %s" % (
-              dur, len(patch), tf.size, 100.0 * len(patch) / tf.size, name)
-      lock.release()
-    except Exception as e:
-      print e
-      raise
+      p = d.Start()
+      if p is not None:
+        with processes_lock:
+          processes[id(d)] = p
+          if stopping:
+            _KillProcess(p)
+        try:
+          d.Finish(_WaitProcess(p, timeout, start))
+        finally:
+          with processes_lock:
+            del processes[id(d)]
+      finished.put((d, start, None))
+    except Exception: # pylint: disable=broad-except
+      finished.put((d, start, sys.exc_info()))
+
+  running = 0
+  in_flight = 0
+  durations = []
+  critical = None   # (end, start, diff)
+  begin = time.time()
+
+  def Done(d, start):
+    end = time.time()
+    dur = end - start
+    durations.append(dur)
+    patch = d.patch
+    name = Name(d)
+    if patch is None:
+      print "patching failed!                                  %s" % (name,)
+    else:
+      print "%8.2f sec %8d / %8d bytes (%6.2f%%) %s" % (
+          dur, len(patch), d.tf.size, 100.0 * len(patch) / d.tf.size, name)
+    return end, start, d
 
-  # start worker threads; wait for them all to finish.
-  threads = [threading.Thread(target=worker)
-             for i in range(OPTIONS.worker_threads)]
-  for th in threads:
-    th.start()
-  while threads:
-    threads.pop().join()
+  try:
+    while pending or running:
+      while pending and running < workers:
+        room = None
+        if max_bytes is not None and running:
+          room = max_bytes - in_flight
+        d = TakePending(room)
+        if d is None:
+          break
+        t = threading.Thread(target=RunDiff, args=(d, time.time()))
+        t.daemon = True
+        t.start()
+        running += 1
+        in_flight += Cost(d)
+
+      # Wait with a timeout, which (unlike a plain get()) can be interrupted.
+      while True:
+        try:
+          d, start, exc_info = finished.get(True, 1)
+          break
+        except Queue.Empty:
+          pass
+      running -= 1
+      in_flight -= Cost(d)
+      if exc_info is not None:
+        raise exc_info[0], exc_info[1], exc_info[2]
+      if d.patch is None and attempts[id(d)] < retries:
+        attempts[id(d)] += 1
+        print "retrying %s" % (Name(d),)
+        bisect.insort(pending, PendingItem(d))
+      else:
+        critical = max(critical, Done(d, start))
+  finally:
+    with processes_lock:
+      stopping.append(True)
+      for p in processes.values():
+        _KillProcess(p)
+
+  if durations:
+    print "diff times:"
+    lower = 0
+    for upper in DIFF_TIME_BUCKETS + (None,):
+      count = len([t for t in durations
+                   if t >= lower and (upper is None or t < upper)])
+      if upper is None:
+        print "  %4d sec and up: %5d" % (lower, count)
+      else:
+        print "  %4d - %4d sec: %5d" % (lower, upper, count)
+      lower = upper
+    end, start, d = critical
+    print "critical path: %s, %.2f sec (started at %.2f of %.2f sec)" % (
+        Name(d), end - start, start - begin, end - begin)
 
 
 class BlockDifference(object):
   def __init__(self, partition, tgt, src=None, check_first_block=False,
-               version=None, disable_imgdiff=False):
+               version=None, disable_imgdiff=False, compute=True):
+    """Set up the block difference for 'partition'. Unless 'compute' is
+    False, the difference is computed right away; otherwise Compute() (or
+    ComputeBlockDifferences()) must be called before writing the scripts."""
     self.tgt = tgt
     self.src = src
     self.partition = partition
@@ -1364,16 +2077,24 @@ class BlockDifference(object):
             OPTIONS.info_dict.get("blockimgdiff_versions", "1").split(","))
     self.version = version
 
-    b = blockimgdiff.BlockImageDiff(tgt, src, threads=OPTIONS.worker_threads,
-                                    version=self.version,
-                                    disable_imgdiff=self.disable_imgdiff)
-    tmpdir = tempfile.mkdtemp()
-    OPTIONS.tempfiles.append(tmpdir)
+    self._required_cache = None
+    self.touched_src_ranges = None
+    self.touched_src_sha1 = None
+
+    # With OPTIONS.work_dir, the output files and results are kept in the
+    # work dir, keyed by everything they depend on, so that a rerun can pick
+    # them up instead of computing them again.
+    if OPTIONS.work_dir is None:
+      self.checkpoint_dir = None
+      tmpdir = tempfile.mkdtemp()
+      OPTIONS.tempfiles.append(tmpdir)
+    else:
+      self.checkpoint_dir = tmpdir = os.path.join(
+          OPTIONS.work_dir, "blockdiff-" + self._CheckpointKey())
     self.path = os.path.join(tmpdir, partition)
-    b.Compute(self.path)
-    self._required_cache = b.max_stashed_size
-    self.touched_src_ranges = b.touched_src_ranges
-    self.touched_src_sha1 = b.touched_src_sha1
+
+    if compute:
+      self.Compute()
 
     if src is None:
       _, self.device = GetTypeAndDevice("/" + partition, OPTIONS.info_dict)
@@ -1381,6 +2102,113 @@ class BlockDifference(object):
       _, self.device = GetTypeAndDevice("/" + partition,
                                         OPTIONS.source_info_dict)
 
+  def _CheckpointKey(self):
+    """Return a hash of everything the output of Compute() depends on."""
+    ctx = sha1()
+    for image in (self.tgt, self.src):
+      if image is None:
+        ctx.update("none\n")
+        continue
+      ctx.update(image.TotalSha1(include_clobbered_blocks=True) + "\n")
+      for ranges in (image.care_map, getattr(image, "clobbered_blocks", None),
+                     getattr(image, "extended", None)):
+        ctx.update("%s\n" % (ranges,))
+      for fn in sorted(image.file_map):
+        ctx.update("%s %s\n" % (fn, image.file_map[fn]))
+    ctx.update(repr((self.partition, self.version, self.disable_imgdiff,
+                     OPTIONS.cache_size, OPTIONS.stash_threshold,
+                     OPTIONS.stash_reorder_rounds, OPTIONS.stash_reorder_time,
+                     OPTIONS.adaptive_split)))
+    return ctx.hexdigest()
+
+  def Compute(self, threads=None):
+    """Compute the difference, writing the transfer list and patch data next
+    to self.path. Patches are computed with 'threads' threads (defaults to
+    OPTIONS.worker_threads)."""
+    if self.checkpoint_dir is not None and os.path.isdir(self.checkpoint_dir):
+      print "using %s block difference from %s" % (self.partition,
+                                                   self.checkpoint_dir)
+      self._LoadResults()
+      return
+
+    if threads is None:
+      threads = OPTIONS.worker_threads
+    b = blockimgdiff.BlockImageDiff(self.tgt, self.src, threads=threads,
+                                    version=self.version,
+                                    disable_imgdiff=self.disable_imgdiff)
+    # The new data is streamed from self.tgt into the package instead (see
+    # _WriteUpdate()).
+    if self.checkpoint_dir is None:
+      b.Compute(self.path, write_new_data=False)
+      self._SetResults(b)
+      return
+
+    # Compute into a staging dir, and rename it into place once all the files
+    # are there. The staging dir is removed here rather than through
+    # OPTIONS.tempfiles, which isn't cleaned up when this runs in a child
+    # process (see ComputeBlockDifferences()).
+    staging = tempfile.mkdtemp(prefix=".blockdiff-", dir=OPTIONS.work_dir)
+    try:
+      b.Compute(os.path.join(staging, self.partition), write_new_data=False)
+      self._SetResults(b)
+      self._SaveResults(os.path.join(staging, self.partition))
+      try:
+        os.rename(staging, self.checkpoint_dir)
+      except OSError:
+        # Another run sharing the work dir got there first.
+        if not os.path.isdir(self.checkpoint_dir):
+          raise
+    finally:
+      if os.path.isdir(staging):
+        shutil.rmtree(staging)
+
+  def _SetResults(self, b):
+    self._required_cache = b.max_stashed_size
+    self.touched_src_ranges = b.touched_src_ranges
+    self.touched_src_sha1 = b.touched_src_sha1
+
+  def _SaveResults(self, path):
+    ranges = self.touched_src_ranges
+    with open(path + ".results", "w") as f:
+      f.write("required_cache=%d\n" % (self._required_cache,))
+      f.write("touched_src_ranges=%s\n" % (
+          ranges.to_string_raw() if ranges else "",))
+      f.write("touched_src_sha1=%s\n" % (self.touched_src_sha1 or "",))
+
+  def _LoadResults(self):
+    results = {}
+    with open(self.path + ".results") as f:
+      for line in f:
+        k, v = line.rstrip("\n").split("=", 1)
+        results[k] = v
+    self._required_cache = int(results["required_cache"])
+    ranges = results["touched_src_ranges"]
+    self.touched_src_ranges = rangelib.RangeSet(
+        data=[int(i) for i in ranges.split(",")[1:]] if ranges else None)
+    self.touched_src_sha1 = results["touched_src_sha1"] or None
+
+  def _ComputeInChild(self, threads, conn):
+    """Run Compute() in a child process and send the results (or the
+    exception) back through 'conn', with the number of OPTIONS.patch_cache
+    hits and misses it took.
+
+    Whatever else is cached along the way (e.g. the block hash indexes of
+    the images) stays in the child; the parent builds its own when needed."""
+    cache = OPTIONS.patch_cache
+    if cache is not None:
+      hits, misses = cache.hits, cache.misses
+    try:
+      self.Compute(threads)
+      stats = None
+      if cache is not None:
+        stats = (cache.hits - hits, cache.misses - misses)
+      conn.send((True, (self._required_cache, self.touched_src_ranges,
+                        self.touched_src_sha1, stats)))
+    except Exception as e: # pylint: disable=broad-except
+      traceback.print_exc()
+      conn.send((False, e))
+    conn.close()
+
   @property
   def required_cache(self):
     return self._required_cache
@@ -1539,13 +2367,29 @@ class BlockDifference(object):
         'update");\n'
         'endif;' % (code, partition))
 
+  def _NewDataRanges(self):
+    """Return the target ranges of the "new" commands of the transfer list,
+    in order: the new data is those blocks of self.tgt, one after the
+    other."""
+    out = []
+    with open(self.path + ".transfer.list") as f:
+      for line in f:
+        if line.startswith("new "):
+          raw = line.split()[1]
+          out.append(rangelib.RangeSet(
+              data=[int(i) for i in raw.split(",")[1:]]))
+    return out
+
   def _WriteUpdate(self, script, output_zip):
     ZipWrite(output_zip,
              '{}.transfer.list'.format(self.path),
              '{}.transfer.list'.format(self.partition))
-    ZipWrite(output_zip,
-             '{}.new.dat'.format(self.path),
-             '{}.new.dat'.format(self.partition))
+    new_ranges = self._NewDataRanges()
+    ZipWriteStream(output_zip,
+                   '{}.new.dat'.format(self.partition),
+                   (piece for ranges in new_ranges
+                    for piece in self.tgt.ReadRangeSet(ranges)),
+                   size=sum(r.size() for r in new_ranges) * self.tgt.blocksize)
     ZipWrite(output_zip,
              '{}.patch.dat'.format(self.path),
              '{}.patch.dat'.format(self.partition),
@@ -1564,6 +2408,10 @@ class BlockDifference(object):
     script.AppendExtra(script.WordWrap(call))
 
   def _HashBlocks(self, source, ranges): # pylint: disable=no-self-use
+    range_sha1 = getattr(source, "RangeSha1", None)
+    if range_sha1 is not None:
+      return range_sha1(ranges)
+
     data = source.ReadRangeSet(ranges)
     ctx = sha1()
 
@@ -0,0 +1,86 @@
+# Copyright (C) 2017 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import multiprocessing.managers
+import multiprocessing.pool
+import threading
+
+import common
+import blockimgdiff
+from patch_cache import PatchCache
+
+__all__ = ["DiffManager", "DiffPool"]
+
+
+class _PendingDiff(object):
+  # A diff submitted to a DiffPool, with its patch (or the exception) once
+  # it's done. (A shared AsyncResult only wakes up one of its waiters.)
+
+  def __init__(self):
+    self.done = threading.Event()
+    self.patch = None
+    self.error = None
+
+
+class DiffPool(object):
+  """A pool of block diffs, shared by the processes that generate several
+  incremental OTAs to the same target.
+
+  The pool lives in the server process of a DiffManager, and the processes
+  submit their diffs to it through a proxy (see OPTIONS.diff_pool and
+  blockimgdiff.compute_patch()). At most 'threads' diffs run at a time, and
+  each distinct diff, by its patch cache key, runs only once: a diff that
+  is submitted while it runs is waited for, and one submitted after it ran
+  is read back from the patch cache in 'cache_dir', where the pool stores
+  the patches."""
+
+  def __init__(self, threads, cache_dir, cache_size=None):
+    self._pool = multiprocessing.pool.ThreadPool(threads)
+    self._cache = PatchCache(cache_dir, cache_size)
+    self._lock = threading.Lock()
+    self._pending = {}   # _PendingDiffs by key; accessed under lock
+
+  def _Run(self, key, pending, src, tgt, imgdiff):
+    try:
+      pending.patch = blockimgdiff.compute_patch(src, tgt, imgdiff=imgdiff)
+      self._cache.Put(key, pending.patch)
+    except Exception as e: # pylint: disable=broad-except
+      pending.error = e
+    # Once stored, the patch is found in the cache by the later requests.
+    with self._lock:
+      del self._pending[key]
+    pending.done.set()
+
+  def Diff(self, key, src, tgt, imgdiff=False):
+    """Return the patch from 'src' to 'tgt' (lists of strings), whose patch
+    cache key is 'key'."""
+    with self._lock:
+      pending = self._pending.get(key)
+      if pending is None:
+        patch = self._cache.Get(key)
+        if patch is not None:
+          return patch
+        pending = self._pending[key] = _PendingDiff()
+        self._pool.apply_async(self._Run, (key, pending, src, tgt, imgdiff))
+    pending.done.wait()
+    if pending.error is not None:
+      raise pending.error
+    return pending.patch
+
+
+class DiffManager(multiprocessing.managers.BaseManager):
+  """Starts a DiffPool in a process of its own: DiffManager().DiffPool()
+  returns a proxy to it, which the processes forked afterwards can use."""
+
+DiffManager.register("DiffPool", DiffPool)
@@ -35,7 +35,13 @@ Usage:  ota_from_target_files [flags] input_target_files output_ota_package
 
   -i  (--incremental_from)  <file>
       Generate an incremental OTA using the given target-files zip as
-      the starting build.
+      the starting build. May be given several times to generate one
+      incremental OTA from each of the given builds; output_ota_package is
+      then a directory, which receives <source>-incremental.zip for each
+      <source>.zip. The target is unzipped and indexed only once, and the
+      packages are generated in parallel (see --source_jobs), with their
+      block diffs run in a single pool of worker threads, so that the
+      patches they have in common are only computed once.
 
   --full_radio
       When generating an incremental OTA, always include a full copy of
@@ -102,10 +108,61 @@ Usage:  ota_from_target_files [flags] input_target_files output_ota_package
       Specifies the number of worker-threads that will be used when
       generating patches for incremental updates (defaults to 3).
 
+  --diff_timeout <seconds>
+      Give up on computing the patch of a file for incremental updates after
+      the given time, and retry it once (defaults to 300).
+
+  --diff_max_bytes <size>
+      Limit the total size in bytes of the source and target files whose
+      patches are computed at the same time. Smaller files are diffed
+      meanwhile if the next largest one doesn't fit (defaults to no limit).
+
+  --source_jobs <int>
+      When several -i are given, the number of incremental OTAs that are
+      generated at the same time (defaults to the number of CPUs divided by
+      the number of worker threads).
+
   --stash_threshold <float>
       Specifies the threshold that will be used to compute the maximum
       allowed stash size (defaults to 0.8).
 
+  --stash_reorder_rounds <int>
+      Specifies the number of orders of the transfers to try in looking for
+      one that keeps the stash within the allowed size, before packing the
+      blocks that don't fit as new data (defaults to 0: they are packed as
+      new data right away).
+
+  --stash_reorder_time <seconds>
+      Stops that search after the given time even if not all the rounds are
+      done (no limit by default). The resulting package then depends on the
+      speed of the machine.
+
+  --adaptive_split
+      Pick the size of the pieces that large files are split into for each
+      partition, by diffing the largest files with a few candidate sizes and
+      keeping the one giving the smallest patches, instead of using 1/8 of
+      the cache size. Slower; the measurements are kept in the patch cache
+      (see --patch_cache) for later runs.
+
+  --patch_cache <dir>
+      Store the computed patches in <dir>, keyed by the contents of the
+      source and target data, and reuse them in later runs (e.g. when
+      generating incrementals from several source builds to the same target).
+      The directory may be shared by concurrent runs.
+
+  --patch_cache_size <size>
+      Maximum size in bytes of the patch cache (defaults to 10 GiB). The least
+      recently used patches are evicted first.
+
+  --work_dir <dir>
+      Keep the unzipped target-files and the computed block differences of
+      each partition in <dir>, keyed by their inputs, instead of in temp
+      dirs. A rerun with the same <dir> (e.g. after a failure late in the
+      run) reuses them and skips the completed stages. Unless --patch_cache
+      is given, <dir>/patch_cache is used as the patch cache as well. For
+      file-based incrementals, the SHA-1s of the partition files are kept
+      there too.
+
   --gen_verify
       Generate an OTA package that verifies the partitions.
 
@@ -135,20 +192,36 @@ if sys.hexversion < 0x02070000:
   print >> sys.stderr, "Python 2.7 or newer is required."
   sys.exit(1)
 
+import difflib
 import multiprocessing
 import os
+import re
 import subprocess
 import shlex
 import tempfile
+import traceback
 import zipfile
 
 import common
+import diff_pool
 import edify_generator
+import patch_cache
 import sparse_img
 
 OPTIONS = common.OPTIONS
 OPTIONS.package_key = None
 OPTIONS.incremental_source = None
+OPTIONS.incremental_sources = []
+# The common.TargetFiles of the incremental source, and the directory its
+# members get unzipped in when some tool needs them as files.
+OPTIONS.source_target_files = None
+OPTIONS.source_tmp = None
+# The patterns of the members the device-specific code needs unzipped, in
+# OPTIONS.input_tmp and OPTIONS.source_tmp (see UnzipPatterns()); None for
+# all of them.
+OPTIONS.device_unzip_patterns = []
+OPTIONS.source_jobs = None
+OPTIONS.key_passwords = {}
 OPTIONS.verify = False
 OPTIONS.require_verbatim = set()
 OPTIONS.prohibit_verbatim = set(("system/build.prop",))
@@ -173,6 +246,12 @@ OPTIONS.full_bootloader = False
 # Stash size cannot exceed cache_size * threshold.
 OPTIONS.cache_size = None
 OPTIONS.stash_threshold = 0.8
+OPTIONS.stash_reorder_rounds = 0
+OPTIONS.stash_reorder_time = None
+OPTIONS.adaptive_split = False
+OPTIONS.patch_cache_dir = None
+OPTIONS.patch_cache_size = None
+OPTIONS.work_dir = None
 OPTIONS.gen_verify = False
 OPTIONS.log_diff = None
 OPTIONS.override_device = 'auto'
@@ -199,42 +278,112 @@ def IsRegular(info):
   regular file."""
   return (info.external_attr >> 16) & 0o770000 == 0o100000
 
-def ClosestFileMatch(src, tgtfiles, existing):
-  """Returns the closest file match between a source file and list
-     of potential matches.  The exact filename match is preferred,
-     then the sha1 is searched for, and finally a file with the same
-     basename is evaluated.  Rename support in the updater-binary is
-     required for the latter checks to be used."""
-
-  result = tgtfiles.get("path:" + src.name)
-  if result is not None:
-    return result
-
-  if not OPTIONS.target_info_dict.get("update_rename_support", False):
-    return None
-
-  if src.size < 1000:
-    return None
-
-  result = tgtfiles.get("sha1:" + src.sha1)
-  if result is not None and existing.get(result.name) is None:
-    return result
-  result = tgtfiles.get("file:" + src.name.split("/")[-1])
-  if result is not None and existing.get(result.name) is None:
-    return result
-  return None
+class FileMatcher(object):
+  """Finds the source file to patch each target file from, for file-based
+  incrementals.
+
+  The source files are indexed by path, and the ones whose path is gone
+  from the target by SHA-1, by basename and by basename without digits
+  (see _Stem()), so that each lookup in Match() costs about the same
+  whatever the number of files. 'counts' tells how many matches each of
+  them resolved."""
+
+  # The minimum size of the files that may be matched under another name,
+  # how similar their basenames need to be (see difflib) for the last
+  # resort match, and how many source files with the same basename but for
+  # digits are considered for it.
+  MIN_RENAME_SIZE = 1000
+  MIN_SIMILARITY = 0.6
+  MAX_SIMILAR_CANDIDATES = 16
+
+  def __init__(self, source_data, target_data):
+    self.by_path = source_data
+    self.by_sha1 = {}
+    self.by_basename = {}
+    self.by_stem = {}
+    for fn in sorted(source_data):
+      # Only allow eligibility for filename/sha matching if there isn't a
+      # perfect path match.
+      if fn in target_data:
+        continue
+      sf = source_data[fn]
+      basename = fn.split("/")[-1]
+      self.by_sha1.setdefault(sf.sha1, []).append(sf)
+      self.by_basename.setdefault(basename, []).append(sf)
+      similar = self.by_stem.setdefault(self._Stem(basename), [])
+      if len(similar) < self.MAX_SIMILAR_CANDIDATES:
+        similar.append(sf)
+    self.counts = dict.fromkeys(
+        ("path", "sha1", "basename", "similar", "none"), 0)
+
+  def Match(self, tf, existing):
+    """Return the closest match among the source files for the target file
+    'tf', or None. The exact filename match is preferred, then the sha1 is
+    searched for, then a file with the same basename, and finally the file
+    with the most similar basename that only differs in digits (e.g. in
+    version numbers) and a similar size. Source files in 'existing' are not
+    matched under another name again. Rename support in the updater-binary
+    is required for all but the first check."""
+    result = self.by_path.get(tf.name)
+    if result is not None:
+      return self._Count("path", result)
+
+    if (not OPTIONS.target_info_dict.get("update_rename_support", False) or
+        tf.size < self.MIN_RENAME_SIZE):
+      return self._Count("none", None)
+
+    for sf in self.by_sha1.get(tf.sha1, ()):
+      if sf.name not in existing:
+        return self._Count("sha1", sf)
+    basename = tf.name.split("/")[-1]
+    for sf in self.by_basename.get(basename, ()):
+      if sf.name not in existing:
+        return self._Count("basename", sf)
+
+    best, best_ratio = None, self.MIN_SIMILARITY
+    matcher = difflib.SequenceMatcher(b=basename)
+    for sf in self.by_stem.get(self._Stem(basename), ()):
+      if sf.name in existing or not 0.5 <= float(sf.size) / tf.size <= 2:
+        continue
+      matcher.set_seq1(sf.name.split("/")[-1])
+      # The cheaper upper bounds first.
+      if (matcher.real_quick_ratio() <= best_ratio or
+          matcher.quick_ratio() <= best_ratio):
+        continue
+      ratio = matcher.ratio()
+      if ratio > best_ratio:
+        best, best_ratio = sf, ratio
+    if best is not None:
+      return self._Count("similar", best)
+    return self._Count("none", None)
+
+  @staticmethod
+  def _Stem(basename):
+    # The basename without its digits, e.g. "libfoo.so." for "libfoo.so.1".
+    return re.sub(r"[0-9]+", "", basename)
+
+  def _Count(self, how, sf):
+    self.counts[how] += 1
+    return sf
 
 class ItemSet(object):
   def __init__(self, partition, fs_config):
     self.partition = partition
     self.fs_config = fs_config
     self.ITEMS = {}
+    # The distinct metadata tuples, shared by all the Items that have them.
+    self._metadata = {}
 
   def Get(self, name, is_dir=False):
     if name not in self.ITEMS:
       self.ITEMS[name] = Item(self, name, is_dir=is_dir)
     return self.ITEMS[name]
 
+  def Intern(self, metadata):
+    """Return the shared copy of the (uid, gid, mode, selabel, capabilities)
+    tuple 'metadata'."""
+    return self._metadata.setdefault(metadata, metadata)
+
   def GetMetadata(self, input_zip):
     # The target_files contains a record of what the uid,
     # gid, and mode are supposed to be.
@@ -259,11 +408,8 @@ class ItemSet(object):
 
       i = self.ITEMS.get(name, None)
       if i is not None:
-        i.uid = int(uid)
-        i.gid = int(gid)
-        i.mode = int(mode, 8)
-        i.selabel = selabel
-        i.capabilities = capabilities
+        i.metadata = self.Intern(
+            (int(uid), int(gid), int(mode, 8), selabel, capabilities))
         if i.is_dir:
           i.children.sort(key=lambda i: i.name)
 
@@ -271,25 +417,26 @@ class ItemSet(object):
     # image at system/etc/recovery.img, it will be taken care by fs_config.
     i = self.ITEMS.get("system/recovery-from-boot.p", None)
     if i:
-      i.uid, i.gid, i.mode, i.selabel, i.capabilities = 0, 0, 0o644, None, None
+      i.metadata = self.Intern((0, 0, 0o644, None, None))
     i = self.ITEMS.get("system/etc/install-recovery.sh", None)
     if i:
-      i.uid, i.gid, i.mode, i.selabel, i.capabilities = 0, 0, 0o544, None, None
+      i.metadata = self.Intern((0, 0, 0o544, None, None))
 
 
 class Item(object):
   """Items represent the metadata (user, group, mode) of files and
   directories in the system image."""
+
+  # There's one Item per file, so keep them small.
+  __slots__ = ("name", "parent", "children", "is_dir", "metadata",
+               "best_subtree")
+
+  NO_METADATA = (None, None, None, None, None)
+
   def __init__(self, itemset, name, is_dir=False):
-    self.itemset = itemset
     self.name = name
-    self.uid = None
-    self.gid = None
-    self.mode = None
-    self.selabel = None
-    self.capabilities = None
+    self.metadata = self.NO_METADATA
     self.is_dir = is_dir
-    self.descendants = None
     self.best_subtree = None
 
     if name:
@@ -300,6 +447,12 @@ class Item(object):
     if self.is_dir:
       self.children = []
 
+  uid = property(lambda self: self.metadata[0])
+  gid = property(lambda self: self.metadata[1])
+  mode = property(lambda self: self.metadata[2])
+  selabel = property(lambda self: self.metadata[3])
+  capabilities = property(lambda self: self.metadata[4])
+
   def Dump(self, indent=0):
     if self.uid is not None:
       print "%s%s %d %d %o" % (
@@ -308,68 +461,53 @@ class Item(object):
       print "%s%s %s %s %s" % (
           "  " * indent, self.name, self.uid, self.gid, self.mode)
     if self.is_dir:
-      print "%s%s" % ("  "*indent, self.descendants)
       print "%s%s" % ("  "*indent, self.best_subtree)
       for i in self.children:
         i.Dump(indent=indent+1)
 
+  def _Key(self):
+    # The (uid, gid, dmode, fmode, selabel, capabilities) tuple of this item.
+    uid, gid, mode, selabel, capabilities = self.metadata
+    if self.is_dir:
+      return (uid, gid, mode, None, selabel, capabilities)
+    return (uid, gid, None, mode, selabel, capabilities)
+
   def CountChildMetadata(self):
     """Count up the (uid, gid, mode, selabel, capabilities) tuples for
     all children and determine the best strategy for using set_perm_recursive
     and set_perm to correctly chown/chmod all the files to their desired
-    values.  Recursively calls itself for all descendants.
+    values.
 
     Returns a dict of {(uid, gid, dmode, fmode, selabel, capabilities): count}
     counting up all descendants of this node.  (dmode or fmode may be None.)
     Also sets the best_subtree of each directory Item to the (uid, gid, dmode,
     fmode, selabel, capabilities) tuple that will match the most descendants of
     that Item.
+
+    The tree is walked once, in post-order and without recursion. Each
+    directory's counts are added to its parent's as soon as they're
+    complete, and then dropped.
     """
 
     assert self.is_dir
-    key = (self.uid, self.gid, self.mode, None, self.selabel,
-           self.capabilities)
-    self.descendants = {key: 1}
-    d = self.descendants
-    for i in self.children:
-      if i.is_dir:
-        for k, v in i.CountChildMetadata().iteritems():
-          d[k] = d.get(k, 0) + v
-      else:
-        k = (i.uid, i.gid, None, i.mode, i.selabel, i.capabilities)
+    # (directory, iterator over its remaining children, its counts so far)
+    stack = [(self, iter(self.children), {self._Key(): 1})]
+    while True:
+      item, children, d = stack[-1]
+      for i in children:
+        if i.is_dir:
+          stack.append((i, iter(i.children), {i._Key(): 1}))
+          break
+        k = i._Key()
         d[k] = d.get(k, 0) + 1
-
-    # Find the (uid, gid, dmode, fmode, selabel, capabilities)
-    # tuple that matches the most descendants.
-
-    # First, find the (uid, gid) pair that matches the most
-    # descendants.
-    ug = {}
-    for (uid, gid, _, _, _, _), count in d.iteritems():
-      ug[(uid, gid)] = ug.get((uid, gid), 0) + count
-    ug = MostPopularKey(ug, (0, 0))
-
-    # Now find the dmode, fmode, selabel, and capabilities that match
-    # the most descendants with that (uid, gid), and choose those.
-    best_dmode = (0, 0o755)
-    best_fmode = (0, 0o644)
-    best_selabel = (0, None)
-    best_capabilities = (0, None)
-    for k, count in d.iteritems():
-      if k[:2] != ug:
-        continue
-      if k[2] is not None and count >= best_dmode[0]:
-        best_dmode = (count, k[2])
-      if k[3] is not None and count >= best_fmode[0]:
-        best_fmode = (count, k[3])
-      if k[4] is not None and count >= best_selabel[0]:
-        best_selabel = (count, k[4])
-      if k[5] is not None and count >= best_capabilities[0]:
-        best_capabilities = (count, k[5])
-    self.best_subtree = ug + (
-        best_dmode[1], best_fmode[1], best_selabel[1], best_capabilities[1])
-
-    return d
+      else:
+        stack.pop()
+        item.best_subtree = _BestSubtree(d)
+        if not stack:
+          return d
+        parent_d = stack[-1][2]
+        for k, v in d.iteritems():
+          parent_d[k] = parent_d.get(k, 0) + v
 
   def SetPermissions(self, script):
     """Append set_perm/set_perm_recursive commands to 'script' to
@@ -383,29 +521,63 @@ class Item(object):
       # that the current item (and all its children) have already been set to.
       # We only need to issue set_perm/set_perm_recursive commands if we're
       # supposed to be something different.
+      uid, gid, mode, selabel, capabilities = item.metadata
       if item.is_dir:
         if current != item.best_subtree:
           script.SetPermissionsRecursive("/"+item.name, *item.best_subtree)
           current = item.best_subtree
 
-        if item.uid != current[0] or item.gid != current[1] or \
-           item.mode != current[2] or item.selabel != current[4] or \
-           item.capabilities != current[5]:
-          script.SetPermissions("/"+item.name, item.uid, item.gid,
-                                item.mode, item.selabel, item.capabilities)
+        if uid != current[0] or gid != current[1] or \
+           mode != current[2] or selabel != current[4] or \
+           capabilities != current[5]:
+          script.SetPermissions("/"+item.name, uid, gid, mode, selabel,
+                                capabilities)
 
         for i in item.children:
           recurse(i, current)
       else:
-        if item.uid != current[0] or item.gid != current[1] or \
-               item.mode != current[3] or item.selabel != current[4] or \
-               item.capabilities != current[5]:
-          script.SetPermissions("/"+item.name, item.uid, item.gid,
-                                item.mode, item.selabel, item.capabilities)
+        if uid != current[0] or gid != current[1] or \
+               mode != current[3] or selabel != current[4] or \
+               capabilities != current[5]:
+          script.SetPermissions("/"+item.name, uid, gid, mode, selabel,
+                                capabilities)
 
     recurse(self, (-1, -1, -1, -1, None, None))
 
 
+def _BestSubtree(d):
+  # Find the (uid, gid, dmode, fmode, selabel, capabilities) tuple that
+  # matches the most descendants, given their counts 'd' (see
+  # Item.CountChildMetadata()).
+
+  # First, find the (uid, gid) pair that matches the most
+  # descendants.
+  ug = {}
+  for (uid, gid, _, _, _, _), count in d.iteritems():
+    ug[(uid, gid)] = ug.get((uid, gid), 0) + count
+  ug = MostPopularKey(ug, (0, 0))
+
+  # Now find the dmode, fmode, selabel, and capabilities that match
+  # the most descendants with that (uid, gid), and choose those.
+  best_dmode = (0, 0o755)
+  best_fmode = (0, 0o644)
+  best_selabel = (0, None)
+  best_capabilities = (0, None)
+  for k, count in d.iteritems():
+    if k[:2] != ug:
+      continue
+    if k[2] is not None and count >= best_dmode[0]:
+      best_dmode = (count, k[2])
+    if k[3] is not None and count >= best_fmode[0]:
+      best_fmode = (count, k[3])
+    if k[4] is not None and count >= best_selabel[0]:
+      best_selabel = (count, k[4])
+    if k[5] is not None and count >= best_capabilities[0]:
+      best_capabilities = (count, k[5])
+  return ug + (
+      best_dmode[1], best_fmode[1], best_selabel[1], best_capabilities[1])
+
+
 def CopyPartitionFiles(itemset, input_zip, output_zip=None, substitute=None):
   """Copies files for the partition in the input zip to the output
   zip.  Populates the Item class with their metadata, and returns a
@@ -448,8 +620,12 @@ def CopyPartitionFiles(itemset, input_zip, output_zip=None, substitute=None):
 
 
 def SignOutput(temp_zip_name, output_zip_name):
-  key_passwords = common.GetKeyPasswords([OPTIONS.package_key])
-  pw = key_passwords[OPTIONS.package_key]
+  # The password is asked for only once, also when several packages are
+  # signed (see WriteIncrementalOTAPackages()).
+  if OPTIONS.package_key not in OPTIONS.key_passwords:
+    OPTIONS.key_passwords.update(
+        common.GetKeyPasswords([OPTIONS.package_key]))
+  pw = OPTIONS.key_passwords[OPTIONS.package_key]
 
   common.SignFile(temp_zip_name, output_zip_name, OPTIONS.package_key, pw,
                   whole_file=True)
@@ -502,19 +678,37 @@ def CalculateFingerprint(oem_props, oem_dict, info_dict):
       GetBuildProp("ro.build.thumbprint", info_dict))
 
 
+# The target images loaded by LoadTargetImages(), by (which, tmpdir).
+_target_images = {}
+
+
 def GetImage(which, tmpdir, info_dict):
   # Return an image object (suitable for passing to BlockImageDiff)
   # for the 'which' partition (most be "system" or "vendor").  If a
   # prebuilt image and file map are found in tmpdir they are used,
-  # otherwise they are reconstructed from the individual files.
+  # otherwise they are reconstructed from the individual files. tmpdir
+  # may also be a common.TargetFiles, in which case a prebuilt image stored
+  # uncompressed is read straight from the zip.
 
   assert which in ("system", "vendor")
 
-  path = os.path.join(tmpdir, "IMAGES", which + ".img")
-  mappath = os.path.join(tmpdir, "IMAGES", which + ".map")
-  if os.path.exists(path) and os.path.exists(mappath):
+  image = _target_images.get((which, tmpdir))
+  if image is not None:
+    return image
+
+  if isinstance(tmpdir, common.TargetFiles):
+    target_files = tmpdir
+  else:
+    target_files = common.TargetFiles(tmpdir)
+
+  offset = 0
+  image_name = "IMAGES/%s.img" % (which,)
+  map_name = "IMAGES/%s.map" % (which,)
+  if target_files.Exists(image_name) and target_files.Exists(map_name):
     print "using %s.img from target-files" % (which,)
     # This is a 'new' target-files, which already has the image in it.
+    path, offset = target_files.Locate(image_name)
+    mappath = target_files.GetPath(map_name)
 
   else:
     print "building %s.img from target-files" % (which,)
@@ -528,10 +722,10 @@ def GetImage(which, tmpdir, info_dict):
     import add_img_to_target_files
     if which == "system":
       path = add_img_to_target_files.BuildSystem(
-          tmpdir, info_dict, block_list=mappath)
+          target_files.Extract(), info_dict, block_list=mappath)
     elif which == "vendor":
       path = add_img_to_target_files.BuildVendor(
-          tmpdir, info_dict, block_list=mappath)
+          target_files.Extract(), info_dict, block_list=mappath)
 
   # Bug: http://b/20939131
   # In ext4 filesystems, block 0 might be changed even being mounted
@@ -539,7 +733,8 @@ def GetImage(which, tmpdir, info_dict):
   # target unconditionally. Note that they are still part of care_map.
   clobbered_blocks = "0"
 
-  return sparse_img.SparseImage(path, mappath, clobbered_blocks)
+  return sparse_img.SparseImage(path, mappath, clobbered_blocks,
+                                use_mmap=True, offset=offset)
 
 
 def WriteFullOTAPackage(input_zip, output_zip):
@@ -753,20 +948,94 @@ def WriteMetadata(metadata, output_zip):
                               for kv in sorted(metadata.iteritems())]))
 
 
-def LoadPartitionFiles(z, partition):
+def UnzipPatterns():
+  """Return the patterns of the members of the target target-files that the
+  OTA needs as files: the metadata, the prebuilt images, the boot, recovery
+  and root trees to build those images from if they aren't prebuilt (ROOT
+  is also read by MakeRecoveryPatch() for system-as-root devices), the
+  radio images and the recovery resources. The partition files themselves
+  are read from the zip. Returns None (all the members) with
+  OPTIONS.log_diff, which compares the whole trees.
+
+  The device-specific code may need more; see OPTIONS.device_unzip_patterns.
+  """
+  if OPTIONS.log_diff:
+    return None
+  return ["META/*", "IMAGES/*", "BOOTABLE_IMAGES/*", "BOOT/*", "RECOVERY/*",
+          "ROOT/*", "RADIO/*", "SYSTEM/etc/recovery-resource.dat"]
+
+
+def LoadPartitionFiles(z, partition, manifest=None):
   """Load all the files from the given partition in a given target-files
-  ZipFile, and return a dict of {filename: File object}."""
+  ZipFile, and return a dict of {filename: File object}.
+
+  The files are common.LazyFile objects that read their contents from the
+  zip only when needed. Their SHA-1s are taken from 'manifest' (see
+  LoadFileManifest()) if it has them."""
+  if manifest is None:
+    manifest = {}
   out = {}
   prefix = partition.upper() + "/"
   for info in z.infolist():
     if info.filename.startswith(prefix) and not IsSymlink(info):
       basefilename = info.filename[len(prefix):]
       fn = partition + "/" + basefilename
-      data = z.read(info.filename)
-      out[fn] = common.File(fn, data)
+      out[fn] = common.LazyFile.FromZip(
+          fn, z, info, manifest.get(_FileManifestKey(info)))
   return out
 
 
+def _FileManifestKey(info):
+  # The zip members are identified by their name, CRC-32 and size in the
+  # central directory, which doesn't take reading them.
+  return info.filename, info.CRC, info.file_size
+
+
+def _FileManifestPath():
+  # Return the path of the file manifest in OPTIONS.work_dir, or None
+  # without a work_dir.
+  if OPTIONS.work_dir is None:
+    return None
+  return os.path.join(OPTIONS.work_dir, "filesha1s")
+
+
+def LoadFileManifest():
+  """Return the manifest saved by SaveFileManifest(), a dict of the SHA-1s
+  of target-files zip members by (name, CRC-32, size), or {} if there's
+  none (or no OPTIONS.work_dir)."""
+  path = _FileManifestPath()
+  manifest = {}
+  if path is None or not os.path.exists(path):
+    return manifest
+  with open(path) as f:
+    for line in f:
+      digest, crc, size, name = line.rstrip("\n").split(" ", 3)
+      manifest[(name, int(crc), int(size))] = digest
+  return manifest
+
+
+def SaveFileManifest(z, partition, files):
+  """Add the SHA-1s known so far of the LazyFiles 'files' of 'partition'
+  from the target-files ZipFile 'z' to the manifest in OPTIONS.work_dir, so
+  that later runs don't need to read the files to get them."""
+  path = _FileManifestPath()
+  if path is None:
+    return
+  manifest = LoadFileManifest()
+  prefix = partition.upper() + "/"
+  for f in files:
+    if f.HasSha1():
+      info = z.getinfo(prefix + f.name[len(partition) + 1:])
+      manifest[_FileManifestKey(info)] = f.sha1
+  # Concurrent runs may share the work dir; write to a temp file and rename
+  # it into place.
+  fd, temp_path = tempfile.mkstemp(prefix=".filesha1s-", dir=OPTIONS.work_dir)
+  with os.fdopen(fd, "w") as f:
+    for key in sorted(manifest):
+      f.write("%s %d %d %s\n" % ((manifest[key],) + key[1:] + key[:1]))
+  os.rename(temp_path, path)
+
+
 def GetBuildProp(prop, info_dict):
   """Return the fingerprint of the build of a given target-files info_dict."""
   try:
@@ -861,7 +1130,7 @@ def WriteBlockIncrementalOTAPackage(target_zip, source_zip, output_zip):
       "ro.build.version.incremental", OPTIONS.target_info_dict)
 
   source_boot = common.GetBootableImage(
-      "/tmp/boot.img", "boot.img", OPTIONS.source_tmp, "BOOT",
+      "/tmp/boot.img", "boot.img", OPTIONS.source_target_files, "BOOT",
       OPTIONS.source_info_dict)
   target_boot = common.GetBootableImage(
       "/tmp/boot.img", "boot.img", OPTIONS.target_tmp, "BOOT")
@@ -871,7 +1140,8 @@ def WriteBlockIncrementalOTAPackage(target_zip, source_zip, output_zip):
   target_recovery = common.GetBootableImage(
       "/tmp/recovery.img", "recovery.img", OPTIONS.target_tmp, "RECOVERY")
 
-  system_src = GetImage("system", OPTIONS.source_tmp, OPTIONS.source_info_dict)
+  system_src = GetImage("system", OPTIONS.source_target_files,
+                        OPTIONS.source_info_dict)
   system_tgt = GetImage("system", OPTIONS.target_tmp, OPTIONS.target_info_dict)
 
   blockimgdiff_version = 1
@@ -894,12 +1164,13 @@ def WriteBlockIncrementalOTAPackage(target_zip, source_zip, output_zip):
   system_diff = common.BlockDifference("system", system_tgt, system_src,
                                        check_first_block,
                                        version=blockimgdiff_version,
-                                       disable_imgdiff=disable_imgdiff)
+                                       disable_imgdiff=disable_imgdiff,
+                                       compute=False)
 
   if HasVendorPartition(target_zip):
     if not HasVendorPartition(source_zip):
       raise RuntimeError("can't generate incremental that adds /vendor")
-    vendor_src = GetImage("vendor", OPTIONS.source_tmp,
+    vendor_src = GetImage("vendor", OPTIONS.source_target_files,
                           OPTIONS.source_info_dict)
     vendor_tgt = GetImage("vendor", OPTIONS.target_tmp,
                           OPTIONS.target_info_dict)
@@ -912,10 +1183,16 @@ def WriteBlockIncrementalOTAPackage(target_zip, source_zip, output_zip):
     vendor_diff = common.BlockDifference("vendor", vendor_tgt, vendor_src,
                                          check_first_block,
                                          version=blockimgdiff_version,
-                                         disable_imgdiff=disable_imgdiff)
+                                         disable_imgdiff=disable_imgdiff,
+                                         compute=False)
   else:
     vendor_diff = None
 
+  # The partitions are computed concurrently; the scripts below are still
+  # written one partition after the other.
+  common.ComputeBlockDifferences(
+      [d for d in (system_diff, vendor_diff) if d is not None])
+
   AppendAssertions(script, OPTIONS.target_info_dict, oem_dict)
   device_specific.IncrementalOTA_Assertions()
 
@@ -1343,10 +1620,13 @@ def WriteABOTAPackageWithBrilloScript(target_file, output_file,
 class FileDifference(object):
   def __init__(self, partition, source_zip, target_zip, output_zip):
     self.deferred_patch_list = None
+    manifest = LoadFileManifest()
     print "Loading target..."
-    self.target_data = target_data = LoadPartitionFiles(target_zip, partition)
+    self.target_data = target_data = LoadPartitionFiles(
+        target_zip, partition, manifest)
     print "Loading source..."
-    self.source_data = source_data = LoadPartitionFiles(source_zip, partition)
+    self.source_data = source_data = LoadPartitionFiles(
+        source_zip, partition, manifest)
 
     self.verbatim_targets = verbatim_targets = []
     self.patch_list = patch_list = []
@@ -1355,22 +1635,16 @@ class FileDifference(object):
     known_paths = set()
     largest_source_size = 0
 
-    matching_file_cache = {}
-    for fn, sf in source_data.items():
+    for fn, sf in source_data.iteritems():
       assert fn == sf.name
-      matching_file_cache["path:" + fn] = sf
-      if fn in target_data.keys():
+      if fn in target_data:
         AddToKnownPaths(fn, known_paths)
-      # Only allow eligibility for filename/sha matching
-      # if there isn't a perfect path match.
-      if target_data.get(sf.name) is None:
-        matching_file_cache["file:" + fn.split("/")[-1]] = sf
-        matching_file_cache["sha:" + sf.sha1] = sf
+    matcher = FileMatcher(source_data, target_data)
 
-    for fn in sorted(target_data.keys()):
+    for fn in sorted(target_data):
       tf = target_data[fn]
       assert fn == tf.name
-      sf = ClosestFileMatch(tf, matching_file_cache, renames)
+      sf = matcher.Match(tf, renames)
       if sf is not None and sf.name != tf.name:
         print "File has moved from " + sf.name + " to " + tf.name
         renames[sf.name] = tf
@@ -1382,14 +1656,16 @@ class FileDifference(object):
         print "send", fn, "verbatim"
         tf.AddToZip(output_zip)
         verbatim_targets.append((fn, tf.size, tf.sha1))
-        if fn in target_data.keys():
-          AddToKnownPaths(fn, known_paths)
+        AddToKnownPaths(fn, known_paths)
       elif tf.sha1 != sf.sha1:
         # File is different; consider sending as a patch
         diffs.append(common.Difference(tf, sf))
       else:
         # Target file data identical to source (may still be renamed)
         pass
+    print ("matched %(path)d files by path, %(sha1)d by sha1, %(basename)d "
+           "by basename, %(similar)d by similar name; %(none)d unmatched" %
+           matcher.counts)
 
     common.ComputeDifferences(diffs)
 
@@ -1413,6 +1689,9 @@ class FileDifference(object):
 
     self.largest_source_size = largest_source_size
 
+    SaveFileManifest(target_zip, partition, target_data.values())
+    SaveFileManifest(source_zip, partition, source_data.values())
+
   def EmitVerification(self, script):
     so_far = 0
     for tf, sf, _, _ in self.patch_list:
@@ -1567,7 +1846,7 @@ def WriteIncrementalOTAPackage(target_zip, source_zip, output_zip):
       "ro.build.version.incremental", OPTIONS.target_info_dict)
 
   source_boot = common.GetBootableImage(
-      "/tmp/boot.img", "boot.img", OPTIONS.source_tmp, "BOOT",
+      "/tmp/boot.img", "boot.img", OPTIONS.source_target_files, "BOOT",
       OPTIONS.source_info_dict)
   target_boot = common.GetBootableImage(
       "/tmp/boot.img", "boot.img", OPTIONS.target_tmp, "BOOT")
@@ -1575,8 +1854,8 @@ def WriteIncrementalOTAPackage(target_zip, source_zip, output_zip):
                    (source_boot.data != target_boot.data))
 
   source_recovery = common.GetBootableImage(
-      "/tmp/recovery.img", "recovery.img", OPTIONS.source_tmp, "RECOVERY",
-      OPTIONS.source_info_dict)
+      "/tmp/recovery.img", "recovery.img", OPTIONS.source_target_files,
+      "RECOVERY", OPTIONS.source_info_dict)
   target_recovery = common.GetBootableImage(
       "/tmp/recovery.img", "recovery.img", OPTIONS.target_tmp, "RECOVERY")
   updating_recovery = (source_recovery.data != target_recovery.data)
@@ -1893,6 +2172,220 @@ endif;
   WriteMetadata(metadata, output_zip)
 
 
+def WriteOTAPackage(input_zip, output_file):
+  """Write the package for the target-files in 'input_zip' (unzipped in
+  OPTIONS.input_tmp) to 'output_file': a verify package, a full OTA, or an
+  incremental OTA from OPTIONS.incremental_source."""
+
+  # Set up the output zip. Create a temporary zip file if signing is needed.
+  if OPTIONS.no_signing:
+    if os.path.exists(output_file):
+      os.unlink(output_file)
+    output_zip = zipfile.ZipFile(output_file, "w",
+                                 compression=zipfile.ZIP_DEFLATED)
+  else:
+    temp_zip_file = tempfile.NamedTemporaryFile()
+    output_zip = zipfile.ZipFile(temp_zip_file, "w",
+                                 compression=zipfile.ZIP_DEFLATED)
+
+  # Generate a verify package.
+  if OPTIONS.gen_verify:
+    WriteVerifyPackage(input_zip, output_zip)
+
+  # Generate a full OTA.
+  elif OPTIONS.incremental_source is None:
+    WriteFullOTAPackage(input_zip, output_zip)
+
+  # Generate an incremental OTA. It will fall back to generate a full OTA on
+  # failure unless no_fallback_to_full is specified.
+  else:
+    # The source is read from the zip; only the files that some tools (or the
+    # device-specific code) need in a directory get unzipped, into
+    # OPTIONS.source_tmp.
+    source_files = common.TargetFiles(OPTIONS.incremental_source)
+    OPTIONS.source_target_files = source_files
+    OPTIONS.source_tmp = source_files.Extract(OPTIONS.device_unzip_patterns)
+    source_zip = source_files.input_zip
+    OPTIONS.target_info_dict = OPTIONS.info_dict
+    OPTIONS.source_info_dict = common.LoadInfoDict(source_files, source_files)
+    if OPTIONS.verbose:
+      print "--- source info ---"
+      common.DumpInfoDict(OPTIONS.source_info_dict)
+    try:
+      WriteIncrementalOTAPackage(input_zip, source_zip, output_zip)
+      if OPTIONS.log_diff:
+        out_file = open(OPTIONS.log_diff, 'w')
+        import target_files_diff
+        target_files_diff.recursiveDiff('',
+                                        source_files.Extract(),
+                                        OPTIONS.input_tmp,
+                                        out_file)
+        out_file.close()
+    except ValueError:
+      if not OPTIONS.fallback_to_full:
+        raise
+      print "--- failed to build incremental; falling back to full ---"
+      OPTIONS.incremental_source = None
+      WriteFullOTAPackage(input_zip, output_zip)
+
+  common.ZipClose(output_zip)
+
+  # Sign the generated zip package unless no_signing is specified.
+  if not OPTIONS.no_signing:
+    SignOutput(temp_zip_file.name, output_file)
+    temp_zip_file.close()
+
+
+def LoadTargetImages(target_zip):
+  """Load the target images and hash all of their blocks, so that every
+  incremental OTA generated from the same target reuses them (see
+  GetImage())."""
+  if not OPTIONS.block_based or not HasRecoveryPatch(target_zip):
+    return
+  partitions = ["system"]
+  if HasVendorPartition(target_zip):
+    partitions.append("vendor")
+  for which in partitions:
+    image = GetImage(which, OPTIONS.target_tmp, OPTIONS.target_info_dict)
+    image.BuildHashIndex()
+    _target_images[(which, OPTIONS.target_tmp)] = image
+
+
+def _WriteIncrementalFromSource(task, conn):
+  # Generate one of the packages of WriteIncrementalOTAPackages(), in a
+  # process forked once the target has been loaded. Sends the patch cache
+  # hits and misses of this package (or the exception) back through 'conn'.
+  target_file, source_file, output_file = task
+  OPTIONS.incremental_source = source_file
+  cache = OPTIONS.patch_cache
+  if cache is not None:
+    hits, misses = cache.hits, cache.misses
+
+  # The target files belong to the parent process.
+  tempfiles = OPTIONS.tempfiles
+  OPTIONS.tempfiles = []
+  try:
+    if OPTIONS.info_dict.get("ab_update") == "true":
+      source_zip = zipfile.ZipFile(source_file, "r")
+      OPTIONS.source_info_dict = common.LoadInfoDict(source_zip)
+      common.ZipClose(source_zip)
+      WriteABOTAPackageWithBrilloScript(target_file=target_file,
+                                        output_file=output_file,
+                                        source_file=source_file)
+    else:
+      # Don't share the file offset of the parent's zip file.
+      input_zip = zipfile.ZipFile(target_file, "r")
+      WriteOTAPackage(input_zip, output_file)
+      common.ZipClose(input_zip)
+    stats = (0, 0)
+    if cache is not None:
+      stats = (cache.hits - hits, cache.misses - misses)
+    conn.send((True, stats))
+  except Exception as e: # pylint: disable=broad-except
+    traceback.print_exc()
+    conn.send((False, e))
+  finally:
+    common.Cleanup()
+    OPTIONS.tempfiles = tempfiles
+  conn.close()
+
+
+def WriteIncrementalOTAPackages(target_file, output_dir):
+  """Write an incremental OTA from each of OPTIONS.incremental_sources to
+  'target_file' into 'output_dir'.
+
+  Each package is generated in a child process of its own, forked from this
+  one after the target has been loaded (see LoadTargetImages()), so the
+  packages don't see each other's OPTIONS, and up to OPTIONS.source_jobs of
+  them at a time. The children compute their partitions in children of
+  their own as usual (see common.ComputeBlockDifferences()), and all of
+  them submit their block diffs to a single diff_pool.DiffPool, so that the
+  patches the packages have in common are only computed once."""
+  tasks = []
+  outputs = set()
+  for source_file in OPTIONS.incremental_sources:
+    name = os.path.splitext(os.path.basename(source_file))[0]
+    output_file = os.path.join(output_dir, name + "-incremental.zip")
+    if output_file in outputs:
+      raise ValueError("Several incremental sources are named %s" %
+                       (os.path.basename(source_file),))
+    outputs.add(output_file)
+    tasks.append((target_file, source_file, output_file))
+  if not os.path.isdir(output_dir):
+    os.makedirs(output_dir)
+
+  # Ask for the password before forking. A/B packages are always signed.
+  ab_update = OPTIONS.info_dict.get("ab_update") == "true"
+  if OPTIONS.package_key is None:
+    OPTIONS.package_key = OPTIONS.info_dict.get(
+        "default_system_dev_certificate",
+        "build/target/product/security/testkey")
+  if ab_update or not OPTIONS.no_signing:
+    OPTIONS.key_passwords.update(
+        common.GetKeyPasswords([OPTIONS.package_key]))
+
+  jobs = OPTIONS.source_jobs
+  if jobs is None:
+    jobs = max(1, multiprocessing.cpu_count() // OPTIONS.worker_threads)
+  jobs = min(jobs, len(tasks))
+
+  manager = diff_pool.DiffManager()
+  manager.start()
+  task_iter = iter(tasks)
+  children = []
+  try:
+    # As many diffs at a time as the packages used to run each on their own.
+    # The diffs are told apart by their patch cache keys.
+    if OPTIONS.patch_cache is not None:
+      OPTIONS.diff_pool = manager.DiffPool(jobs * OPTIONS.worker_threads,
+                                           OPTIONS.patch_cache.cache_dir,
+                                           OPTIONS.patch_cache.max_size)
+    while True:
+      for task in task_iter:
+        recv_conn, send_conn = multiprocessing.Pipe(False)
+        p = multiprocessing.Process(target=_WriteIncrementalFromSource,
+                                    args=(task, send_conn))
+        p.start()
+        send_conn.close()
+        children.append((task[2], p, recv_conn))
+        if len(children) == jobs:
+          break
+      if not children:
+        break
+
+      # Wait for any of the packages to be done.
+      done = None
+      while done is None:
+        for child in children:
+          if child[2].poll(0.1):
+            done = child
+            break
+      children.remove(done)
+      output_file, p, conn = done
+      try:
+        result = conn.recv()
+      except EOFError:
+        result = None
+      p.join()
+      if result is None:
+        raise common.ExternalError("failed to write %s (exit %s)" %
+                                   (output_file, p.exitcode))
+      ok, value = result
+      if not ok:
+        raise value
+      print "wrote %s" % (output_file,)
+      if OPTIONS.patch_cache is not None:
+        OPTIONS.patch_cache.hits += value[0]
+        OPTIONS.patch_cache.misses += value[1]
+  finally:
+    for _, p, _ in children:
+      if p.is_alive():
+        p.terminate()
+        p.join()
+    OPTIONS.diff_pool = None
+    manager.shutdown()
+
+
 def main(argv):
 
   def option_handler(o, a):
@@ -1902,6 +2395,7 @@ def main(argv):
       OPTIONS.package_key = a
     elif o in ("-i", "--incremental_from"):
       OPTIONS.incremental_source = a
+      OPTIONS.incremental_sources.append(a)
     elif o == "--full_radio":
       OPTIONS.full_radio = True
     elif o == "--full_bootloader":
@@ -1930,6 +2424,24 @@ def main(argv):
       else:
         raise ValueError("Cannot parse value %r for option %r - only "
                          "integers are allowed." % (a, o))
+    elif o == "--diff_timeout":
+      try:
+        OPTIONS.diff_timeout = float(a)
+      except ValueError:
+        raise ValueError("Cannot parse value %r for option %r - expecting "
+                         "a float" % (a, o))
+    elif o == "--diff_max_bytes":
+      if a.isdigit():
+        OPTIONS.diff_max_bytes = int(a)
+      else:
+        raise ValueError("Cannot parse value %r for option %r - only "
+                         "integers are allowed." % (a, o))
+    elif o == "--source_jobs":
+      if a.isdigit() and int(a) > 0:
+        OPTIONS.source_jobs = int(a)
+      else:
+        raise ValueError("Cannot parse value %r for option %r - only "
+                         "positive integers are allowed." % (a, o))
     elif o in ("-2", "--two_step"):
       OPTIONS.two_step = True
     elif o == "--no_signing":
@@ -1948,6 +2460,30 @@ def main(argv):
       except ValueError:
         raise ValueError("Cannot parse value %r for option %r - expecting "
                          "a float" % (a, o))
+    elif o == "--stash_reorder_rounds":
+      try:
+        OPTIONS.stash_reorder_rounds = int(a)
+      except ValueError:
+        raise ValueError("Cannot parse value %r for option %r - expecting "
+                         "an integer" % (a, o))
+    elif o == "--stash_reorder_time":
+      try:
+        OPTIONS.stash_reorder_time = float(a)
+      except ValueError:
+        raise ValueError("Cannot parse value %r for option %r - expecting "
+                         "a float" % (a, o))
+    elif o == "--adaptive_split":
+      OPTIONS.adaptive_split = True
+    elif o == "--patch_cache":
+      OPTIONS.patch_cache_dir = a
+    elif o == "--patch_cache_size":
+      if a.isdigit():
+        OPTIONS.patch_cache_size = int(a)
+      else:
+        raise ValueError("Cannot parse value %r for option %r - only "
+                         "integers are allowed." % (a, o))
+    elif o == "--work_dir":
+      OPTIONS.work_dir = os.path.abspath(a)
     elif o == "--gen_verify":
       OPTIONS.gen_verify = True
     elif o == "--log_diff":
@@ -1975,6 +2511,9 @@ def main(argv):
                                  "downgrade",
                                  "extra_script=",
                                  "worker_threads=",
+                                 "diff_timeout=",
+                                 "diff_max_bytes=",
+                                 "source_jobs=",
                                  "aslr_mode=",
                                  "two_step",
                                  "no_signing",
@@ -1985,6 +2524,12 @@ def main(argv):
                                  "verify",
                                  "no_fallback_to_full",
                                  "stash_threshold=",
+                                 "stash_reorder_rounds=",
+                                 "stash_reorder_time=",
+                                 "adaptive_split",
+                                 "patch_cache=",
+                                 "patch_cache_size=",
+                                 "work_dir=",
                                  "gen_verify",
                                  "log_diff=",
                                  "override_device=",
@@ -2008,6 +2553,27 @@ def main(argv):
       raise ValueError("Cannot generate downgradable full OTAs - consider"
                        "using --omit_prereq?")
 
+  multi_source = len(OPTIONS.incremental_sources) > 1
+  if multi_source:
+    if OPTIONS.gen_verify or OPTIONS.log_diff:
+      raise ValueError("--gen_verify and --log_diff can't be used with "
+                       "several incremental sources")
+    if OPTIONS.patch_cache_dir is None and OPTIONS.work_dir is None:
+      # The packages are generated in separate processes, which share the
+      # patches through the cache.
+      OPTIONS.patch_cache_dir = tempfile.mkdtemp(prefix="patch_cache-")
+      OPTIONS.tempfiles.append(OPTIONS.patch_cache_dir)
+
+  if OPTIONS.work_dir is not None:
+    if not os.path.isdir(OPTIONS.work_dir):
+      os.makedirs(OPTIONS.work_dir)
+    if OPTIONS.patch_cache_dir is None:
+      OPTIONS.patch_cache_dir = os.path.join(OPTIONS.work_dir, "patch_cache")
+
+  if OPTIONS.patch_cache_dir is not None:
+    OPTIONS.patch_cache = patch_cache.PatchCache(OPTIONS.patch_cache_dir,
+                                                 OPTIONS.patch_cache_size)
+
   # Load the dict file from the zip directly to have a peek at the OTA type.
   # For packages using A/B update, unzipping is not needed.
   input_zip = zipfile.ZipFile(args[0], "r")
@@ -2016,6 +2582,12 @@ def main(argv):
 
   ab_update = OPTIONS.info_dict.get("ab_update") == "true"
 
+  if ab_update and multi_source:
+    OPTIONS.target_info_dict = OPTIONS.info_dict
+    WriteIncrementalOTAPackages(args[0], args[1])
+    print "done."
+    return
+
   if ab_update:
     if OPTIONS.incremental_source is not None:
       OPTIONS.target_info_dict = OPTIONS.info_dict
@@ -2043,7 +2615,14 @@ def main(argv):
     OPTIONS.extra_script = open(OPTIONS.extra_script).read()
 
   print "unzipping target target-files..."
-  OPTIONS.input_tmp, input_zip = common.UnzipTemp(args[0])
+  OPTIONS.input_tmp, input_zip = common.UnzipTemp(args[0], UnzipPatterns())
+  # Old target-files have no prebuilt images; those get built from the
+  # partition trees.
+  names = set(input_zip.namelist())
+  partitions = [p.upper() + "/*" for p in ("system", "vendor")
+                if "IMAGES/%s.img" % (p,) not in names]
+  if partitions and not OPTIONS.log_diff:
+    common.UnzipToDir(input_zip.filename, OPTIONS.input_tmp, partitions)
 
   OPTIONS.target_tmp = OPTIONS.input_tmp
   OPTIONS.info_dict = common.LoadInfoDict(input_zip, OPTIONS.target_tmp)
@@ -2070,6 +2649,15 @@ def main(argv):
   if OPTIONS.device_specific is not None:
     OPTIONS.device_specific = os.path.abspath(OPTIONS.device_specific)
 
+    # The device-specific code may read any member from the unzipped
+    # directory; unzip the ones it asks for, or all of them.
+    if not OPTIONS.log_diff:
+      device_specific = common.DeviceSpecificParams()
+      if device_specific.module is not None:
+        OPTIONS.device_unzip_patterns = device_specific.UnzipPatterns()
+        common.UnzipToDir(input_zip.filename, OPTIONS.input_tmp,
+                          OPTIONS.device_unzip_patterns)
+
   if OPTIONS.info_dict.get("no_recovery") == "true":
     raise common.ExternalError(
         "--- target build has specified no recovery ---")
@@ -2081,66 +2669,23 @@ def main(argv):
           "default_system_dev_certificate",
           "build/target/product/security/testkey")
 
-  # Set up the output zip. Create a temporary zip file if signing is needed.
-  if OPTIONS.no_signing:
-    if os.path.exists(args[1]):
-      os.unlink(args[1])
-    output_zip = zipfile.ZipFile(args[1], "w",
-                                 compression=zipfile.ZIP_DEFLATED)
-  else:
-    temp_zip_file = tempfile.NamedTemporaryFile()
-    output_zip = zipfile.ZipFile(temp_zip_file, "w",
-                                 compression=zipfile.ZIP_DEFLATED)
-
   # Non A/B OTAs rely on /cache partition to store temporary files.
   cache_size = OPTIONS.info_dict.get("cache_size", None)
   if cache_size is None:
     print "--- can't determine the cache partition size ---"
   OPTIONS.cache_size = cache_size
 
-  # Generate a verify package.
-  if OPTIONS.gen_verify:
-    WriteVerifyPackage(input_zip, output_zip)
-
-  # Generate a full OTA.
-  elif OPTIONS.incremental_source is None:
-    WriteFullOTAPackage(input_zip, output_zip)
-
-  # Generate an incremental OTA. It will fall back to generate a full OTA on
-  # failure unless no_fallback_to_full is specified.
-  else:
-    print "unzipping source target-files..."
-    OPTIONS.source_tmp, source_zip = common.UnzipTemp(
-        OPTIONS.incremental_source)
+  if multi_source:
     OPTIONS.target_info_dict = OPTIONS.info_dict
-    OPTIONS.source_info_dict = common.LoadInfoDict(source_zip,
-                                                   OPTIONS.source_tmp)
-    if OPTIONS.verbose:
-      print "--- source info ---"
-      common.DumpInfoDict(OPTIONS.source_info_dict)
-    try:
-      WriteIncrementalOTAPackage(input_zip, source_zip, output_zip)
-      if OPTIONS.log_diff:
-        out_file = open(OPTIONS.log_diff, 'w')
-        import target_files_diff
-        target_files_diff.recursiveDiff('',
-                                        OPTIONS.source_tmp,
-                                        OPTIONS.input_tmp,
-                                        out_file)
-        out_file.close()
-    except ValueError:
-      if not OPTIONS.fallback_to_full:
-        raise
-      print "--- failed to build incremental; falling back to full ---"
-      OPTIONS.incremental_source = None
-      WriteFullOTAPackage(input_zip, output_zip)
-
-  common.ZipClose(output_zip)
+    LoadTargetImages(input_zip)
+    WriteIncrementalOTAPackages(args[0], args[1])
+  else:
+    WriteOTAPackage(input_zip, args[1])
 
-  # Sign the generated zip package unless no_signing is specified.
-  if not OPTIONS.no_signing:
-    SignOutput(temp_zip_file.name, args[1])
-    temp_zip_file.close()
+  if OPTIONS.patch_cache is not None:
+    print "patch cache: %d hits, %d misses" % (OPTIONS.patch_cache.hits,
+                                               OPTIONS.patch_cache.misses)
+    OPTIONS.patch_cache.Trim()
 
   print "done."
 
@@ -0,0 +1,154 @@
+# Copyright (C) 2016 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import errno
+import fcntl
+import os
+import tempfile
+import threading
+from hashlib import sha1
+
+__all__ = ["PatchCache"]
+
+
+class PatchCache(object):
+  """A content-addressed on-disk cache of computed patches.
+
+  Entries are keyed by the SHA-1 of the source and target data together with
+  the diff command line, so a given (source, target) pair only needs to be
+  diffed once, e.g. when generating incrementals from several source builds
+  to the same target.
+
+  The cache directory can be shared by concurrent OTA runs. Entries are
+  written to a temp file and renamed into place, so readers never see partial
+  data, and trimming the cache is done under an exclusive lock. Reading an
+  entry refreshes its mtime; once the cache grows beyond max_size bytes, the
+  least recently used entries are evicted first.
+  """
+
+  DEFAULT_MAX_SIZE = 10 * (1 << 30)
+
+  def __init__(self, cache_dir, max_size=None):
+    self.cache_dir = cache_dir
+    self.max_size = self.DEFAULT_MAX_SIZE if max_size is None else max_size
+    self.hits = 0
+    self.misses = 0
+    self._lock = threading.Lock()
+    self._added_size = 0
+    if not os.path.isdir(cache_dir):
+      try:
+        os.makedirs(cache_dir)
+      except OSError as e:
+        if e.errno != errno.EEXIST:
+          raise
+
+  @staticmethod
+  def Key(src_sha1, tgt_sha1, cmd):
+    """Return the cache key for patching src into tgt with the diff command
+    'cmd' (the list of program name and options, without the filenames)."""
+    ctx = sha1()
+    ctx.update("%s\0%s\0" % (src_sha1, tgt_sha1))
+    ctx.update("\0".join(cmd))
+    return ctx.hexdigest()
+
+  def _Path(self, key):
+    return os.path.join(self.cache_dir, key[:2], key[2:])
+
+  def Get(self, key):
+    """Return the cached patch for 'key', or None if it's not cached."""
+    path = self._Path(key)
+    try:
+      with open(path, "rb") as f:
+        data = f.read()
+    except IOError as e:
+      if e.errno != errno.ENOENT:
+        raise
+      with self._lock:
+        self.misses += 1
+      return None
+
+    # Mark the entry as recently used. It may have been evicted by another
+    # process in the meantime, which is fine since we already have the data.
+    try:
+      os.utime(path, None)
+    except OSError:
+      pass
+    with self._lock:
+      self.hits += 1
+    return data
+
+  def Put(self, key, data):
+    """Store 'data' as the patch for 'key'."""
+    path = self._Path(key)
+    dirname = os.path.dirname(path)
+    if not os.path.isdir(dirname):
+      try:
+        os.makedirs(dirname)
+      except OSError as e:
+        if e.errno != errno.EEXIST:
+          raise
+
+    fd, temp_path = tempfile.mkstemp(prefix=".tmp-", dir=dirname)
+    try:
+      with os.fdopen(fd, "wb") as f:
+        f.write(data)
+      os.rename(temp_path, path)
+    except:
+      os.unlink(temp_path)
+      raise
+
+    # Trim the cache every time it may have grown by 1/16 of its limit, so
+    # that it stays bounded during long runs without rescanning it each time.
+    with self._lock:
+      self._added_size += len(data)
+      trim = self._added_size > self.max_size / 16
+      if trim:
+        self._added_size = 0
+    if trim:
+      self.Trim()
+
+  def Trim(self):
+    """Evict the least recently used entries until the cache fits in
+    max_size bytes."""
+    with open(os.path.join(self.cache_dir, ".lock"), "a") as lock_file:
+      fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+      try:
+        entries = []
+        total = 0
+        for dirpath, _, filenames in os.walk(self.cache_dir):
+          for fn in filenames:
+            if fn.startswith("."):
+              continue
+            path = os.path.join(dirpath, fn)
+            try:
+              st = os.stat(path)
+            except OSError:
+              continue
+            entries.append((st.st_mtime, path, st.st_size))
+            total += st.st_size
+
+        if total <= self.max_size:
+          return
+
+        entries.sort()
+        for _, path, size in entries:
+          try:
+            os.unlink(path)
+          except OSError:
+            continue
+          total -= size
+          if total <= self.max_size:
+            break
+      finally:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
@@ -13,6 +13,8 @@
 # limitations under the License.
 
 from __future__ import print_function
+import array
+import bisect
 import heapq
 import itertools
 
@@ -21,22 +23,43 @@ __all__ = ["RangeSet"]
 class RangeSet(object):
   """A RangeSet represents a set of nonoverlapping ranges on the
   integers (ie, a set of integers, but efficient when the set contains
-  lots of runs."""
+  lots of runs.
+
+  The ranges are stored as a flat array of their boundaries, [start0, end0,
+  start1, end1, ...], which the set operations search with bisect, so that
+  combining a small RangeSet with a large one only touches the ranges of the
+  large one that are near the small one."""
+
+  # Signed 64-bit on the LP64 hosts the tools run on (Python 2's array module
+  # has no 'q' type code).
+  TYPECODE = "l"
 
   def __init__(self, data=None):
     self.monotonic = False
+    self._size = None
     if isinstance(data, str):
       self._parse_internal(data)
     elif data:
       assert len(data) % 2 == 0
-      self.data = tuple(self._remove_pairs(data))
+      self.data = array.array(self.TYPECODE, self._remove_pairs(data))
       self.monotonic = all(x < y for x, y in zip(self.data, self.data[1:]))
     else:
-      self.data = ()
+      self.data = array.array(self.TYPECODE)
+
+  @classmethod
+  def _from_array(cls, data):
+    """Wrap an array of boundaries that's already sorted and free of empty
+    or adjacent ranges, without going through __init__."""
+    out = cls.__new__(cls)
+    out.data = data
+    out.monotonic = bool(data)
+    out._size = None
+    return out
 
   def __iter__(self):
-    for i in range(0, len(self.data), 2):
-      yield self.data[i:i+2]
+    data = self.data
+    for i in range(0, len(data), 2):
+      yield data[i], data[i+1]
 
   def __eq__(self, other):
     return self.data == other.data
@@ -93,7 +116,7 @@ class RangeSet(object):
         else:
           monotonic = False
     data.sort()
-    self.data = tuple(self._remove_pairs(data))
+    self.data = array.array(self.TYPECODE, self._remove_pairs(data))
     self.monotonic = monotonic
 
   @staticmethod
@@ -135,14 +158,63 @@ class RangeSet(object):
     >>> RangeSet("10-19 30-34").union(RangeSet("22 32"))
     <RangeSet("10-19 22 30-34")>
     """
-    out = []
-    z = 0
-    for p, d in heapq.merge(zip(self.data, itertools.cycle((+1, -1))),
-                            zip(other.data, itertools.cycle((+1, -1)))):
-      if (z == 0 and d == 1) or (z == 1 and d == -1):
-        out.append(p)
-      z += d
-    return RangeSet(data=out)
+    # Walk the ranges of the smaller set, copying the ranges of the larger
+    # one in between wholesale.
+    a, b = self.data, other.data
+    if len(a) < len(b):
+      a, b = b, a
+
+    out = array.array(self.TYPECODE)
+    pos = 0
+    for k in range(0, len(b), 2):
+      s, e = b[k], b[k+1]
+      i = bisect.bisect_left(a, s, max(pos - 1, 0))
+      if i & 1:
+        # s is inside a range of 'a' (or right at its end); start there.
+        i -= 1
+        start = a[i]
+      else:
+        start = s
+      j = bisect.bisect_right(a, e, i)
+      if j & 1:
+        # e is inside a range of 'a' (or right at its start); end there.
+        end = a[j]
+        j += 1
+      else:
+        end = e
+
+      if i < pos:
+        # Merges with the range we produced last.
+        if end > out[-1]:
+          out[-1] = end
+      else:
+        out.extend(a[pos:i])
+        out.append(start)
+        out.append(end)
+      pos = j
+    out.extend(a[pos:])
+    return RangeSet._from_array(out)
+
+  @classmethod
+  def union_all(cls, rangesets):
+    """Return a new RangeSet representing the union of all the RangeSets in
+    'rangesets', in one pass rather than one union() per RangeSet.
+
+    >>> RangeSet.union_all([RangeSet("10-19"), RangeSet("30-34"),
+    ...                     RangeSet("18-29 40")])
+    <RangeSet("10-34 40")>
+    >>> RangeSet.union_all([])
+    <RangeSet("")>
+    """
+    out = array.array(cls.TYPECODE)
+    for s, e in sorted(itertools.chain.from_iterable(rangesets)):
+      if out and s <= out[-1]:
+        if e > out[-1]:
+          out[-1] = e
+      else:
+        out.append(s)
+        out.append(e)
+    return cls._from_array(out)
 
   def intersect(self, other):
     """Return a new RangeSet representing the intersection of this
@@ -153,14 +225,25 @@ class RangeSet(object):
     >>> RangeSet("10-19 30-34").intersect(RangeSet("22-28"))
     <RangeSet("")>
     """
-    out = []
-    z = 0
-    for p, d in heapq.merge(zip(self.data, itertools.cycle((+1, -1))),
-                            zip(other.data, itertools.cycle((+1, -1)))):
-      if (z == 1 and d == 1) or (z == 2 and d == -1):
-        out.append(p)
-      z += d
-    return RangeSet(data=out)
+    a, b = self.data, other.data
+    if len(a) < len(b):
+      a, b = b, a
+
+    # For each range of the smaller set, the boundaries of 'a' that fall
+    # strictly inside it are also boundaries of the intersection. An odd
+    # insertion index means the end point falls inside a range of 'a'.
+    out = array.array(self.TYPECODE)
+    j = 0
+    for k in range(0, len(b), 2):
+      s, e = b[k], b[k+1]
+      i = bisect.bisect_right(a, s, j)
+      j = bisect.bisect_left(a, e, i)
+      if i & 1:
+        out.append(s)
+      out.extend(a[i:j])
+      if j & 1:
+        out.append(e)
+    return RangeSet._from_array(out)
 
   def subtract(self, other):
     """Return a new RangeSet representing subtracting the argument
@@ -172,14 +255,48 @@ class RangeSet(object):
     <RangeSet("10-19 30-34")>
     """
 
-    out = []
-    z = 0
-    for p, d in heapq.merge(zip(self.data, itertools.cycle((+1, -1))),
-                            zip(other.data, itertools.cycle((-1, +1)))):
-      if (z == 0 and d == 1) or (z == 1 and d == -1):
-        out.append(p)
-      z += d
-    return RangeSet(data=out)
+    a, b = self.data, other.data
+    out = array.array(self.TYPECODE)
+
+    if len(a) <= len(b):
+      # Like intersect, but keeping the parts of our ranges that fall
+      # outside the ranges of 'b'.
+      j = 0
+      for k in range(0, len(a), 2):
+        s, e = a[k], a[k+1]
+        i = bisect.bisect_right(b, s, j)
+        j = bisect.bisect_left(b, e, i)
+        if not i & 1:
+          out.append(s)
+        out.extend(b[i:j])
+        if not j & 1:
+          out.append(e)
+      return RangeSet._from_array(out)
+
+    # Cut the ranges of 'b' out of 'a', copying the untouched ranges of 'a'
+    # in between wholesale.
+    pos = 0
+    for k in range(0, len(b), 2):
+      s, e = b[k], b[k+1]
+      i = bisect.bisect_right(a, s, pos)
+      out.extend(a[pos:i])
+      if i & 1:
+        # s is inside a range of 'a'; end it at s (dropping it altogether if
+        # it started at s).
+        if out and out[-1] == s:
+          out.pop()
+        else:
+          out.append(s)
+      j = bisect.bisect_left(a, e, i)
+      if j & 1:
+        # e is inside a range of 'a'; restart it at e unless it ends there.
+        if a[j] == e:
+          j += 1
+        else:
+          out.append(e)
+      pos = j
+    out.extend(a[pos:])
+    return RangeSet._from_array(out)
 
   def overlaps(self, other):
     """Returns true if the argument has a nonempty overlap with this
@@ -193,12 +310,16 @@ class RangeSet(object):
 
     # This is like intersect, but we can stop as soon as we discover the
     # output is going to be nonempty.
-    z = 0
-    for _, d in heapq.merge(zip(self.data, itertools.cycle((+1, -1))),
-                            zip(other.data, itertools.cycle((+1, -1)))):
-      if (z == 1 and d == 1) or (z == 2 and d == -1):
+    a, b = self.data, other.data
+    if len(a) < len(b):
+      a, b = b, a
+
+    i = 0
+    for k in range(0, len(b), 2):
+      s, e = b[k], b[k+1]
+      i = bisect.bisect_right(a, s, i)
+      if i & 1 or (i < len(a) and a[i] < e):
         return True
-      z += d
     return False
 
   def size(self):
@@ -209,13 +330,9 @@ class RangeSet(object):
     15
     """
 
-    total = 0
-    for i, p in enumerate(self.data):
-      if i % 2:
-        total += p
-      else:
-        total -= p
-    return total
+    if self._size is None:
+      self._size = sum(self.data[1::2]) - sum(self.data[::2])
+    return self._size
 
   def map_within(self, other):
     """'other' should be a subset of 'self'.  Returns a RangeSet
@@ -260,13 +377,16 @@ class RangeSet(object):
     >>> RangeSet("10-19 30-39").extend(10)
     <RangeSet("0-49")>
     """
-    out = self
-    for i in range(0, len(self.data), 2):
-      s, e = self.data[i:i+2]
+    out = array.array(self.TYPECODE)
+    for s, e in self:
       s1 = max(0, s - n)
       e1 = e + n
-      out = out.union(RangeSet(str(s1) + "-" + str(e1-1)))
-    return out
+      if out and s1 <= out[-1]:
+        out[-1] = e1
+      else:
+        out.append(s1)
+        out.append(e1)
+    return RangeSet._from_array(out)
 
   def first(self, n):
     """Return the RangeSet that contains at most the first 'n' integers.
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2016 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# Times the RangeSet operations that the OTA tools use, on the ranges of a
+# block map (e.g. the system.map written next to system.img). Pass
+# --compare with another rangelib.py (e.g. one checked out from an older
+# revision) to time it side by side.
+#
+
+from __future__ import print_function
+
+import argparse
+import imp
+import random
+import time
+
+import rangelib
+
+
+def LoadBlockMap(fn):
+  with open(fn) as f:
+    return [line.split(None, 1)[1] for line in f if line.strip()]
+
+
+def SyntheticBlockMap(num_files, seed=0):
+  """Return the ranges of 'num_files' files laid out like in a fragmented
+  ext4 image: mostly contiguous, with some files split into several
+  extents."""
+  rnd = random.Random(seed)
+  pos = 0
+  out = []
+  for _ in range(num_files):
+    pieces = []
+    for _ in range(1 if rnd.random() < 0.8 else rnd.randint(2, 20)):
+      pos += rnd.randint(0, 3)
+      length = rnd.randint(1, 64)
+      pieces.append("%d-%d" % (pos, pos + length - 1))
+      pos += length
+    out.append(" ".join(pieces))
+  rnd.shuffle(out)
+  return out
+
+
+def Time(fn):
+  start = time.time()
+  fn()
+  return time.time() - start
+
+
+def RunBenchmarks(module, texts, rounds):
+  RangeSet = module.RangeSet
+  rnd = random.Random(0)
+  files = [RangeSet.parse(t) for t in texts]
+  pairs = [(rnd.choice(files), rnd.choice(files)) for _ in range(len(files))]
+  total = files[0]
+  for f in files[1:]:
+    total = total.union(f)
+
+  def Parse():
+    for t in texts:
+      RangeSet.parse(t)
+
+  def Union():
+    out = RangeSet()
+    for f in files:
+      out = out.union(f)
+
+  def UnionAll():
+    RangeSet.union_all(files)
+
+  def FileMap():
+    # What SparseImage.LoadFileBlockMap() does for each file.
+    remaining = total
+    for f in files:
+      assert f.size() == f.intersect(remaining).size()
+      remaining = remaining.subtract(f)
+
+  def Overlaps():
+    # What BlockImageDiff.GenerateDigraph() does for each pair of transfers.
+    for a, b in pairs:
+      if a.overlaps(b):
+        a.intersect(b).size()
+
+  def Size():
+    for _ in range(10):
+      for f in files:
+        f.size()
+      total.size()
+
+  results = []
+  for name, fn in (("parse", Parse), ("union", Union),
+                   ("union_all", UnionAll), ("file map", FileMap),
+                   ("overlaps", Overlaps), ("size", Size)):
+    if name == "union_all" and not hasattr(RangeSet, "union_all"):
+      results.append((name, None))
+      continue
+    results.append((name, min(Time(fn) for _ in range(rounds))))
+  return results
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('block_map', nargs='?',
+      help='The block map to take the ranges from (e.g. system.map)')
+  parser.add_argument('--synthetic', type=int, default=20000,
+      help='Number of files in the generated block map, if none is given')
+  parser.add_argument('--compare',
+      help='Another rangelib.py to time against this one')
+  parser.add_argument('--rounds', type=int, default=3,
+      help='Time each benchmark this many times, keeping the fastest')
+  args = parser.parse_args()
+
+  if args.block_map:
+    texts = LoadBlockMap(args.block_map)
+  else:
+    texts = SyntheticBlockMap(args.synthetic)
+  print("%d files" % (len(texts),))
+
+  current = RunBenchmarks(rangelib, texts, args.rounds)
+  if not args.compare:
+    for name, t in current:
+      print("%-10s %8.3fs" % (name, t))
+    return
+
+  other = RunBenchmarks(imp.load_source("rangelib_other", args.compare),
+                        texts, args.rounds)
+  print("%-10s %9s %9s %8s" % ("", "other", "current", "speedup"))
+  for (name, t), (_, t_other) in zip(current, other):
+    if t_other is None:
+      print("%-10s %9s %8.3fs" % (name, "-", t))
+    else:
+      print("%-10s %8.3fs %8.3fs %7.1fx" % (name, t_other, t,
+                                             t_other / max(t, 1e-6)))
+
+if __name__ == '__main__':
+  main()
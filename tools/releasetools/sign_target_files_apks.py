@@ -58,6 +58,9 @@ Usage:  sign_target_files_apks [flags] input_target_files output_target_files
       as well. If there're multiple OTA keys, only the first one will be used
       for payload verification.
 
+  --worker_threads <int>
+      Sign this many APKs at a time (defaults to the number of CPUs).
+
   -t  (--tag_changes)  <+tag>,<-tag>,...
       Comma-separated list of changes to make to the set of tags (in
       the last component of the build fingerprint).  Prefix each with
@@ -90,11 +93,13 @@ import base64
 import cStringIO
 import copy
 import errno
+import multiprocessing
 import os
 import re
 import shutil
 import subprocess
 import tempfile
+import threading
 import zipfile
 
 import add_img_to_target_files
@@ -179,6 +184,82 @@ def SignApk(data, keyname, pw, platform_api_level, codename_to_api_level_map):
   return data
 
 
+class ApkSigner(object):
+  """Signs the APKs 'apks' (ZipInfos of input_tf_zip) in
+  OPTIONS.worker_threads threads, which start right away. Next() returns the
+  signed data of each in turn.
+
+  Each APK gets signed by a JVM of its own, which takes a while to start,
+  so the threads keep signing up to a couple of APKs each ahead of the
+  caller while it goes on with the other entries. input_tf_zip must have
+  been opened by file name, so that members can be read from several
+  threads."""
+
+  def __init__(self, input_tf_zip, apks, apk_key_map, key_passwords,
+               platform_api_level, codename_to_api_level_map):
+    self.input_tf_zip = input_tf_zip
+    self.apk_key_map = apk_key_map
+    self.key_passwords = key_passwords
+    self.platform_api_level = platform_api_level
+    self.codename_to_api_level_map = codename_to_api_level_map
+
+    num_threads = OPTIONS.worker_threads or multiprocessing.cpu_count()
+    self._results = [None] * len(apks)
+    self._done = [threading.Event() for _ in apks]
+    self._next = 0
+    # Bounds the signed APKs that are kept in memory until Next() returns
+    # them.
+    self._window = threading.Semaphore(2 * num_threads)
+    self._lock = threading.Lock()
+    self._apk_iter = iter(enumerate(apks))   # accessed under lock
+    self._stop = False
+    self._threads = [threading.Thread(target=self._Worker)
+                     for _ in range(num_threads)]
+    for th in self._threads:
+      th.daemon = True
+      th.start()
+
+  def _Worker(self):
+    while True:
+      self._window.acquire()
+      with self._lock:
+        index, info = next(self._apk_iter, (None, None))
+      if index is None or self._stop:
+        return
+      try:
+        key = self.apk_key_map[os.path.basename(info.filename)]
+        data = self.input_tf_zip.read(info.filename)
+        self._results[index] = (True, SignApk(
+            data, key, self.key_passwords[key], self.platform_api_level,
+            self.codename_to_api_level_map))
+      except Exception: # pylint: disable=broad-except
+        self._results[index] = (False, sys.exc_info())
+      self._done[index].set()
+
+  def Next(self):
+    """Return the signed data of the next APK, or raise the error signing
+    it ran into."""
+    index = self._next
+    self._next += 1
+    # Wait with a timeout, so that the wait can be interrupted.
+    while not self._done[index].wait(1):
+      pass
+    signed, result = self._results[index]
+    self._results[index] = None
+    self._window.release()
+    if not signed:
+      raise result[0], result[1], result[2]
+    return result
+
+  def Close(self):
+    """Stop the threads, once the APKs being signed are done."""
+    self._stop = True
+    for _ in self._threads:
+      self._window.release()
+    for th in self._threads:
+      th.join()
+
+
 def ProcessTargetFiles(input_tf_zip, output_tf_zip, misc_info,
                        apk_key_map, key_passwords, platform_api_level,
                        codename_to_api_level_map):
@@ -207,95 +288,110 @@ def ProcessTargetFiles(input_tf_zip, output_tf_zip, misc_info,
         with open(fn, "wb") as f:
           f.write(data)
 
-  for info in input_tf_zip.infolist():
-    if info.filename.startswith("IMAGES/"):
-      continue
-
-    data = input_tf_zip.read(info.filename)
-    out_info = copy.copy(info)
-
-    # Sign APKs.
-    if info.filename.endswith(".apk"):
-      name = os.path.basename(info.filename)
-      key = apk_key_map[name]
-      if key not in common.SPECIAL_CERT_STRINGS:
-        print "    signing: %-*s (%s)" % (maxsize, name, key)
-        signed_data = SignApk(data, key, key_passwords[key], platform_api_level,
-            codename_to_api_level_map)
-        common.ZipWriteStr(output_tf_zip, out_info, signed_data)
-      else:
-        # an APK we're not supposed to sign.
-        print "NOT signing: %s" % (name,)
-        common.ZipWriteStr(output_tf_zip, out_info, data)
-
-    # System properties.
-    elif info.filename in ("SYSTEM/build.prop",
-                           "VENDOR/build.prop",
-                           "BOOT/RAMDISK/default.prop",
-                           "ROOT/default.prop",
-                           "RECOVERY/RAMDISK/default.prop"):
-      print "rewriting %s:" % (info.filename,)
-      new_data = RewriteProps(data, misc_info)
-      common.ZipWriteStr(output_tf_zip, out_info, new_data)
-      if info.filename in ("BOOT/RAMDISK/default.prop",
-                           "ROOT/default.prop",
-                           "RECOVERY/RAMDISK/default.prop"):
-        write_to_temp(info.filename, info.external_attr, new_data)
-
-    elif info.filename.endswith("mac_permissions.xml"):
-      print "rewriting %s with new keys." % (info.filename,)
-      new_data = ReplaceCerts(data)
-      common.ZipWriteStr(output_tf_zip, out_info, new_data)
-
-    # Trigger a rebuild of the recovery patch if needed.
-    elif info.filename in ("SYSTEM/recovery-from-boot.p",
-                           "SYSTEM/etc/recovery.img",
-                           "SYSTEM/bin/install-recovery.sh"):
-      rebuild_recovery = True
-
-    # Don't copy OTA keys if we're replacing them.
-    elif (OPTIONS.replace_ota_keys and
-          info.filename in (
-              "BOOT/RAMDISK/res/keys",
-              "BOOT/RAMDISK/etc/update_engine/update-payload-key.pub.pem",
-              "RECOVERY/RAMDISK/res/keys",
-              "SYSTEM/etc/security/otacerts.zip",
-              "SYSTEM/etc/update_engine/update-payload-key.pub.pem")):
-      pass
+  # The APKs are signed in parallel, ahead of the loop below, which writes
+  # them out in their place in the zip.
+  apks = [info for info in input_tf_zip.infolist()
+          if info.filename.endswith(".apk") and
+          not info.filename.startswith("IMAGES/") and
+          (apk_key_map[os.path.basename(info.filename)] not in
+           common.SPECIAL_CERT_STRINGS)]
+  signer = ApkSigner(input_tf_zip, apks, apk_key_map, key_passwords,
+                     platform_api_level, codename_to_api_level_map)
 
-    # Skip META/misc_info.txt if we will replace the verity private key later.
-    elif (OPTIONS.replace_verity_private_key and
-          info.filename == "META/misc_info.txt"):
-      pass
+  try:
+    for info in input_tf_zip.infolist():
+      if info.filename.startswith("IMAGES/"):
+        continue
 
-    # Skip verity public key if we will replace it.
-    elif (OPTIONS.replace_verity_public_key and
-          info.filename in ("BOOT/RAMDISK/verity_key",
-                            "ROOT/verity_key")):
-      pass
+      out_info = copy.copy(info)
+
+      # Sign APKs.
+      if info.filename.endswith(".apk"):
+        name = os.path.basename(info.filename)
+        key = apk_key_map[name]
+        if key not in common.SPECIAL_CERT_STRINGS:
+          print "    signing: %-*s (%s)" % (maxsize, name, key)
+          common.ZipWriteStr(output_tf_zip, out_info, signer.Next())
+        else:
+          # an APK we're not supposed to sign.
+          print "NOT signing: %s" % (name,)
+          common.ZipWriteStr(output_tf_zip, out_info,
+                             input_tf_zip.read(info.filename))
+        continue
 
-    # Skip verity keyid (for system_root_image use) if we will replace it.
-    elif (OPTIONS.replace_verity_keyid and
-          info.filename == "BOOT/cmdline"):
-      pass
+      data = input_tf_zip.read(info.filename)
+
+      # System properties.
+      if info.filename in ("SYSTEM/build.prop",
+                             "VENDOR/build.prop",
+                             "BOOT/RAMDISK/default.prop",
+                             "ROOT/default.prop",
+                             "RECOVERY/RAMDISK/default.prop"):
+        print "rewriting %s:" % (info.filename,)
+        new_data = RewriteProps(data, misc_info)
+        common.ZipWriteStr(output_tf_zip, out_info, new_data)
+        if info.filename in ("BOOT/RAMDISK/default.prop",
+                             "ROOT/default.prop",
+                             "RECOVERY/RAMDISK/default.prop"):
+          write_to_temp(info.filename, info.external_attr, new_data)
+
+      elif info.filename.endswith("mac_permissions.xml"):
+        print "rewriting %s with new keys." % (info.filename,)
+        new_data = ReplaceCerts(data)
+        common.ZipWriteStr(output_tf_zip, out_info, new_data)
+
+      # Trigger a rebuild of the recovery patch if needed.
+      elif info.filename in ("SYSTEM/recovery-from-boot.p",
+                             "SYSTEM/etc/recovery.img",
+                             "SYSTEM/bin/install-recovery.sh"):
+        rebuild_recovery = True
+
+      # Don't copy OTA keys if we're replacing them.
+      elif (OPTIONS.replace_ota_keys and
+            info.filename in (
+                "BOOT/RAMDISK/res/keys",
+                "BOOT/RAMDISK/etc/update_engine/update-payload-key.pub.pem",
+                "RECOVERY/RAMDISK/res/keys",
+                "SYSTEM/etc/security/otacerts.zip",
+                "SYSTEM/etc/update_engine/update-payload-key.pub.pem")):
+        pass
+
+      # Skip META/misc_info.txt if we will replace the verity private key later.
+      elif (OPTIONS.replace_verity_private_key and
+            info.filename == "META/misc_info.txt"):
+        pass
+
+      # Skip verity public key if we will replace it.
+      elif (OPTIONS.replace_verity_public_key and
+            info.filename in ("BOOT/RAMDISK/verity_key",
+                              "ROOT/verity_key")):
+        pass
+
+      # Skip verity keyid (for system_root_image use) if we will replace it.
+      elif (OPTIONS.replace_verity_keyid and
+            info.filename == "BOOT/cmdline"):
+        pass
+
+      # Skip the care_map as we will regenerate the system/vendor images.
+      elif (info.filename == "META/care_map.txt"):
+        pass
+
+      # Copy BOOT/, RECOVERY/, META/, ROOT/ to rebuild recovery patch. This case
+      # must come AFTER other matching rules.
+      elif (info.filename.startswith("BOOT/") or
+            info.filename.startswith("RECOVERY/") or
+            info.filename.startswith("META/") or
+            info.filename.startswith("ROOT/") or
+            info.filename == "SYSTEM/etc/recovery-resource.dat"):
+        write_to_temp(info.filename, info.external_attr, data)
+        common.ZipWriteStr(output_tf_zip, out_info, data)
 
-    # Skip the care_map as we will regenerate the system/vendor images.
-    elif (info.filename == "META/care_map.txt"):
-      pass
+      # A non-APK file; copy it verbatim.
+      else:
+        common.ZipWriteStr(output_tf_zip, out_info, data)
 
-    # Copy BOOT/, RECOVERY/, META/, ROOT/ to rebuild recovery patch. This case
-    # must come AFTER other matching rules.
-    elif (info.filename.startswith("BOOT/") or
-          info.filename.startswith("RECOVERY/") or
-          info.filename.startswith("META/") or
-          info.filename.startswith("ROOT/") or
-          info.filename == "SYSTEM/etc/recovery-resource.dat"):
-      write_to_temp(info.filename, info.external_attr, data)
-      common.ZipWriteStr(output_tf_zip, out_info, data)
-
-    # A non-APK file; copy it verbatim.
-    else:
-      common.ZipWriteStr(output_tf_zip, out_info, data)
+  finally:
+    signer.Close()
 
   if OPTIONS.replace_ota_keys:
     new_recovery_keys = ReplaceOtaKeys(input_tf_zip, output_tf_zip, misc_info)
@@ -667,6 +763,12 @@ def main(argv):
       OPTIONS.replace_verity_private_key = (True, a)
     elif o == "--replace_verity_keyid":
       OPTIONS.replace_verity_keyid = (True, a)
+    elif o == "--worker_threads":
+      if a.isdigit() and int(a) > 0:
+        OPTIONS.worker_threads = int(a)
+      else:
+        raise ValueError("Cannot parse value %r for option %r - only "
+                         "positive integers are allowed." % (a, o))
     else:
       return False
     return True
@@ -680,7 +782,8 @@ def main(argv):
                                               "tag_changes=",
                                               "replace_verity_public_key=",
                                               "replace_verity_private_key=",
-                                              "replace_verity_keyid="],
+                                              "replace_verity_keyid=",
+                                              "worker_threads="],
                              extra_option_handler=option_handler)
 
   if len(args) != 2:
@@ -12,9 +12,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import binascii
 import bisect
+import mmap
 import os
 import struct
+from collections import OrderedDict
 from hashlib import sha1
 
 import rangelib
@@ -29,11 +32,38 @@ class SparseImage(object):
   of blocks that should be always written to the target regardless of the old
   contents (i.e. copying instead of patching). clobbered_blocks should be in
   the form of a string like "0" or "0 1-5 8".
+
+  The image starts at 'offset' in simg_fn, e.g. for an image stored
+  uncompressed in a zip (see common.TargetFiles.Locate()).
+
+  If use_mmap is True, the image file is mapped into memory (read-only) and
+  ReadRangeSet() returns buffer slices into the mapped raw chunks instead of
+  copies of the data. Reads then no longer go through the shared file object,
+  so multiple threads can read ranges at the same time.
+
+  The SHA-1 hashes of the most recent ranges read through RangeSha1(), and
+  those of TotalSha1(), are cached, and BuildHashIndex() hashes every block of the image in a single
+  pass, so that each block needs to be read from disk only once.
   """
 
+  # Fill chunks are handed out in pieces of at most this many blocks, so that
+  # reading a large fill region doesn't materialize all of it at once.
+  FILL_PIECE_BLOCKS = 256
+
+  # The number of range hashes RangeSha1() keeps, least recently used first
+  # out.
+  RANGE_SHA1_CACHE_SIZE = 1024
+
   def __init__(self, simg_fn, file_map_fn=None, clobbered_blocks=None,
-               mode="rb", build_map=True):
+               mode="rb", build_map=True, use_mmap=False, offset=0):
+    if use_mmap and mode != "rb":
+      raise ValueError("use_mmap requires read-only mode, not %r" % (mode,))
     self.simg_f = f = open(simg_fn, mode)
+    self.simg_map = None
+    self.offset = offset
+    # The chunk positions below are offsets in the file, including 'offset'.
+    f.seek(offset, os.SEEK_SET)
+    self._ResetHashes()
 
     header_bin = f.read(28)
     header = struct.unpack("<I4H4I", header_bin)
@@ -62,6 +92,11 @@ class SparseImage(object):
     print("Total of %u %u-byte output blocks in %u input chunks."
           % (total_blks, blk_sz, total_chunks))
 
+    if use_mmap:
+      # The buffers returned by ReadRangeSet() refer to the mapping, so it's
+      # never closed explicitly; it goes away with the last reference to it.
+      self.simg_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
     if not build_map:
       return
 
@@ -131,6 +166,8 @@ class SparseImage(object):
       self.file_map = {"__DATA": self.care_map}
 
   def AppendFillChunk(self, data, blocks):
+    assert self.simg_map is None, "can't append to a memory-mapped image"
+    assert self.offset == 0, "can't append to an image inside another file"
     f = self.simg_f
 
     # Append a fill chunk
@@ -144,6 +181,13 @@ class SparseImage(object):
     f.seek(16, os.SEEK_SET)
     f.write(struct.pack("<2I", self.total_blocks, self.total_chunks))
 
+    self._ResetHashes()
+
+  def _ResetHashes(self):
+    self._range_sha1s = OrderedDict()
+    self._total_sha1s = {}
+    self._block_sha1s = None
+
   def ReadRangeSet(self, ranges):
     return [d for d in self._GetRangeData(ranges)]
 
@@ -152,13 +196,76 @@ class SparseImage(object):
 
     If include_clobbered_blocks is True, it returns the hash including the
     clobbered_blocks."""
-    ranges = self.care_map
-    if not include_clobbered_blocks:
-      ranges = ranges.subtract(self.clobbered_blocks)
-    h = sha1()
-    for d in self._GetRangeData(ranges):
-      h.update(d)
-    return h.hexdigest()
+    h = self._total_sha1s.get(include_clobbered_blocks)
+    if h is None:
+      ranges = self.care_map
+      if not include_clobbered_blocks:
+        ranges = ranges.subtract(self.clobbered_blocks)
+      h = self._total_sha1s[include_clobbered_blocks] = self.RangeSha1(ranges)
+    return h
+
+  def RangeSha1(self, ranges):
+    """Return the SHA-1 hash (as a hex string) of the data in 'ranges'.
+
+    The hashes of the last RANGE_SHA1_CACHE_SIZE ranges are kept, so that
+    ranges hashed again soon after (e.g. whole files) aren't read again.
+    Single blocks are looked up in the block hash index if it's been built
+    (see BlockSha1()), rather than building it for one block."""
+    if ranges.size() == 1 and self._block_sha1s is not None:
+      return binascii.hexlify(self.BlockSha1(ranges.data[0]))
+
+    key = ranges.data.tostring()
+    h = self._range_sha1s.pop(key, None)
+    if h is None:
+      ctx = sha1()
+      for d in self._GetRangeData(ranges):
+        ctx.update(d)
+      h = ctx.hexdigest()
+      if len(self._range_sha1s) >= self.RANGE_SHA1_CACHE_SIZE:
+        self._range_sha1s.popitem(last=False)
+    self._range_sha1s[key] = h
+    return h
+
+  def BlockSha1(self, block):
+    """Return the SHA-1 digest (as a binary string) of the data in 'block',
+    from the block hash index, which gets built on first use. Raises
+    ValueError if 'block' isn't part of the care_map."""
+    # The care_map boundaries alternate between starts and ends.
+    if bisect.bisect_right(self.care_map.data, block) % 2 == 0:
+      raise ValueError("block %d is not in the care_map" % (block,))
+    if self._block_sha1s is None:
+      self.BuildHashIndex()
+    return self._block_sha1s[block * 20:(block + 1) * 20]
+
+  def BuildHashIndex(self):
+    """Compute the SHA-1 digest of every block in the care_map.
+
+    The total SHA-1 hashes (with and without the clobbered blocks) are
+    computed along the way, so TotalSha1() doesn't need to read the image
+    again."""
+    bs = self.blocksize
+    clobbered = set(self.clobbered_blocks.next_item())
+    total = sha1()
+    total_clobbered = sha1()
+    digests = []
+    pos = 0
+    for s, e in self.care_map:
+      # Blocks outside the care_map get an all-zero placeholder digest.
+      digests.append("\0" * (20 * (s - pos)))
+      b = s
+      for d in self._GetRangeData(((s, e),)):
+        for offset in range(0, len(d), bs):
+          block_data = buffer(d, offset, bs)
+          digests.append(sha1(block_data).digest())
+          total_clobbered.update(block_data)
+          if b not in clobbered:
+            total.update(block_data)
+          b += 1
+      pos = e
+
+    self._block_sha1s = "".join(digests)
+    self._total_sha1s[False] = total.hexdigest()
+    self._total_sha1s[True] = total_clobbered.hexdigest()
 
   def _GetRangeData(self, ranges):
     """Generator that produces all the image data in 'ranges'.  The
@@ -166,11 +273,11 @@ class SparseImage(object):
     particular is not necessarily equal to the number of ranges in
     'ranges'.
 
-    This generator is stateful -- it depends on the open file object
-    contained in this SparseImage, so you should not try to run two
-    instances of this generator on the same object simultaneously."""
+    Unless the image is memory-mapped, this generator is stateful -- it
+    depends on the open file object contained in this SparseImage, so you
+    should not try to run two instances of this generator on the same object
+    simultaneously."""
 
-    f = self.simg_f
     for s, e in ranges:
       to_read = e-s
       idx = bisect.bisect_right(self.offset_index, s) - 1
@@ -179,12 +286,9 @@ class SparseImage(object):
       # for the first chunk we may be starting partway through it.
       remain = chunk_len - (s - chunk_start)
       this_read = min(remain, to_read)
-      if filepos is not None:
-        p = filepos + ((s - chunk_start) * self.blocksize)
-        f.seek(p, os.SEEK_SET)
-        yield f.read(this_read * self.blocksize)
-      else:
-        yield fill_data * (this_read * (self.blocksize >> 2))
+      for d in self._GetChunkData(filepos, fill_data, s - chunk_start,
+                                  this_read):
+        yield d
       to_read -= this_read
 
       while to_read > 0:
@@ -192,13 +296,32 @@ class SparseImage(object):
         idx += 1
         chunk_start, chunk_len, filepos, fill_data = self.offset_map[idx]
         this_read = min(chunk_len, to_read)
-        if filepos is not None:
-          f.seek(filepos, os.SEEK_SET)
-          yield f.read(this_read * self.blocksize)
-        else:
-          yield fill_data * (this_read * (self.blocksize >> 2))
+        for d in self._GetChunkData(filepos, fill_data, 0, this_read):
+          yield d
         to_read -= this_read
 
+  def _GetChunkData(self, filepos, fill_data, start, count):
+    """Generator that produces 'count' blocks of a chunk's data, starting at
+    block 'start' within the chunk."""
+
+    if filepos is not None:
+      p = filepos + start * self.blocksize
+      if self.simg_map is not None:
+        yield buffer(self.simg_map, p, count * self.blocksize)
+      else:
+        f = self.simg_f
+        f.seek(p, os.SEEK_SET)
+        yield f.read(count * self.blocksize)
+    else:
+      # All the full-sized pieces share the same string.
+      n = min(count, self.FILL_PIECE_BLOCKS)
+      piece = fill_data * (n * (self.blocksize >> 2))
+      while count > 0:
+        if count < n:
+          piece = piece[:count * self.blocksize]
+        yield piece
+        count -= n
+
   def LoadFileBlockMap(self, fn, clobbered_blocks):
     remaining = self.care_map
     self.file_map = out = {}
@@ -226,44 +349,36 @@ class SparseImage(object):
 
     zero_blocks = []
     nonzero_blocks = []
-    reference = '\0' * self.blocksize
 
     # Workaround for bug 23227672. For squashfs, we don't have a system.map. So
     # the whole system image will be treated as a single file. But for some
     # unknown bug, the updater will be killed due to OOM when writing back the
     # patched image to flash (observed on lenok-userdebug MEA49). Prior to
     # getting a real fix, we evenly divide the non-zero blocks into smaller
-    # groups (currently 1024 blocks or 4MB per group).
+    # groups (currently 512 blocks or 2MB per group).
     # Bug: 23227672
-    MAX_BLOCKS_PER_GROUP = 1024
+    MAX_BLOCKS_PER_GROUP = 512
     nonzero_groups = []
-
-    f = self.simg_f
-    for s, e in remaining:
-      for b in range(s, e):
-        idx = bisect.bisect_right(self.offset_index, b) - 1
-        chunk_start, _, filepos, fill_data = self.offset_map[idx]
-        if filepos is not None:
-          filepos += (b-chunk_start) * self.blocksize
-          f.seek(filepos, os.SEEK_SET)
-          data = f.read(self.blocksize)
-        else:
-          if fill_data == reference[:4]:   # fill with all zeros
-            data = reference
-          else:
-            data = None
-
-        if data == reference:
-          zero_blocks.append(b)
-          zero_blocks.append(b+1)
-        else:
-          nonzero_blocks.append(b)
-          nonzero_blocks.append(b+1)
-
-          if len(nonzero_blocks) >= MAX_BLOCKS_PER_GROUP:
-            nonzero_groups.append(nonzero_blocks)
-            # Clear the list.
-            nonzero_blocks = []
+    group_size = 0
+
+    for s, e, is_zero in self._ClassifyBlocks(remaining):
+      if is_zero:
+        zero_blocks.append(s)
+        zero_blocks.append(e)
+        continue
+
+      while s < e:
+        n = min(e - s, MAX_BLOCKS_PER_GROUP - group_size)
+        nonzero_blocks.append(s)
+        nonzero_blocks.append(s + n)
+        group_size += n
+        s += n
+
+        if group_size >= MAX_BLOCKS_PER_GROUP:
+          nonzero_groups.append(nonzero_blocks)
+          # Clear the list.
+          nonzero_blocks = []
+          group_size = 0
 
     if nonzero_blocks:
       nonzero_groups.append(nonzero_blocks)
@@ -279,6 +394,57 @@ class SparseImage(object):
     if clobbered_blocks:
       out["__COPY"] = clobbered_blocks
 
+  # Raw chunks are scanned for zero blocks in slabs of this many blocks.
+  CLASSIFY_SLAB_BLOCKS = 2048
+
+  def _ClassifyBlocks(self, ranges):
+    """Generator that splits 'ranges' into runs of all-zero and non-zero
+    blocks, producing (start, end, is_zero) tuples in block order.
+
+    Raw chunks are read in large slabs; a slab that is entirely zero is
+    detected with a single comparison, and only mixed slabs are checked
+    block by block (without copying the blocks out of the slab)."""
+
+    blocksize = self.blocksize
+    zero_fill = "\0" * 4
+    zero_slab = ""
+    f = self.simg_f
+
+    for s, e in ranges:
+      idx = bisect.bisect_right(self.offset_index, s) - 1
+      while s < e:
+        chunk_start, chunk_len, filepos, fill_data = self.offset_map[idx]
+        chunk_end = min(chunk_start + chunk_len, e)
+
+        if filepos is None:
+          yield s, chunk_end, fill_data == zero_fill
+          s = chunk_end
+          idx += 1
+          continue
+
+        while s < chunk_end:
+          n = min(chunk_end - s, self.CLASSIFY_SLAB_BLOCKS)
+          f.seek(filepos + (s - chunk_start) * blocksize, os.SEEK_SET)
+          slab = f.read(n * blocksize)
+
+          if len(zero_slab) != len(slab):
+            zero_slab = "\0" * len(slab)
+          if slab == zero_slab:
+            yield s, s + n, True
+          else:
+            reference = zero_slab[:blocksize]
+            run_start = 0
+            run_is_zero = slab.startswith(reference)
+            for i in range(1, n):
+              is_zero = slab.startswith(reference, i * blocksize)
+              if is_zero != run_is_zero:
+                yield s + run_start, s + i, run_is_zero
+                run_start = i
+                run_is_zero = is_zero
+            yield s + run_start, s + n, run_is_zero
+          s += n
+        idx += 1
+
   def ResetFileMap(self):
     """Throw away the file map and treat the entire image as
     undifferentiated data."""
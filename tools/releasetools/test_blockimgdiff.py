@@ -0,0 +1,334 @@
+#
+# Copyright (C) 2016 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+from __future__ import print_function
+
+import hashlib
+import heapq
+import itertools
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import common
+from blockimgdiff import BlockImageDiff, DataImage, SimilarityIndex, Transfer
+from patch_cache import PatchCache
+from rangelib import RangeSet
+
+BLOCKSIZE = 4096
+
+def RandomData(rnd, blocks):
+  return "".join(chr(rnd.randrange(256)) for _ in range(blocks * BLOCKSIZE))
+
+def MakeImage(files):
+  """Return a DataImage holding the (name, data) 'files' back to back, with
+  a file_map of them."""
+  data = []
+  file_map = {}
+  pos = 0
+  for name, contents in files:
+    blocks = len(contents) // BLOCKSIZE
+    file_map[name] = RangeSet(data=(pos, pos + blocks))
+    data.append(contents)
+    pos += blocks
+  image = DataImage("".join(data))
+  image.file_map = file_map
+  return image
+
+def VertexSequence(transfers):
+  """The sequence FindVertexSequence() picked with a heap of (score, push
+  order) entries, where a changed score was pushed anew and the stale entry
+  skipped."""
+  for xf in transfers:
+    xf.incoming = xf.goes_after.copy()
+    xf.outgoing = xf.goes_before.copy()
+    xf.score = sum(xf.outgoing.values()) - sum(xf.incoming.values())
+
+  counter = itertools.count()
+  G = set(transfers)
+  live = {}
+  heap = []
+  def push(xf):
+    live[xf] = (-xf.score, next(counter), xf)
+    heapq.heappush(heap, live[xf])
+  for xf in transfers:
+    push(xf)
+
+  s1 = []
+  s2 = []
+  sinks = set(u for u in transfers if not u.outgoing)
+  sources = set(u for u in transfers if not u.incoming)
+
+  def adjust_score(iu, delta):
+    iu.score += delta
+    push(iu)
+
+  while G:
+    while sinks:
+      new_sinks = set()
+      for u in sinks:
+        if u not in G: continue
+        s2.insert(0, u)
+        G.remove(u)
+        for iu in u.incoming:
+          adjust_score(iu, -iu.outgoing.pop(u))
+          if not iu.outgoing: new_sinks.add(iu)
+      sinks = new_sinks
+
+    while sources:
+      new_sources = set()
+      for u in sources:
+        if u not in G: continue
+        s1.append(u)
+        G.remove(u)
+        for iu in u.outgoing:
+          adjust_score(iu, +iu.incoming.pop(u))
+          if not iu.incoming: new_sources.add(iu)
+      sources = new_sources
+
+    if not G: break
+
+    while True:
+      entry = heapq.heappop(heap)
+      u = entry[2]
+      if u in G and live[u] is entry:
+        break
+    s1.append(u)
+    G.remove(u)
+    for iu in u.outgoing:
+      adjust_score(iu, +iu.incoming.pop(u))
+      if not iu.incoming: sources.add(iu)
+    for iu in u.incoming:
+      adjust_score(iu, -iu.outgoing.pop(u))
+      if not iu.outgoing: sinks.add(iu)
+
+  for xf in transfers:
+    del xf.incoming
+    del xf.outgoing
+    del xf.score
+  return s1 + s2
+
+class VertexSequenceTest(unittest.TestCase):
+
+  def test_random_digraphs(self):
+    rnd = random.Random(0)
+    b = BlockImageDiff(DataImage(RandomData(rnd, 1)))
+    for _ in range(50):
+      by_id = []
+      transfers = [Transfer("t", "s", RangeSet(), RangeSet(), "diff", by_id)
+                   for _ in range(rnd.randrange(2, 60))]
+      for _ in range(rnd.randrange(4 * len(transfers))):
+        u, v = rnd.sample(transfers, 2)
+        # Few distinct weights, so that many scores tie.
+        u.goes_before[v] = v.goes_after[u] = rnd.randrange(1, 4)
+
+      expected = VertexSequence(transfers)
+      b.transfers = transfers
+      b.FindVertexSequence()
+      self.assertEqual(b.transfers, expected)
+      self.assertEqual([xf.order for xf in b.transfers],
+                       range(len(transfers)))
+
+class SimilarityIndexTest(unittest.TestCase):
+
+  def setUp(self):
+    rnd = random.Random(0)
+    self.lib = RandomData(rnd, 8)
+    self.other = RandomData(rnd, 8)
+    self.src = MakeImage([("/system/lib/libfoo-1.so", self.lib),
+                          ("/system/lib/libbar.so", self.other)])
+
+  def test_find_most_similar(self):
+    index = SimilarityIndex(self.src, self.src.file_map)
+    # Shifting the data around doesn't change its sketch much.
+    shifted = ("x" * 100 + self.lib)[:len(self.lib)]
+    tgt = MakeImage([("/system/lib64/libfoo-2.so", shifted)])
+    self.assertEqual(
+        index.FindMostSimilar(tgt, tgt.file_map["/system/lib64/libfoo-2.so"]),
+        "/system/lib/libfoo-1.so")
+
+    tgt = MakeImage([("new", RandomData(random.Random(1), 8))])
+    self.assertEqual(index.FindMostSimilar(tgt, tgt.file_map["new"]), None)
+
+  def test_max_entries(self):
+    index = SimilarityIndex(self.src, self.src.file_map,
+                            max_entries=SimilarityIndex.MIN_SKETCH_SIZE)
+    self.assertEqual(index.sketch_size, SimilarityIndex.MIN_SKETCH_SIZE)
+    self.assertEqual(len(index.names), 1)
+    self.assertLessEqual(len(index.postings), SimilarityIndex.MIN_SKETCH_SIZE)
+
+class FindTransfersTest(unittest.TestCase):
+
+  def setUp(self):
+    self.cache_size = common.OPTIONS.cache_size
+    common.OPTIONS.cache_size = 1024 * BLOCKSIZE
+
+  def tearDown(self):
+    common.OPTIONS.cache_size = self.cache_size
+
+  def test_similar_source(self):
+    rnd = random.Random(0)
+    lib = RandomData(rnd, 4)
+    src = MakeImage([("/system/lib/libfoo-1.so", lib),
+                     ("/system/app/Foo.apk", RandomData(rnd, 2))])
+    tgt = MakeImage([("/system/lib64/libfoo.so", lib[:-100] + "x" * 100),
+                     ("/system/app/Foo.apk", RandomData(rnd, 2)),
+                     ("/system/app/Bar.apk", RandomData(rnd, 2))])
+    # Version 2, so that the identical blocks aren't split off into transfers
+    # of their own (see test_identical_blocks).
+    b = BlockImageDiff(tgt, src, version=2)
+    b.AbbreviateSourceNames()
+    b.FindTransfers()
+    transfers = dict((xf.tgt_name, xf) for xf in b.transfers)
+    self.assertEqual(transfers["/system/lib64/libfoo.so"].src_name,
+                     "/system/lib/libfoo-1.so")
+    self.assertEqual(transfers["/system/lib64/libfoo.so"].style, "diff")
+    self.assertEqual(transfers["/system/app/Foo.apk"].src_name,
+                     "/system/app/Foo.apk")
+    self.assertEqual(transfers["/system/app/Bar.apk"].style, "new")
+
+  def test_similar_source_of_another_type(self):
+    rnd = random.Random(0)
+    data = RandomData(rnd, 2)
+    src = MakeImage([("/system/lib/libfoo.so", data)])
+    tgt = MakeImage([("/system/app/Foo.apk", data[:-100] + "x" * 100)])
+    b = BlockImageDiff(tgt, src, version=2)
+    b.AbbreviateSourceNames()
+    b.FindTransfers()
+    xf = [xf for xf in b.transfers if xf.tgt_name == "/system/app/Foo.apk"][0]
+    self.assertEqual(xf.src_name, "/system/lib/libfoo.so")
+    # The source isn't a zip, so imgdiff can't be used.
+    self.assertFalse(b.CanUseImgdiff(xf.tgt_name, xf.src_name,
+                                     xf.tgt_ranges, xf.src_ranges))
+    self.assertTrue(b.CanUseImgdiff(xf.tgt_name, "/system/app/Bar.apk",
+                                    xf.tgt_ranges, xf.src_ranges))
+
+  def test_identical_blocks(self):
+    rnd = random.Random(0)
+    a = [RandomData(rnd, 1) for _ in range(4)]
+    b = [RandomData(rnd, 1) for _ in range(4)]
+    src = MakeImage([("a", "".join(a)), ("b", "".join(b))])
+    # Blocks 0-1 moved within the file and block 2 comes from another file;
+    # only block 3 changed.
+    tgt = MakeImage([("a", a[2] + a[3] + b[0] + RandomData(rnd, 1)),
+                     ("b", "".join(b))])
+    b = BlockImageDiff(tgt, src)
+    b.AbbreviateSourceNames()
+    b.FindTransfers()
+    transfers = dict((xf.tgt_name, xf) for xf in b.transfers)
+    self.assertEqual(sorted(transfers), ["a-cropped", "a-skipped", "b"])
+    self.assertEqual(transfers["a-skipped"].tgt_ranges, RangeSet("0-2"))
+    self.assertEqual(transfers["a-skipped"].src_ranges, RangeSet("2-4"))
+    self.assertEqual(transfers["a-cropped"].tgt_ranges, RangeSet("3"))
+    self.assertEqual(transfers["a-cropped"].src_ranges, RangeSet("0-1"))
+
+  def test_identical_blocks_not_from_copy_or_clobbered(self):
+    rnd = random.Random(0)
+    a = [RandomData(rnd, 1) for _ in range(4)]
+    b = [RandomData(rnd, 1) for _ in range(2)]
+    c = RandomData(rnd, 1)
+    src = MakeImage([("a", "".join(a)), ("b", "".join(b)), ("__COPY", c)])
+    src.clobbered_blocks = RangeSet("5")
+    # Block 2 is only found in "__COPY" and block 3 only in a clobbered block.
+    tgt = MakeImage([("a", a[0] + a[1] + c + b[1])])
+    diff = BlockImageDiff(tgt, src)
+    index = diff.SourceBlockIndex()
+    self.assertNotIn(hashlib.sha1(c).digest(), index)
+    self.assertNotIn(hashlib.sha1(b[1]).digest(), index)
+    groups, tgt_skipped, src_skipped = diff.FindIdenticalBlocks(
+        tgt.file_map["a"], src.file_map["a"])
+    self.assertEqual(groups, [(RangeSet("0-1"), RangeSet("0-1"))])
+    self.assertEqual(tgt_skipped, RangeSet("0-1"))
+    self.assertEqual(src_skipped, RangeSet("0-1"))
+
+class StashOrderTest(unittest.TestCase):
+
+  def setUp(self):
+    self.options = (common.OPTIONS.cache_size,
+                    common.OPTIONS.stash_reorder_rounds)
+    # Room for 3 stashed blocks.
+    common.OPTIONS.cache_size = 4 * BLOCKSIZE
+    self.tmp_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    common.OPTIONS.cache_size, common.OPTIONS.stash_reorder_rounds = (
+        self.options)
+    shutil.rmtree(self.tmp_dir)
+
+  def _Compute(self, rounds):
+    common.OPTIONS.stash_reorder_rounds = rounds
+    rnd = random.Random(0)
+    a = RandomData(rnd, 4)
+    b = RandomData(rnd, 4)
+    # The two files swap places, so one of them needs to be stashed whatever
+    # the order; it doesn't fit, and gets packed as new data.
+    src = MakeImage([("a", a), ("b", b)])
+    tgt = MakeImage([("b", b), ("a", a)])
+    prefix = os.path.join(self.tmp_dir, "rounds-%d" % (rounds,))
+    b = BlockImageDiff(tgt, src)
+    # Don't split the files.
+    b.split_threshold = 1.0
+    b.Compute(prefix)
+    output = []
+    for ext in (".transfer.list", ".new.dat", ".patch.dat"):
+      with open(prefix + ext, "rb") as f:
+        output.append(f.read())
+    return output
+
+  def test_no_better_order(self):
+    output = self._Compute(0)
+    self.assertEqual(len(output[1]), 4 * BLOCKSIZE)
+    self.assertEqual(self._Compute(100), output)
+
+class SplitThresholdTest(unittest.TestCase):
+
+  def setUp(self):
+    self.options = (common.OPTIONS.cache_size, common.OPTIONS.patch_cache)
+    common.OPTIONS.cache_size = 64 * BLOCKSIZE
+    self.cache_dir = tempfile.mkdtemp()
+    common.OPTIONS.patch_cache = PatchCache(self.cache_dir)
+
+  def tearDown(self):
+    common.OPTIONS.cache_size, common.OPTIONS.patch_cache = self.options
+    shutil.rmtree(self.cache_dir)
+
+  def test_split_ranges(self):
+    self.assertEqual(
+        BlockImageDiff.SplitRanges(RangeSet("0-9"), RangeSet("20-26"), 4),
+        [(RangeSet("0-3"), RangeSet("20-23")),
+         (RangeSet("4-9"), RangeSet("24-26"))])
+
+  def test_choose_split_threshold(self):
+    rnd = random.Random(0)
+    src = MakeImage([("big", RandomData(rnd, 40)),
+                     ("small", RandomData(rnd, 2))])
+    tgt = MakeImage([("big", RandomData(rnd, 40)),
+                     ("small", RandomData(rnd, 2))])
+    b = BlockImageDiff(tgt, src)
+
+    # Use the results memoized in the patch cache rather than diffing.
+    cache = common.OPTIONS.patch_cache
+    for t, size in zip(BlockImageDiff.SPLIT_THRESHOLDS, (300, 100, 200, 400)):
+      key = cache.Key(b.HashBlocks(src, src.file_map["big"]),
+                      b.HashBlocks(tgt, tgt.file_map["big"]),
+                      ["split", str(b.MaxBlocksPerTransfer(t))])
+      cache.Put(key, "%d 1.0" % (size,))
+
+    b.ChooseSplitThreshold()
+    self.assertEqual(b.split_threshold, 0.125)
+    self.assertEqual(cache.hits, len(BlockImageDiff.SPLIT_THRESHOLDS))
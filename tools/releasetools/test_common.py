@@ -13,13 +13,17 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+import multiprocessing
 import os
+import shutil
 import tempfile
+import threading
 import time
 import unittest
 import zipfile
 
 import common
+from patch_cache import PatchCache
 
 
 def random_string_with_holes(size, block_size, step_size):
@@ -42,6 +46,19 @@ def get_2gb_string():
   return two_gb_string
 
 
+def compute_block_differences(partitions):
+  # Compute the block differences of 'partitions' (name, data) pairs at once,
+  # as when generating an incremental, and return their transfer lists.
+  diffs = [common.BlockDifference(name, common.DataImage(data), version=1,
+                                  compute=False)
+           for name, data in partitions]
+  common.ComputeBlockDifferences(diffs)
+  out = []
+  for d in diffs:
+    with open(d.path + ".transfer.list") as f:
+      out.append(f.read())
+  return out
+
 class CommonZipTest(unittest.TestCase):
   def _verify(self, zip_file, zip_file_name, arcname, contents,
               test_file_name=None, expected_stat=None, expected_mode=0o644,
@@ -214,6 +231,20 @@ class CommonZipTest(unittest.TestCase):
   def test_ZipWrite_resets_ZIP64_LIMIT(self):
     self._test_reset_ZIP64_LIMIT(self._test_ZipWrite, "")
 
+  def test_ZipWriteStream(self):
+    pieces = [os.urandom(1024) for _ in range(16)]
+    for compress_type in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+      for size in (16 * 1024, None):
+        with tempfile.NamedTemporaryFile(suffix=".zip") as zip_file:
+          output_zip = zipfile.ZipFile(zip_file, "w")
+          common.ZipWriteStream(output_zip, "foo", iter(pieces), size=size,
+                                perms=0o755, compress_type=compress_type)
+          common.ZipWriteStr(output_zip, "bar", "bar")
+          common.ZipClose(output_zip)
+          self._verify(output_zip, zip_file.name, "foo", "".join(pieces),
+                       expected_mode=0o755,
+                       expected_compress_type=compress_type)
+
   def test_ZipWriteStr(self):
     random_string = os.urandom(1024)
     # Passing arcname
@@ -295,3 +326,389 @@ class CommonZipTest(unittest.TestCase):
                    expected_mode=0o400)
     finally:
       os.remove(zip_file_name)
+
+
+class CommonUnzipTest(unittest.TestCase):
+
+  def setUp(self):
+    self.zip_file = tempfile.NamedTemporaryFile(suffix=".zip")
+    with zipfile.ZipFile(self.zip_file.name, "w") as z:
+      z.writestr("META/misc_info.txt", "recovery_api_version=3\n")
+      info = zipfile.ZipInfo("SYSTEM/bin/tool")
+      info.external_attr = 0o100755 << 16
+      z.writestr(info, "#!/bin/sh\n")
+      info = zipfile.ZipInfo("SYSTEM/bin/link")
+      info.external_attr = 0o120777 << 16
+      z.writestr(info, "tool")
+      z.writestr("SYSTEM/app/Foo.apk", "apk" * 1000)
+    self.out_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    self.zip_file.close()
+    shutil.rmtree(self.out_dir)
+
+  def test_UnzipToDir(self):
+    extracted, skipped = common.UnzipToDir(self.zip_file.name, self.out_dir)
+    self.assertEqual((extracted, skipped), (3037, 0))
+    bin_dir = os.path.join(self.out_dir, "SYSTEM", "bin")
+    self.assertEqual(os.stat(os.path.join(bin_dir, "tool")).st_mode & 0o777,
+                     0o755)
+    self.assertEqual(os.readlink(os.path.join(bin_dir, "link")), "tool")
+    with open(os.path.join(self.out_dir, "META", "misc_info.txt")) as f:
+      self.assertEqual(f.read(), "recovery_api_version=3\n")
+
+    # Only the members that don't match get unzipped again.
+    with open(os.path.join(bin_dir, "tool"), "w") as f:
+      f.write("#!/bin/bash")
+    extracted, skipped = common.UnzipToDir(self.zip_file.name, self.out_dir)
+    self.assertEqual((extracted, skipped), (10, 3027))
+    with open(os.path.join(bin_dir, "tool")) as f:
+      self.assertEqual(f.read(), "#!/bin/sh\n")
+
+  def test_UnzipToDir_with_patterns(self):
+    extracted, _ = common.UnzipToDir(self.zip_file.name, self.out_dir,
+                                     ["*.apk", "META/*"])
+    self.assertEqual(extracted, 3023)
+    self.assertEqual(sorted(os.listdir(self.out_dir)), ["META", "SYSTEM"])
+    self.assertEqual(os.listdir(os.path.join(self.out_dir, "SYSTEM")),
+                     ["app"])
+
+  def test_UnzipTemp_with_bootable_images(self):
+    with tempfile.NamedTemporaryFile(suffix=".zip") as images:
+      with zipfile.ZipFile(images.name, "w") as z:
+        z.writestr("boot.img", "boot")
+      tmp, z = common.UnzipTemp(self.zip_file.name + "+" + images.name,
+                                "META/*")
+      z.close()
+    try:
+      # The pattern only applies to the target-files.
+      self.assertEqual(sorted(os.listdir(tmp)), ["BOOTABLE_IMAGES", "META"])
+      self.assertEqual(os.listdir(os.path.join(tmp, "BOOTABLE_IMAGES")),
+                       ["boot.img"])
+    finally:
+      common.Cleanup()
+
+
+class CommonTargetFilesTest(unittest.TestCase):
+
+  def setUp(self):
+    self.zip_file = tempfile.NamedTemporaryFile(suffix=".zip")
+    with zipfile.ZipFile(self.zip_file.name, "w") as z:
+      z.writestr("META/misc_info.txt", "recovery_api_version=3\n",
+                 zipfile.ZIP_DEFLATED)
+      z.writestr("IMAGES/system.img", "img" * 1000, zipfile.ZIP_STORED)
+      info = zipfile.ZipInfo("SYSTEM/bin/link")
+      info.external_attr = 0o120777 << 16
+      z.writestr(info, "sh")
+    self.out_dir = tempfile.mkdtemp()
+    self.tempfiles = common.OPTIONS.tempfiles
+    common.OPTIONS.tempfiles = []
+
+  def tearDown(self):
+    common.Cleanup()
+    common.OPTIONS.tempfiles = self.tempfiles
+    self.zip_file.close()
+    shutil.rmtree(self.out_dir)
+
+  def test_zip(self):
+    tf = common.TargetFiles(self.zip_file.name)
+    self.assertEqual(tf.NameList(), [
+        "IMAGES/system.img", "META/misc_info.txt", "SYSTEM/bin/link"])
+    self.assertTrue(tf.Exists("IMAGES/system.img"))
+    self.assertFalse(tf.Exists("IMAGES/vendor.img"))
+    self.assertTrue(tf.IsSymlink("SYSTEM/bin/link"))
+    self.assertEqual(tf.Read("META/misc_info.txt"), "recovery_api_version=3\n")
+    self.assertRaises(KeyError, tf.Read, "IMAGES/vendor.img")
+
+    # Stored members are read straight from the zip, nothing gets unzipped.
+    self.assertEqual(str(tf.Map("IMAGES/system.img")), "img" * 1000)
+    path, offset = tf.Locate("IMAGES/system.img")
+    self.assertEqual(path, self.zip_file.name)
+    with open(path) as f:
+      f.seek(offset)
+      self.assertEqual(f.read(3000), "img" * 1000)
+    self.assertIsNone(tf.unzip_dir)
+
+    # Deflated ones get unzipped when their path is needed.
+    path = tf.GetPath("META/misc_info.txt")
+    with open(path) as f:
+      self.assertEqual(f.read(), "recovery_api_version=3\n")
+    self.assertEqual(os.listdir(tf.unzip_dir), ["META"])
+    self.assertEqual(tf.Locate("META/misc_info.txt"), (path, 0))
+
+    self.assertEqual(common.LoadInfoDict(tf)["recovery_api_version"], 3)
+    tf.Close()
+
+  def test_dir(self):
+    common.UnzipToDir(self.zip_file.name, self.out_dir)
+    tf = common.TargetFiles(self.out_dir)
+    self.assertEqual(tf.NameList(), [
+        "IMAGES/system.img", "META/misc_info.txt", "SYSTEM/bin/link"])
+    self.assertTrue(tf.IsSymlink("SYSTEM/bin/link"))
+    self.assertEqual(tf.Read("META/misc_info.txt"), "recovery_api_version=3\n")
+    self.assertRaises(KeyError, tf.Read, "IMAGES/vendor.img")
+    self.assertEqual(str(tf.Map("IMAGES/system.img")), "img" * 1000)
+    self.assertEqual(tf.GetPath("META/misc_info.txt"),
+                     os.path.join(self.out_dir, "META", "misc_info.txt"))
+    self.assertEqual(tf.Extract(), self.out_dir)
+
+  def test_LazyFile(self):
+    data = "img" * 1000
+    expected = common.File("system.img", data)
+    with zipfile.ZipFile(self.zip_file.name) as z:
+      info = z.getinfo("IMAGES/system.img")
+      f = common.LazyFile.FromZip("system.img", z, info)
+      self.assertEqual(f.size, expected.size)
+      self.assertFalse(f.HasSha1())
+      self.assertEqual(f.sha1, expected.sha1)
+      self.assertTrue(f.HasSha1())
+      self.assertEqual(f.data, data)
+      with f.WriteToTemp() as t:
+        with open(t.name) as temp:
+          self.assertEqual(temp.read(), data)
+
+      out_name = os.path.join(self.out_dir, "out.zip")
+      with zipfile.ZipFile(out_name, "w", zipfile.ZIP_DEFLATED) as out:
+        f.AddToZip(out)
+      with zipfile.ZipFile(out_name) as out:
+        self.assertEqual(out.read("system.img"), data)
+
+      # A SHA-1 from a manifest is taken as is.
+      f = common.LazyFile.FromZip("system.img", z, info, "0" * 40)
+      self.assertEqual(f.sha1, "0" * 40)
+
+
+class CommonDifferenceTest(unittest.TestCase):
+
+  # A diff program whose "patch" is the target file itself.
+  COPY = ["sh", "-c", 'cat "$2" > "$3"', "sh"]
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.options = (common.OPTIONS.worker_threads, common.OPTIONS.patch_cache,
+                    common.OPTIONS.diff_timeout, common.OPTIONS.diff_max_bytes)
+    common.OPTIONS.worker_threads = 2
+    common.OPTIONS.patch_cache = None
+
+  def tearDown(self):
+    (common.OPTIONS.worker_threads, common.OPTIONS.patch_cache,
+     common.OPTIONS.diff_timeout, common.OPTIONS.diff_max_bytes) = self.options
+    shutil.rmtree(self.tmp_dir)
+
+  def _Diff(self, name, data, diff_program=None):
+    return common.Difference(common.File(name, data),
+                             common.File(name, "source"),
+                             diff_program=diff_program or self.COPY)
+
+  def test_ComputeDifferences(self):
+    common.OPTIONS.diff_max_bytes = 1000
+    diffs = [self._Diff("file%d" % (i,), "x" * (100 * i))
+             for i in range(1, 9)]
+    common.ComputeDifferences(diffs)
+    for i, d in enumerate(diffs, 1):
+      self.assertEqual(d.GetPatch()[2], "x" * (100 * i))
+
+  def test_ComputeDifferences_threads(self):
+    # The files to diff are written out by the threads running the diffs,
+    # rather than by the one scheduling them.
+    threads = []
+
+    class File(common.File):
+      def WriteToTemp(self):
+        threads.append(threading.current_thread())
+        return common.File.WriteToTemp(self)
+
+    diffs = [common.Difference(File("file%d" % (i,), "x" * (100 * i)),
+                               File("file%d" % (i,), "source"),
+                               diff_program=self.COPY)
+             for i in range(1, 5)]
+    common.ComputeDifferences(diffs)
+    self.assertEqual(len(threads), 8)
+    self.assertNotIn(threading.current_thread(), threads)
+    for i, d in enumerate(diffs, 1):
+      self.assertEqual(d.GetPatch()[2], "x" * (100 * i))
+
+  def test_ComputeDifferences_retries(self):
+    # Fails the first time it's run.
+    marker = os.path.join(self.tmp_dir, "marker")
+    flaky = ["sh", "-c", 'test -e %s || { touch %s; exit 1; }; cat "$2" > "$3"'
+             % (marker, marker), "sh"]
+    d = self._Diff("flaky", "data", flaky)
+    common.ComputeDifferences([d], retries=0)
+    self.assertIsNone(d.GetPatch()[2])
+    os.remove(marker)
+    common.ComputeDifferences([d])
+    self.assertEqual(d.GetPatch()[2], "data")
+
+  def test_ComputeDifferences_timeout(self):
+    common.OPTIONS.diff_timeout = 0.2
+    slow = self._Diff("slow", "data", ["sh", "-c", "exec sleep 10", "sh"])
+    fast = self._Diff("fast", "data")
+    start = time.time()
+    common.ComputeDifferences([slow, fast])
+    self.assertLess(time.time() - start, 5)
+    self.assertIsNone(slow.GetPatch()[2])
+    self.assertEqual(fast.GetPatch()[2], "data")
+    self.assertEqual(slow.ComputePatch(), (None, None, None))
+
+
+class CommonBlockDifferenceTest(unittest.TestCase):
+
+  class FstabEntry(object):
+    fs_type = "ext4"
+
+    def __init__(self, device):
+      self.device = device
+
+  def setUp(self):
+    self.options = (common.OPTIONS.info_dict, common.OPTIONS.tempfiles,
+                    common.OPTIONS.worker_threads)
+    common.OPTIONS.info_dict = {"fstab": {
+        "/system": self.FstabEntry("/dev/block/system"),
+        "/vendor": self.FstabEntry("/dev/block/vendor")}}
+    common.OPTIONS.tempfiles = []
+    common.OPTIONS.worker_threads = 2
+    self.partitions = [("system", os.urandom(4096 * 8)),
+                       ("vendor", os.urandom(4096 * 4))]
+
+  def tearDown(self):
+    common.Cleanup()
+    (common.OPTIONS.info_dict, common.OPTIONS.tempfiles,
+     common.OPTIONS.worker_threads) = self.options
+
+  def test_ComputeBlockDifferences(self):
+    system, vendor = compute_block_differences(self.partitions)
+    self.assertIn("new 2,0,8", system)
+    self.assertIn("new 2,0,4", vendor)
+
+  def test_ComputeBlockDifferences_patch_cache_stats(self):
+    cache_dir = tempfile.mkdtemp()
+    patch_cache = common.OPTIONS.patch_cache
+    common.OPTIONS.patch_cache = PatchCache(cache_dir)
+    hit = PatchCache.Key("0" * 40, "1" * 40, ["bsdiff"])
+    miss = PatchCache.Key("0" * 40, "2" * 40, ["bsdiff"])
+    common.OPTIONS.patch_cache.Put(hit, "patch")
+
+    # Each partition looks up a cached patch and a missing one, in a child
+    # process of its own.
+    compute = common.blockimgdiff.BlockImageDiff.Compute
+    def Compute(b, *args, **kwargs):
+      common.OPTIONS.patch_cache.Get(hit)
+      common.OPTIONS.patch_cache.Get(miss)
+      return compute(b, *args, **kwargs)
+    common.blockimgdiff.BlockImageDiff.Compute = Compute
+    try:
+      compute_block_differences(self.partitions)
+      self.assertEqual(common.OPTIONS.patch_cache.hits, 2)
+      self.assertEqual(common.OPTIONS.patch_cache.misses, 2)
+    finally:
+      common.blockimgdiff.BlockImageDiff.Compute = compute
+      common.OPTIONS.patch_cache = patch_cache
+      shutil.rmtree(cache_dir)
+
+  def test_ComputeBlockDifferences_in_pool_worker(self):
+    # Pool workers are daemonic and can't fork children of their own, as
+    # with several incremental sources; the partitions are computed in the
+    # worker itself.
+    pool = multiprocessing.Pool(1)
+    try:
+      result = pool.apply(compute_block_differences, (self.partitions,))
+    finally:
+      pool.terminate()
+      pool.join()
+    self.assertEqual(result, compute_block_differences(self.partitions))
+
+
+class CommonWorkDirTest(unittest.TestCase):
+
+  class FstabEntry(object):
+    fs_type = "ext4"
+    device = "/dev/block/system"
+
+  def setUp(self):
+    self.work_dir = tempfile.mkdtemp()
+    self.options = (common.OPTIONS.work_dir, common.OPTIONS.info_dict,
+                    common.OPTIONS.tempfiles)
+    common.OPTIONS.work_dir = self.work_dir
+    common.OPTIONS.info_dict = {"fstab": {"/system": self.FstabEntry()}}
+    common.OPTIONS.tempfiles = []
+
+  def tearDown(self):
+    common.Cleanup()
+    (common.OPTIONS.work_dir, common.OPTIONS.info_dict,
+     common.OPTIONS.tempfiles) = self.options
+    shutil.rmtree(self.work_dir)
+
+  def test_UnzipTemp(self):
+    with tempfile.NamedTemporaryFile(suffix=".zip") as f:
+      with zipfile.ZipFile(f.name, "w") as z:
+        z.writestr("SYSTEM/foo", "foo")
+      tmp, z = common.UnzipTemp(f.name)
+      z.close()
+      self.assertEqual(os.path.dirname(tmp), self.work_dir)
+      with open(os.path.join(tmp, "SYSTEM", "foo")) as foo:
+        self.assertEqual(foo.read(), "foo")
+
+      # The second time around, the unzipped files get reused and only the
+      # missing ones are unzipped again.
+      os.remove(os.path.join(tmp, "SYSTEM", "foo"))
+      tmp2, z = common.UnzipTemp(f.name)
+      z.close()
+      self.assertEqual(tmp2, tmp)
+      with open(os.path.join(tmp, "SYSTEM", "foo")) as foo:
+        self.assertEqual(foo.read(), "foo")
+
+  def test_BlockDifference(self):
+    tgt = common.DataImage(os.urandom(4096 * 8))
+    d = common.BlockDifference("system", tgt, version=1)
+    self.assertTrue(d.path.startswith(d.checkpoint_dir))
+    self.assertTrue(os.path.exists(d.path + ".transfer.list"))
+
+    # An identical one gets the results without computing anything.
+    compute = common.blockimgdiff.BlockImageDiff.Compute
+    common.blockimgdiff.BlockImageDiff.Compute = None
+    try:
+      d2 = common.BlockDifference("system", tgt, version=1)
+    finally:
+      common.blockimgdiff.BlockImageDiff.Compute = compute
+    self.assertEqual(d2.path, d.path)
+    self.assertEqual(d2.required_cache, d.required_cache)
+    self.assertEqual(d2.touched_src_ranges, d.touched_src_ranges)
+
+    # Different inputs don't.
+    d3 = common.BlockDifference("system", tgt, version=2)
+    self.assertNotEqual(d3.path, d.path)
+
+    # Neither do different options affecting the output.
+    rounds = common.OPTIONS.stash_reorder_rounds
+    common.OPTIONS.stash_reorder_rounds = rounds + 1
+    try:
+      d4 = common.BlockDifference("system", tgt, version=1)
+    finally:
+      common.OPTIONS.stash_reorder_rounds = rounds
+    self.assertNotEqual(d4.path, d.path)
+
+  def test_BlockDifference_failure(self):
+    tgt = common.DataImage(os.urandom(4096 * 8))
+    d = common.BlockDifference("system", tgt, version=1, compute=False)
+
+    def Fail(*_args, **_kwargs):
+      raise ValueError("failed")
+    compute = common.blockimgdiff.BlockImageDiff.Compute
+    common.blockimgdiff.BlockImageDiff.Compute = Fail
+    try:
+      self.assertRaises(ValueError, d.Compute)
+      # The same in a child process, which can't rely on OPTIONS.tempfiles.
+      recv_conn, send_conn = multiprocessing.Pipe(False)
+      p = multiprocessing.Process(target=d._ComputeInChild,
+                                  args=(1, send_conn))
+      p.start()
+      send_conn.close()
+      ok, e = recv_conn.recv()
+      p.join()
+    finally:
+      common.blockimgdiff.BlockImageDiff.Compute = compute
+    self.assertFalse(ok)
+    self.assertIsInstance(e, ValueError)
+    # Neither left a staging dir or a checkpoint behind.
+    self.assertEqual(os.listdir(self.work_dir), [])
@@ -0,0 +1,115 @@
+#
+# Copyright (C) 2017 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import common
+import blockimgdiff
+from diff_pool import DiffManager, DiffPool
+from patch_cache import PatchCache
+
+class DiffPoolTest(unittest.TestCase):
+
+  def setUp(self):
+    self.cache_dir = tempfile.mkdtemp()
+    self.log = os.path.join(self.cache_dir, ".diffs")
+    self.compute_patch = blockimgdiff.compute_patch
+    blockimgdiff.compute_patch = self._StubComputePatch
+    self.options = (common.OPTIONS.patch_cache, common.OPTIONS.diff_pool)
+    common.OPTIONS.patch_cache = PatchCache(self.cache_dir)
+
+  def tearDown(self):
+    common.OPTIONS.patch_cache, common.OPTIONS.diff_pool = self.options
+    blockimgdiff.compute_patch = self.compute_patch
+    shutil.rmtree(self.cache_dir)
+
+  def _StubComputePatch(self, src, tgt, imgdiff=False):
+    # Log the diffs that get run, from whichever process runs them.
+    with open(self.log, "a") as f:
+      f.write("".join(src) + "\n")
+    time.sleep(0.1)
+    if src == ["bad"]:
+      raise ValueError("diff failed: 1")
+    return "".join(src) + "-" + "".join(tgt)
+
+  def _Diffs(self):
+    with open(self.log) as f:
+      return sorted(f.read().split())
+
+  def test_once(self):
+    pool = DiffPool(4, self.cache_dir)
+    key = PatchCache.Key("a" * 40, "b" * 40, ["bsdiff"])
+    patches = []
+    threads = [threading.Thread(
+        target=lambda: patches.append(pool.Diff(key, ["src"], ["tgt"])))
+               for _ in range(8)]
+    for th in threads:
+      th.start()
+    for th in threads:
+      th.join()
+    self.assertEqual(patches, ["src-tgt"] * 8)
+    self.assertEqual(pool.Diff(key, ["src"], ["tgt"]), "src-tgt")
+    self.assertEqual(self._Diffs(), ["src"])
+    self.assertEqual(common.OPTIONS.patch_cache.Get(key), "src-tgt")
+
+  def test_error(self):
+    pool = DiffPool(1, self.cache_dir)
+    key = PatchCache.Key("a" * 40, "b" * 40, ["bsdiff"])
+    self.assertRaises(ValueError, pool.Diff, key, ["bad"], ["tgt"])
+    # Failed diffs aren't kept.
+    self.assertRaises(ValueError, pool.Diff, key, ["bad"], ["tgt"])
+    self.assertEqual(self._Diffs(), ["bad", "bad"])
+
+  def test_processes(self):
+    # The pool serves the processes forked after it started, and theirs.
+    manager = DiffManager()
+    manager.start()
+    try:
+      common.OPTIONS.diff_pool = manager.DiffPool(2, self.cache_dir)
+      keys = [PatchCache.Key("%040d" % (i,), "b" * 40, ["bsdiff"])
+              for i in range(3)]
+
+      def Child(i):
+        # The real compute_patch(), which hands the diff to the pool.
+        patch = self.compute_patch([buffer("src%d" % (i % 3,))], ["tgt"],
+                                   key=keys[i % 3])
+        assert patch == "src%d-tgt" % (i % 3,), patch
+
+      def Parent(i):
+        children = [multiprocessing.Process(target=Child, args=(j,))
+                    for j in range(i, i + 3)]
+        for p in children:
+          p.start()
+        for p in children:
+          p.join()
+          assert p.exitcode == 0
+
+      parents = [multiprocessing.Process(target=Parent, args=(i,))
+                 for i in range(3)]
+      for p in parents:
+        p.start()
+      for p in parents:
+        p.join()
+        self.assertEqual(p.exitcode, 0)
+    finally:
+      manager.shutdown()
+    self.assertEqual(self._Diffs(), ["src0", "src1", "src2"])
@@ -0,0 +1,160 @@
+#
+# Copyright (C) 2016 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+import common
+from ota_from_target_files import (FileMatcher, LoadFileManifest,
+                                   LoadPartitionFiles, SaveFileManifest)
+
+def RandomFile(rnd, name, size=2000):
+  return common.File(name, "".join(chr(rnd.randrange(256))
+                                   for _ in range(size)))
+
+def Files(*files):
+  return dict((f.name, f) for f in files)
+
+class FileMatcherTest(unittest.TestCase):
+
+  def setUp(self):
+    self.target_info_dict = common.OPTIONS.target_info_dict
+    common.OPTIONS.target_info_dict = {"update_rename_support": True}
+    self.rnd = random.Random(0)
+
+  def tearDown(self):
+    common.OPTIONS.target_info_dict = self.target_info_dict
+
+  def test_path(self):
+    sf = RandomFile(self.rnd, "system/a")
+    tf = RandomFile(self.rnd, "system/a")
+    matcher = FileMatcher(Files(sf), Files(tf))
+    self.assertIs(matcher.Match(tf, {}), sf)
+    self.assertEqual(matcher.counts["path"], 1)
+
+  def test_sha1(self):
+    sf = RandomFile(self.rnd, "system/old/a")
+    tf = common.File("system/new/b", sf.data)
+    matcher = FileMatcher(Files(sf), Files(tf))
+    self.assertIs(matcher.Match(tf, {}), sf)
+    self.assertEqual(matcher.counts["sha1"], 1)
+
+  def test_basename(self):
+    sf = RandomFile(self.rnd, "system/app/Foo.apk")
+    tf = RandomFile(self.rnd, "system/priv-app/Foo.apk")
+    matcher = FileMatcher(Files(sf), Files(tf))
+    self.assertIs(matcher.Match(tf, {}), sf)
+    self.assertEqual(matcher.counts["basename"], 1)
+
+  def test_similar(self):
+    sf = RandomFile(self.rnd, "system/lib/libfoo.so.1")
+    other = RandomFile(self.rnd, "system/lib/libbar.so.1")
+    tf = RandomFile(self.rnd, "system/lib/libfoo.so.2")
+    matcher = FileMatcher(Files(sf, other), Files(tf))
+    self.assertIs(matcher.Match(tf, {}), sf)
+    self.assertEqual(matcher.counts["similar"], 1)
+
+    # Not when the size is too different, nor when it's more than the digits
+    # that differ.
+    tf = RandomFile(self.rnd, "system/lib/libfoo.so.2", 5000)
+    self.assertIsNone(matcher.Match(tf, {}))
+    tf = RandomFile(self.rnd, "system/lib/libfoo2.so")
+    self.assertIsNone(matcher.Match(tf, {}))
+    self.assertEqual(matcher.counts["none"], 2)
+
+  def test_similar_candidates(self):
+    source = [RandomFile(self.rnd, "system/lib/lib%d.so" % (i,))
+              for i in range(FileMatcher.MAX_SIMILAR_CANDIDATES + 1)]
+    tf = RandomFile(self.rnd, "system/lib/lib99.so")
+    matcher = FileMatcher(Files(*source), Files(tf))
+    self.assertEqual(len(matcher.by_stem["lib.so"]),
+                     FileMatcher.MAX_SIMILAR_CANDIDATES)
+    self.assertIn(matcher.Match(tf, {}), source)
+
+  def test_small(self):
+    sf = RandomFile(self.rnd, "system/old/a", 100)
+    tf = common.File("system/new/a", sf.data)
+    matcher = FileMatcher(Files(sf), Files(tf))
+    self.assertIsNone(matcher.Match(tf, {}))
+
+  def test_no_rename_support(self):
+    common.OPTIONS.target_info_dict = {}
+    sf = RandomFile(self.rnd, "system/old/a")
+    tf = common.File("system/new/a", sf.data)
+    matcher = FileMatcher(Files(sf), Files(tf))
+    self.assertIsNone(matcher.Match(tf, {}))
+
+  def test_existing(self):
+    sf = RandomFile(self.rnd, "system/old/a")
+    tf1 = common.File("system/new/a", sf.data)
+    tf2 = common.File("system/new/b", sf.data)
+    matcher = FileMatcher(Files(sf), Files(tf1, tf2))
+    self.assertIs(matcher.Match(tf1, {}), sf)
+    # The source file is already renamed to tf1.
+    self.assertIsNone(matcher.Match(tf2, {sf.name: tf1}))
+
+    # Nor is a source file that's still in the target matched under another
+    # name.
+    tf3 = common.File("system/old/a", sf.data)
+    matcher = FileMatcher(Files(sf), Files(tf2, tf3))
+    self.assertIsNone(matcher.Match(tf2, {}))
+
+
+class FileManifestTest(unittest.TestCase):
+
+  def setUp(self):
+    self.work_dir = tempfile.mkdtemp()
+    self.work_dir_option = common.OPTIONS.work_dir
+    common.OPTIONS.work_dir = self.work_dir
+
+  def tearDown(self):
+    common.OPTIONS.work_dir = self.work_dir_option
+    shutil.rmtree(self.work_dir)
+
+  def _Zip(self, files):
+    path = os.path.join(self.work_dir, "target_files.zip")
+    with zipfile.ZipFile(path, "w") as z:
+      for name, data in files:
+        z.writestr(name, data)
+    return zipfile.ZipFile(path)
+
+  def test_manifest(self):
+    z = self._Zip([("SYSTEM/a", "a"), ("SYSTEM/b", "b")])
+    files = LoadPartitionFiles(z, "system", LoadFileManifest())
+    self.assertFalse(files["system/a"].HasSha1())
+    sha1 = files["system/a"].sha1
+    SaveFileManifest(z, "system", files.values())
+    z.close()
+
+    files = LoadPartitionFiles(z, "system", LoadFileManifest())
+    self.assertTrue(files["system/a"].HasSha1())
+    self.assertEqual(files["system/a"].sha1, sha1)
+    self.assertFalse(files["system/b"].HasSha1())
+
+    # The SHA-1s are kept by member, so that they survive the other members
+    # changing, but not the member itself changing.
+    z = self._Zip([("SYSTEM/a", "a"), ("SYSTEM/b", "c")])
+    files = LoadPartitionFiles(z, "system", LoadFileManifest())
+    self.assertTrue(files["system/a"].HasSha1())
+    z.close()
+    z = self._Zip([("SYSTEM/a", "A")])
+    files = LoadPartitionFiles(z, "system", LoadFileManifest())
+    self.assertFalse(files["system/a"].HasSha1())
+    z.close()
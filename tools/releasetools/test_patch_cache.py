@@ -0,0 +1,64 @@
+#
+# Copyright (C) 2016 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from patch_cache import PatchCache
+
+class PatchCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self.cache_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.cache_dir)
+
+  def test_get_put(self):
+    cache = PatchCache(self.cache_dir)
+    key = cache.Key("a" * 40, "b" * 40, ["bsdiff"])
+    self.assertEqual(cache.Get(key), None)
+    cache.Put(key, "patch data")
+    self.assertEqual(cache.Get(key), "patch data")
+    self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    # Entries are visible to other instances sharing the directory.
+    self.assertEqual(PatchCache(self.cache_dir).Get(key), "patch data")
+
+  def test_key(self):
+    key = PatchCache.Key("a" * 40, "b" * 40, ["bsdiff"])
+    self.assertEqual(key, PatchCache.Key("a" * 40, "b" * 40, ["bsdiff"]))
+    self.assertNotEqual(key, PatchCache.Key("b" * 40, "a" * 40, ["bsdiff"]))
+    self.assertNotEqual(key, PatchCache.Key("a" * 40, "b" * 40,
+                                            ["imgdiff", "-z"]))
+
+  def test_trim(self):
+    cache = PatchCache(self.cache_dir)
+    keys = [cache.Key(str(i), str(i), ["bsdiff"]) for i in range(3)]
+    for i, key in enumerate(keys):
+      cache.Put(key, "x" * 100)
+      os.utime(cache._Path(key), (i, i))
+
+    cache.max_size = 250
+
+    # Reading the oldest entry makes it the most recently used one.
+    self.assertEqual(cache.Get(keys[0]), "x" * 100)
+    cache.Trim()
+    self.assertEqual(cache.Get(keys[1]), None)
+    self.assertEqual(cache.Get(keys[0]), "x" * 100)
+    self.assertEqual(cache.Get(keys[2]), "x" * 100)
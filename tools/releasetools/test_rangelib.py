@@ -26,6 +26,35 @@ class RangeSetTest(unittest.TestCase):
     self.assertEqual(RangeSet("10-19 30-34").union(RangeSet("22 32")),
                      RangeSet("10-19 22 30-34"))
 
+  def test_union_all(self):
+    self.assertEqual(RangeSet.union_all([RangeSet("10-19"),
+                                         RangeSet("30-34"),
+                                         RangeSet("18-29 40")]),
+                     RangeSet("10-34 40"))
+    self.assertEqual(RangeSet.union_all([RangeSet("3"), RangeSet("4")]),
+                     RangeSet("3-4"))
+    self.assertEqual(RangeSet.union_all([]), RangeSet(""))
+
+  def test_small_large(self):
+    # Operations between a small and a large RangeSet only look at the
+    # ranges of the large one near the small one.
+    large = RangeSet(" ".join("%d-%d" % (i, i + 4) for i in range(0, 100, 10)))
+    small = RangeSet("4-5 20 33-50 99")
+    self.assertEqual(large.union(small),
+                     RangeSet("0-5 10-14 20-24 30-54 60-64 70-74 80-84 "
+                              "90-94 99"))
+    self.assertEqual(small.union(large), large.union(small))
+    self.assertEqual(large.intersect(small), RangeSet("4 20 33-34 40-44 50"))
+    self.assertEqual(small.intersect(large), large.intersect(small))
+    self.assertEqual(large.subtract(small),
+                     RangeSet("0-3 10-14 21-24 30-32 51-54 60-64 70-74 80-84 "
+                              "90-94"))
+    self.assertEqual(small.subtract(large), RangeSet("5 35-39 45-49 99"))
+    self.assertTrue(large.overlaps(small))
+    self.assertTrue(small.overlaps(large))
+    self.assertFalse(large.overlaps(RangeSet("5-9 25-29 95-100")))
+    self.assertFalse(RangeSet("5-9 25-29 95-100").overlaps(large))
+
   def test_intersect(self):
     self.assertEqual(RangeSet("10-19 30-34").intersect(RangeSet("18-32")),
                      RangeSet("18-19 30-32"))
@@ -45,6 +74,7 @@ class RangeSetTest(unittest.TestCase):
   def test_size(self):
     self.assertEqual(RangeSet("10-19 30-34").size(), 15)
     self.assertEqual(RangeSet("").size(), 0)
+    self.assertEqual(RangeSet("10-19").union(RangeSet("15-24")).size(), 15)
 
   def test_map_within(self):
     self.assertEqual(RangeSet("0-9").map_within(RangeSet("3-4")),
@@ -0,0 +1,105 @@
+#
+# Copyright (C) 2017 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+import unittest
+import zipfile
+
+import common
+import sign_target_files_apks
+
+def StubSignApk(data, keyname, pw, platform_api_level,
+                codename_to_api_level_map):
+  # Finish in a random order.
+  time.sleep(random.random() * 0.01)
+  if data == "bad":
+    raise common.ExternalError("failed to sign")
+  return "%s signed with %s (%s)" % (data, keyname, pw)
+
+class ProcessTargetFilesTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.options = common.OPTIONS.worker_threads
+    self.sign_apk = sign_target_files_apks.SignApk
+    sign_target_files_apks.SignApk = StubSignApk
+    self.stdout = sys.stdout
+
+  def tearDown(self):
+    sys.stdout = self.stdout
+    sign_target_files_apks.SignApk = self.sign_apk
+    common.OPTIONS.worker_threads = self.options
+    shutil.rmtree(self.tmp_dir)
+
+  def _Input(self, apks):
+    path = os.path.join(self.tmp_dir, "input.zip")
+    with zipfile.ZipFile(path, "w") as z:
+      for name, data in apks:
+        z.writestr("SYSTEM/app/" + name, data)
+        z.writestr("SYSTEM/lib/%s.so" % (name,), data[::-1])
+      z.writestr("SYSTEM/app/Presigned.apk", "presigned")
+    key_map = dict((name, "key%d" % (i % 3))
+                   for i, (name, _) in enumerate(apks))
+    key_map["Presigned.apk"] = "PRESIGNED"
+    passwords = dict((key, "pw-" + key) for key in key_map.values())
+    return path, key_map, passwords
+
+  def _Sign(self, input_path, key_map, passwords, threads):
+    common.OPTIONS.worker_threads = threads
+    path = os.path.join(self.tmp_dir, "output-%d.zip" % (threads,))
+    input_zip = zipfile.ZipFile(input_path)
+    output_zip = zipfile.ZipFile(path, "w")
+    sys.stdout = open(os.devnull, "w")
+    try:
+      sign_target_files_apks.ProcessTargetFiles(
+          input_zip, output_zip, {}, key_map, passwords, 23, {})
+    finally:
+      sys.stdout.close()
+      sys.stdout = self.stdout
+      output_zip.close()
+      input_zip.close()
+    with open(path, "rb") as f:
+      return f.read()
+
+  def test_threads(self):
+    apks = [("App%d.apk" % (i,), "app%d" % (i,) * (i + 1)) for i in range(40)]
+    args = self._Input(apks)
+    serial = self._Sign(*args, threads=1)
+    self.assertEqual(self._Sign(*args, threads=8), serial)
+
+    with zipfile.ZipFile(os.path.join(self.tmp_dir, "output-8.zip")) as z:
+      self.assertEqual(z.read("SYSTEM/app/Presigned.apk"), "presigned")
+      self.assertEqual(z.read("SYSTEM/app/App4.apk"),
+                       "app4" * 5 + " signed with key1 (pw-key1)")
+
+  def test_error(self):
+    apks = [("App%d.apk" % (i,), "app%d" % (i,)) for i in range(10)]
+    apks[5] = ("Bad.apk", "bad")
+    args = self._Input(apks)
+    try:
+      self._Sign(*args, threads=4)
+    except common.ExternalError:
+      # The error comes with the traceback of where it was raised.
+      self.assertEqual(traceback.extract_tb(sys.exc_info()[2])[-1][2],
+                       "StubSignApk")
+    else:
+      self.fail("no error signing Bad.apk")
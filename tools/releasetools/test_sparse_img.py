@@ -0,0 +1,181 @@
+#
+# Copyright (C) 2016 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import struct
+import tempfile
+import unittest
+from hashlib import sha1
+
+from rangelib import RangeSet
+from sparse_img import SparseImage
+
+BLOCKSIZE = 4096
+
+def WriteSparseImage(f, chunks):
+  """Write a sparse image made of 'chunks' to the file object 'f'.
+
+  Each chunk is ("raw", data), ("fill", 4-byte pattern, blocks) or
+  ("dontcare", blocks). Returns the expanded image data, with zeros for the
+  don't care chunks."""
+  total_blocks = 0
+  body = []
+  expanded = []
+  for chunk in chunks:
+    if chunk[0] == "raw":
+      data = chunk[1]
+      blocks = len(data) // BLOCKSIZE
+      body.append(struct.pack("<2H2I", 0xCAC1, 0, blocks, 12 + len(data)))
+      body.append(data)
+      expanded.append(data)
+    elif chunk[0] == "fill":
+      blocks = chunk[2]
+      body.append(struct.pack("<2H2I", 0xCAC2, 0, blocks, 16))
+      body.append(chunk[1])
+      expanded.append(chunk[1] * (blocks * BLOCKSIZE // 4))
+    else:
+      blocks = chunk[1]
+      body.append(struct.pack("<2H2I", 0xCAC3, 0, blocks, 12))
+      expanded.append("\0" * (blocks * BLOCKSIZE))
+    total_blocks += blocks
+
+  f.write(struct.pack("<I4H4I", 0xED26FF3A, 1, 0, 28, 12, BLOCKSIZE,
+                      total_blocks, len(chunks), 0))
+  for b in body:
+    f.write(b)
+  f.flush()
+  return "".join(expanded)
+
+class SparseImageTest(unittest.TestCase):
+
+  def setUp(self):
+    self.simg_file = tempfile.NamedTemporaryFile()
+    self.data = WriteSparseImage(self.simg_file, [
+        ("raw", "".join(chr(i) * BLOCKSIZE for i in range(1, 5))),
+        ("fill", "\1\2\3\4", 300),
+        ("dontcare", 10),
+        ("raw", "\0" * BLOCKSIZE + "x" * BLOCKSIZE * 2),
+        ("fill", "\0\0\0\0", 3),
+    ])
+
+  def tearDown(self):
+    self.simg_file.close()
+
+  def _Expected(self, ranges):
+    return "".join(self.data[s * BLOCKSIZE:e * BLOCKSIZE] for s, e in ranges)
+
+  def test_read_range_set(self):
+    for use_mmap in (False, True):
+      simg = SparseImage(self.simg_file.name, use_mmap=use_mmap)
+      self.assertEqual(simg.care_map, RangeSet("0-303 314-319"))
+      for ranges in ("0-303 314-319", "2-5", "3-280 315", "299-303 314-316"):
+        ranges = RangeSet(ranges)
+        pieces = simg.ReadRangeSet(ranges)
+        self.assertEqual("".join(str(p) for p in pieces),
+                         self._Expected(ranges))
+      self.assertEqual(simg.TotalSha1(), SparseImage(
+          self.simg_file.name).TotalSha1())
+
+  def test_hashes(self):
+    expected_total = sha1(self._Expected(RangeSet("1-303 314-319")))
+    expected_total_clobbered = sha1(self._Expected(RangeSet("0-303 314-319")))
+    for use_mmap in (False, True):
+      simg = SparseImage(self.simg_file.name, clobbered_blocks="0",
+                         use_mmap=use_mmap)
+      for ranges in ("0-303 314-319", "2-5", "3-280 315", "299", "315"):
+        ranges = RangeSet(ranges)
+        self.assertEqual(simg.RangeSha1(ranges),
+                         sha1(self._Expected(ranges)).hexdigest())
+      # Single blocks don't need the block hash index.
+      self.assertIsNone(simg._block_sha1s)
+      self.assertEqual(simg.TotalSha1(), expected_total.hexdigest())
+
+      simg = SparseImage(self.simg_file.name, clobbered_blocks="0",
+                         use_mmap=use_mmap)
+      simg.BuildHashIndex()
+      self.assertEqual(simg.TotalSha1(), expected_total.hexdigest())
+      self.assertEqual(simg.TotalSha1(include_clobbered_blocks=True),
+                       expected_total_clobbered.hexdigest())
+      self.assertEqual(simg.BlockSha1(2),
+                       sha1(self._Expected(RangeSet("2"))).digest())
+      self.assertEqual(simg.RangeSha1(RangeSet("2")),
+                       sha1(self._Expected(RangeSet("2"))).hexdigest())
+      self.assertRaises(ValueError, simg.BlockSha1, 305)
+      self.assertRaises(ValueError, simg.BlockSha1, 320)
+
+  def test_range_sha1_cache(self):
+    simg = SparseImage(self.simg_file.name, clobbered_blocks="0")
+    simg.RANGE_SHA1_CACHE_SIZE = 4
+    for i in range(10):
+      simg.RangeSha1(RangeSet(data=(i, i + 2)))
+    simg.RangeSha1(RangeSet("6-7"))
+    simg.RangeSha1(RangeSet("0-1"))
+    self.assertEqual(list(simg._range_sha1s),
+                     [RangeSet(r).data.tostring()
+                      for r in ("8-9", "9-10", "6-7", "0-1")])
+    self.assertEqual(simg.RangeSha1(RangeSet("0-1")),
+                     sha1(self._Expected(RangeSet("0-1"))).hexdigest())
+
+  def test_offset(self):
+    # The image stored inside another file, e.g. a zip.
+    with open(self.simg_file.name) as f:
+      simg_data = f.read()
+    outer_file = tempfile.NamedTemporaryFile()
+    outer_file.write("x" * 1000 + simg_data + "y" * 1000)
+    outer_file.flush()
+    for use_mmap in (False, True):
+      simg = SparseImage(outer_file.name, use_mmap=use_mmap, offset=1000)
+      self.assertEqual(simg.care_map, RangeSet("0-303 314-319"))
+      ranges = RangeSet("3-280 315")
+      self.assertEqual("".join(str(p) for p in simg.ReadRangeSet(ranges)),
+                       self._Expected(ranges))
+    outer_file.close()
+
+  def test_mmap_read_only(self):
+    self.assertRaises(ValueError, SparseImage, self.simg_file.name,
+                      mode="r+b", use_mmap=True)
+
+  def test_file_map(self):
+    map_file = tempfile.NamedTemporaryFile()
+    map_file.write("/system/file 2-3\n")
+    map_file.flush()
+    simg = SparseImage(self.simg_file.name, map_file.name, "0")
+    map_file.close()
+
+    # Blocks 1 and 315-316 are non-zero raw blocks, 4-303 a non-zero fill;
+    # they all fit in a single group of non-zero blocks.
+    self.assertEqual(sorted(simg.file_map), [
+        "/system/file", "__COPY", "__NONZERO-0", "__ZERO"])
+    self.assertEqual(simg.file_map["__ZERO"], RangeSet("314 317-319"))
+    self.assertEqual(simg.file_map["__NONZERO-0"],
+                     RangeSet("1 4-303 315-316"))
+    self.assertEqual(simg.file_map["__COPY"], RangeSet("0"))
+
+  def test_file_map_groups(self):
+    simg_file = tempfile.NamedTemporaryFile()
+    WriteSparseImage(simg_file, [
+        ("raw", ("x" * BLOCKSIZE + "\0" * BLOCKSIZE) * 600),
+        ("fill", "\1\1\1\1", 500),
+    ])
+    simg = SparseImage(simg_file.name, "/dev/null", "")
+    simg_file.close()
+
+    self.assertEqual(simg.file_map["__ZERO"],
+                     RangeSet(data=range(1, 1201)))
+    self.assertEqual(simg.file_map["__NONZERO-0"],
+                     RangeSet(data=range(0, 1024)))
+    self.assertEqual(simg.file_map["__NONZERO-1"],
+                     RangeSet(data=range(1024, 1200) + [1200, 1624]))
+    self.assertEqual(simg.file_map["__NONZERO-2"], RangeSet("1624-1699"))